@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
 import datetime
 import json
 import logging
@@ -17,31 +18,47 @@ from pymongo import UpdateMany
 
 from matchengine.internals.database_connectivity.mongo_connection import MongoDBConnection
 from matchengine.internals.match_criteria_transform import MatchCriteriaTransform
+from matchengine.internals.query_transform import QueryTransformerMemo
 from matchengine.internals.match_translator import (
     extract_match_clauses_from_trial,
     create_match_tree,
     get_match_paths,
-    translate_match_path
+    translate_match_path,
+    translate_match_tree,
+    translate_match_tree_paths
 )
 from matchengine.internals.typing.matchengine_types import (
     PoisonPill,
     Cache,
     QueryTask,
+    MatchTreeTask,
     UpdateTask,
     RunLogUpdateTask,
     CheckIndicesTask,
     IndexUpdateTask
 )
+from matchengine.internals.utilities.age_eligibility import BirthDateIndex
+from matchengine.internals.utilities.in_memory_query import InMemoryClinicalEvaluator, ExtendedAttributeIndex
 from matchengine.internals.utilities.list_utils import chunk_list
-from matchengine.internals.utilities.object_comparison import nested_object_hash
+from matchengine.internals.utilities.match_hash import PartialDigest
+from matchengine.internals.utilities.match_template import TrialMatchTemplate, clinical_match_fields
+from matchengine.internals.utilities.object_comparison import set_legacy_hashing
+from matchengine.internals.utilities import parallel_compilation
+from matchengine.internals.utilities.persistent_cache import PersistentQueryCache
+from matchengine.internals.utilities.plan_cache import PlanCache, PersistentPlanCache, plan_fingerprint
 from matchengine.internals.utilities.query import (
     execute_clinical_queries,
     execute_extended_queries,
     get_docs_results,
-    get_valid_reasons
+    get_valid_reasons,
+    prefetch_queries
 )
+from matchengine.internals.utilities.query_planner import QueryPlanner, QUERY_STATISTICS_COLLECTION
+from matchengine.internals.utilities.run_log import ClinicalUpdateIndex, run_log_signature
+from matchengine.internals.utilities.sort_order import SortOrderEvaluator
 from matchengine.internals.utilities.task_utils import (
     run_query_task,
+    run_match_tree_task,
     run_poison_pill,
     run_update_task,
     run_run_log_update_task,
@@ -55,7 +72,8 @@ from matchengine.internals.utilities.utilities import (
 if TYPE_CHECKING:
     from typing import (
         NoReturn,
-        Any
+        Any,
+        Callable
     )
     from matchengine.internals.typing.matchengine_types import (
         Dict,
@@ -63,6 +81,7 @@ if TYPE_CHECKING:
         List,
         Set,
         ClinicalID,
+        MatchClauseData,
         MultiCollectionQuery,
         MatchReason,
         ObjectId,
@@ -81,13 +100,34 @@ class MatchEngine(object):
     cache: Cache
     config: Dict
     match_criteria_transform: MatchCriteriaTransform
+    sort_order_evaluator: SortOrderEvaluator
     protocol_nos: Union[List[str], None]
     sample_ids: Union[List[str], None]
     match_on_closed: bool
     match_on_deceased: bool
+    combine_clinical_queries: bool
+    query_node_concurrency: int
+    in_memory_clinical_queries: bool
+    clinical_evaluator: Union[InMemoryClinicalEvaluator, None]
+    index_extended_attributes: bool
+    extended_attribute_index: Union[ExtendedAttributeIndex, None]
+    plan_queries: bool
+    query_planner: Union[QueryPlanner, None]
+    prefetch_queries: bool
+    factorize_match_trees: bool
+    share_match_path_prefixes: bool
+    plan_cache: Union[PlanCache, None]
+    persistent_plan_cache: Union[PersistentPlanCache, None]
+    compile_workers: int
+    memoize_query_transformers: bool
+    canonical_hashes: bool
+    compose_match_hashes: bool
+    query_cache_path: Union[str, None]
     debug: bool
     num_workers: int
     clinical_ids: Set[ClinicalID]
+    birth_date_index: BirthDateIndex
+    clinical_update_index: ClinicalUpdateIndex
     _task_q: asyncio.queues.Queue
     _matches: Dict[str, Dict[str, List[Dict]]]
     _loop: asyncio.AbstractEventLoop
@@ -117,6 +157,12 @@ class MatchEngine(object):
             self._loop.run_until_complete(self._async_exit())
             self._loop.stop()
             self._loop.close()
+        if self.cache.persistent is not None:
+            self.cache.persistent.close()
+        self._stop_compiling_trials()
+        if self.persistent_plan_cache is not None:
+            self.persistent_plan_cache.close()
+        set_legacy_hashing(self._previous_legacy_hashing)
 
     def __init__(
             self,
@@ -150,7 +196,22 @@ class MatchEngine(object):
             drop_accept: bool = False,
             resource_dirs: List = None,
             chunk_size: int = 1000,
-            bypass_warnings: bool = False
+            bypass_warnings: bool = False,
+            combine_clinical_queries: bool = False,
+            query_node_concurrency: int = 4,
+            in_memory_clinical_queries: bool = False,
+            index_extended_attributes: bool = False,
+            plan_queries: bool = False,
+            prefetch_queries: bool = False,
+            query_cache_path: str = None,
+            factorize_match_trees: bool = False,
+            share_match_path_prefixes: bool = False,
+            cache_compiled_plans: bool = False,
+            plan_cache_path: str = None,
+            compile_workers: int = 0,
+            memoize_query_transformers: bool = False,
+            canonical_hashes: bool = False,
+            compose_match_hashes: bool = False
     ):
         self.resource_dirs = list()
         self.resource_dirs.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'ref'))
@@ -167,6 +228,17 @@ class MatchEngine(object):
         self._sample_ids_param = list(sample_ids) if sample_ids is not None else sample_ids
         self.chunk_size = chunk_size
         self.debug = debug
+        # hashes are persisted, so every hash of a run must use the same encoding.  The encoding is process wide, and
+        # restored on exit
+        self.canonical_hashes = canonical_hashes
+        self._previous_legacy_hashing = set_legacy_hashing(not self.canonical_hashes)
+        if compose_match_hashes and not canonical_hashes:
+            log.warning("Composite match hashes need canonical hashes; hashing trial_match documents in full")
+        self.compose_match_hashes = compose_match_hashes and canonical_hashes
+        self._trial_partial_digests: Dict[str, PartialDigest] = dict()
+        self._clinical_partial_digests: Dict[ClinicalID, PartialDigest] = dict()
+        self._trial_match_templates: Dict[str, TrialMatchTemplate] = dict()
+        self._clinical_match_fields: Dict[ClinicalID, Tuple[Dict, Dict]] = dict()
 
         if config.__class__ is str:
             with open(config) as config_file_handle:
@@ -175,6 +247,8 @@ class MatchEngine(object):
             self.config = config
 
         self.match_criteria_transform = MatchCriteriaTransform(self.config, self.resource_dirs)
+        self.sort_order_evaluator = SortOrderEvaluator(self.config['trial_match_sorting'],
+                                                       self.match_criteria_transform.trial_identifier)
 
         self.plugin_dir = plugin_dir
         self.match_document_creator_class = match_document_creator_class
@@ -183,6 +257,9 @@ class MatchEngine(object):
         self.query_node_subsetter_class = query_node_subsetter_class
         self.db_secrets_class = db_secrets_class
         find_plugins(self)
+        self.memoize_query_transformers = memoize_query_transformers
+        if self.memoize_query_transformers:
+            self.match_criteria_transform.query_transformer_memo = QueryTransformerMemo()
 
         self.db_init = db_init
         self._db_ro = MongoDBConnection(read_only=True, async_init=False,
@@ -222,6 +299,25 @@ class MatchEngine(object):
         self.match_on_closed = match_on_closed
         self.match_on_deceased = match_on_deceased
         self.report_all_clinical_reasons = report_all_clinical_reasons
+        self.combine_clinical_queries = combine_clinical_queries
+        self.query_node_concurrency = query_node_concurrency
+        self.in_memory_clinical_queries = in_memory_clinical_queries
+        self.index_extended_attributes = index_extended_attributes
+        self.plan_queries = plan_queries
+        self.prefetch_queries = prefetch_queries
+        self.query_cache_path = query_cache_path
+        self.factorize_match_trees = factorize_match_trees
+        self.share_match_path_prefixes = share_match_path_prefixes
+        fingerprint = (self.get_plan_fingerprint()
+                       if cache_compiled_plans or plan_cache_path is not None
+                       else None)
+        self.plan_cache = PlanCache(fingerprint) if cache_compiled_plans else None
+        self.persistent_plan_cache = (PersistentPlanCache(plan_cache_path, fingerprint)
+                                      if plan_cache_path is not None
+                                      else None)
+        self.compile_workers = compile_workers
+        self._compile_pool = None
+        self._compiling: Dict[str, concurrent.futures.Future] = dict()
         self.num_workers = num_workers
         self.visualize_match_paths = visualize_match_paths
         self.fig_dir = fig_dir
@@ -234,19 +330,40 @@ class MatchEngine(object):
             self.protocol_nos = list(self.trials.keys())
         self._run_log_history = self._populate_run_log_history()
         self._clinical_data = self._get_clinical_data()
+        self.clinical_evaluator = (InMemoryClinicalEvaluator(self.cache.clinical_id_index,
+                                                             self._clinical_data,
+                                                             self.get_clinical_query_fields())
+                                   if self.in_memory_clinical_queries
+                                   else None)
         self.clinical_mapping = self.get_clinical_ids_from_sample_ids()
         self.clinical_deceased = self.get_clinical_deceased()
         self.clinical_birth_dates = self.get_clinical_birth_dates()
+        self.birth_date_index = BirthDateIndex(self.clinical_birth_dates,
+                                               getattr(self.match_criteria_transform.query_transformers,
+                                                       'age_range_to_date_int_query'))
         self.clinical_update_mapping = dict() if self.ignore_run_log else self.get_clinical_updated_mapping()
+        self.clinical_update_index = ClinicalUpdateIndex(self.clinical_update_mapping)
+        if self.query_cache_path is not None:
+            self.cache.persistent = PersistentQueryCache(self.query_cache_path,
+                                                         self.get_clinical_updated_mapping(),
+                                                         self.starttime)
         self.clinical_extra_field_lookup = self.get_extra_field_lookup(self._clinical_data,
                                                                        "clinical")
         self._clinical_ids_for_protocol_cache = dict()
+        self._clinical_ids_for_run_log_signature = dict()
+        self._compiled_trials = dict()
         self.sample_mapping = {sample_id: clinical_id for clinical_id, sample_id in
                                self.clinical_mapping.items()}
         self.clinical_ids = set(self.clinical_mapping.keys())
         self.clinical_run_log_mapping = (dict()
                                          if self.get_clinical_ids_from_sample_ids()
                                          else self.get_clinical_run_log_mapping())
+        self.extended_attribute_index = (self.get_extended_attribute_index()
+                                         if self.index_extended_attributes
+                                         else None)
+        self.query_planner = (QueryPlanner(self.cache, self.get_query_statistics())
+                              if self.plan_queries
+                              else None)
         if self.sample_ids is None:
             self.sample_ids = list(self.clinical_mapping.values())
 
@@ -335,14 +452,23 @@ class MatchEngine(object):
         Execute a mongo query on the clinical and extended_attributes collections to find trial matches.
         First execute the clinical query. If no records are returned short-circuit and return.
         """
-        clinical_ids = set(initial_clinical_ids)
+        clinical_ids = self.cache.clinical_id_index.to_set(initial_clinical_ids)
+        if (self.query_planner is not None
+                and multi_collection_query.clinical
+                and multi_collection_query.extended_attributes
+                and self.query_planner.extended_first(multi_collection_query)):
+            # narrow down the clinical IDs with the extended queries first. The results are cached, so running the
+            # extended queries again after the clinical ones only builds the match reasons
+            clinical_ids, _, _ = await execute_extended_queries(self,
+                                                                multi_collection_query,
+                                                                clinical_ids,
+                                                                defaultdict(list))
+            if not clinical_ids:
+                return dict()
         if multi_collection_query.clinical:
             new_clinical_ids, clinical_match_reasons = await execute_clinical_queries(self,
                                                                                       multi_collection_query,
-                                                                                      clinical_ids
-                                                                                      if clinical_ids
-                                                                                      else set(
-                                                                                          initial_clinical_ids))
+                                                                                      clinical_ids)
             clinical_ids = new_clinical_ids
         else:
             clinical_match_reasons = defaultdict(list)
@@ -353,10 +479,7 @@ class MatchEngine(object):
             new_clinical_ids, extended_attribute_id_map, all_match_reasons = await (
                 execute_extended_queries(self,
                                          multi_collection_query,
-                                         clinical_ids
-                                         if clinical_ids
-                                         else set(
-                                             initial_clinical_ids),
+                                         clinical_ids,
                                          clinical_match_reasons)
             )
             clinical_ids = new_clinical_ids
@@ -366,8 +489,11 @@ class MatchEngine(object):
             extended_attribute_id_map = dict()
             all_match_reasons = clinical_match_reasons
 
-        needed_clinical = list(clinical_ids)
-        needed_extended = extended_attribute_id_map
+        # documents already loaded by an earlier query (or by prefetching) are not fetched again
+        needed_clinical = [clinical_id for clinical_id in clinical_ids if clinical_id not in self.cache.docs]
+        needed_extended = {query_level: [extended_id for extended_id in extended_ids
+                                         if extended_id not in self.cache.docs]
+                           for query_level, extended_ids in extended_attribute_id_map.items()}
         results = await get_docs_results(self, needed_clinical, needed_extended)
 
         # asyncio.gather returns [[],[]]. Save the resulting values on the cache for use when creating trial matches
@@ -395,6 +521,9 @@ class MatchEngine(object):
             elif task_class is QueryTask:
                 await run_query_task(*args)
 
+            elif task_class is MatchTreeTask:
+                await run_match_tree_task(*args)
+
             elif task_class is UpdateTask:
                 await run_update_task(*args)
 
@@ -421,7 +550,7 @@ class MatchEngine(object):
             clinical_ids: Iterable[ClinicalID]
     ) -> Tuple[bool, Set[ClinicalID]]:
         """Stub function to be overriden by plugin"""
-        return True, {clinical_id for clinical_id in clinical_ids}
+        return True, clinical_ids
 
     def clinical_query_node_clinical_ids_subsetter(
             self,
@@ -429,7 +558,7 @@ class MatchEngine(object):
             clinical_ids: Iterable[ClinicalID]
     ) -> Tuple[bool, Set[ClinicalID]]:
         """Stub function to be overriden by plugin"""
-        return True, {clinical_id for clinical_id in clinical_ids}
+        return True, clinical_ids
 
     def update_matches_for_protocol_number(self, protocol_no: str):
         """
@@ -466,11 +595,19 @@ class MatchEngine(object):
                     self.task_q.put_nowait(UpdateTask([UpdateMany(query, update)],
                                                       protocol_number))
             self.update_matches_for_protocol_number(protocol_number)
+        # like the matches themselves, query statistics are only written by runs which update the database (i.e. not
+        # by dry runs)
+        if self.query_planner is not None and self.db_init:
+            self.save_query_statistics()
 
     def get_matches_for_all_trials(self) -> Dict[str, Dict[str, List]]:
         """
         Synchronously iterates over each protocol number, getting trial matches for each
         """
+        if self.compile_workers:
+            self._start_compiling_trials()
+        if self.prefetch_queries:
+            self._loop.run_until_complete(self._async_prefetch_queries())
         for protocol_no in self.protocol_nos:
             if protocol_no not in self._trials_to_match_on:
                 logging.info((f'{self.match_criteria_transform.trial_collection} {protocol_no} '
@@ -480,8 +617,62 @@ class MatchEngine(object):
                                                                                                         set())
                 continue
             self.get_matches_for_trial(protocol_no)
+        self._stop_compiling_trials()
+        if self.cache.persistent is not None:
+            self.cache.persistent.flush()
+        if self.persistent_plan_cache is not None:
+            self.persistent_plan_cache.flush()
+            log.info(f"Persisted compiled trials: {self.persistent_plan_cache.hits} loaded, "
+                     f"{self.persistent_plan_cache.misses} compiled")
+        if self.plan_cache is not None:
+            log.info(f"Compiled plan cache: {self.plan_cache.hits} hits, {self.plan_cache.misses} misses "
+                     f"({self.plan_cache.hit_rate():.1%} hit rate)")
+        query_transformer_memo = self.match_criteria_transform.query_transformer_memo
+        if query_transformer_memo is not None:
+            log.info(f"Query transformer memo: {query_transformer_memo.hits} hits, {query_transformer_memo.misses} "
+                     f"misses ({query_transformer_memo.hit_rate():.1%} hit rate)")
+        if self.debug:
+            log.info(f"Cache memory usage (bytes): {self.cache.memory_usage()}")
         return self._matches
 
+    async def _async_prefetch_queries(self):
+        """
+        The first phase of a two-phase run: compile every trial to be matched, then run each distinct query of the
+        compiled trials once, for the clinical IDs of all trials, so that the trials are matched from the cache.
+        """
+        clinical_ids = self.cache.clinical_id_index.empty_set()
+        clinical_query_parts = dict()
+        extended_query_nodes = dict()
+        for protocol_no in self.protocol_nos:
+            if protocol_no not in self._trials_to_match_on:
+                continue
+            tasks, age_criteria = self._compiled_trials[protocol_no] = await self._async_compile_trial(protocol_no)
+            clinical_ids_to_run = self.get_clinical_ids_for_protocol(protocol_no, age_criteria)
+            if not clinical_ids_to_run:
+                continue
+            clinical_ids |= clinical_ids_to_run
+            queries = ([node_query for _, _, _, node_queries, _ in tasks for node_query in node_queries.values()]
+                       if self.factorize_match_trees
+                       else [query for _, _, _, query in tasks])
+            for query in queries:
+                for query_node_container in query.clinical:
+                    for query_node in query_node_container.query_nodes:
+                        for query_part in query_node.query_parts:
+                            if query_part.render:
+                                clinical_query_parts.setdefault(query_part.hash(),
+                                                                (query_node.query_level, query_part))
+                for query_node_container in query.extended_attributes:
+                    for query_node in query_node_container.query_nodes:
+                        # an exclusion and an inclusion query node share their query, but only the documents
+                        # returned for inclusions are reported
+                        query_hash = query_node.raw_query_hash()
+                        if extended_query_nodes.get(query_hash, query_node).exclusion or not query_node.exclusion:
+                            extended_query_nodes[query_hash] = query_node
+        log.info(f"Prefetching {len(clinical_query_parts)} clinical and {len(extended_query_nodes)} extended "
+                 f"queries for {len(clinical_ids)} patients")
+        restrict = self._sample_ids_param is not None or len(clinical_ids) < len(self.clinical_ids)
+        await prefetch_queries(self, clinical_query_parts, extended_query_nodes, clinical_ids, restrict)
+
     def get_matches_for_trial(self, protocol_no: str):
         """
         Get the trial matches for a given protocol number
@@ -490,36 +681,165 @@ class MatchEngine(object):
         task = self._loop.create_task(self._async_get_matches_for_trial(protocol_no))
         return self._loop.run_until_complete(task)
 
-    async def _async_get_matches_for_trial(self, protocol_no: str) -> Dict[str, List[Dict]]:
+    def compile_trial(self, protocol_no: str) -> Tuple[List[Tuple], Set[str]]:
         """
-        Asynchronous function used by get_matches_for_trial, not meant to be called externally.
-        Gets the matches for a given trial
+        Translate each match path of each match clause of a trial into a MultiCollectionQuery.
+        Returns the (trial, match clause, match path, query) of each match path, and the age criteria of the trial
+
+        If the factorize_match_trees flag is set, match clauses are not expanded into match paths. Instead, the
+        (trial, match clause, match tree, query of each node of the tree, match path and query of each path of the tree)
+        of each match clause is returned.
+
+        If a plan cache path is set, the trial is loaded from the plans persisted by previous runs instead, as long
+        as neither the trial nor the plan fingerprint has changed since.
         """
-        # Get each match clause in the trial document
         trial = self.trials[protocol_no]
+        persistent_plan_cache = self.persistent_plan_cache
+        if persistent_plan_cache is not None:
+            compiled_trial = persistent_plan_cache.load(protocol_no, trial.get('_updated', None))
+            if compiled_trial is not None:
+                persisted_tasks, age_criteria = compiled_trial
+                return [(trial,) + task for task in persisted_tasks], age_criteria
+
+        # Get each match clause in the trial document, and compile each (or reuse an identical match clause's plan)
         match_clauses = extract_match_clauses_from_trial(self, protocol_no)
 
-        # for each match clause, create the match tree, and extract each possible match path from the tree
         tasks = list()
         age_criteria = set()
         for match_clause in match_clauses:
-            match_tree = create_match_tree(self, match_clause)
-            match_paths = get_match_paths(match_tree)
-
-            # for each match path, translate the path into valid mongo queries
-            for match_path in match_paths:
-                query = translate_match_path(self, match_clause, match_path)
-                for criteria_node in match_path.criteria_list:
-                    for criteria in criteria_node.criteria:
-                        # check if node has any age criteria, to know to check for newly qualifying patients
-                        # or patients aging out
-                        for k, v in criteria.get('clinical', dict()).items():
-                            if k.lower() == 'age_numerical':
-                                age_criteria.add(v)
-                if self.debug:
-                    log.info(f"Query: {query}")
-                # put the query onto the task queue for execution
-                tasks.append((trial, match_clause, match_path, query))
+            if self.plan_cache is not None and not self.visualize_match_paths:
+                key = self.plan_cache.key(match_clause)
+                plan = self.plan_cache.get(key)
+                if plan is None:
+                    plan = self.compile_match_clause(match_clause)
+                    self.plan_cache.put(key, plan)
+            else:
+                plan = self.compile_match_clause(match_clause)
+            match_clause_tasks, match_clause_age_criteria = plan
+            tasks.extend((trial, match_clause) + task for task in match_clause_tasks)
+            age_criteria.update(match_clause_age_criteria)
+        if persistent_plan_cache is not None:
+            # the trial itself is not persisted, it is loaded from the database on every run
+            persistent_plan_cache.record(protocol_no,
+                                         trial.get('_updated', None),
+                                         ([task[1:] for task in tasks], age_criteria))
+        return tasks, age_criteria
+
+    def _start_compiling_trials(self):
+        """
+        Submit every trial to be matched (which hasn't been persisted by an earlier run) to a pool of compile_workers
+        processes, so trials are compiled while earlier trials are being matched
+        """
+        self._compile_pool = parallel_compilation.create_compile_pool(self.compile_workers,
+                                                                      self.get_compiler_settings())
+        for protocol_no in self.protocol_nos:
+            if protocol_no not in self._trials_to_match_on or protocol_no in self._compiled_trials:
+                continue
+            trial = self.trials[protocol_no]
+            if self.persistent_plan_cache is not None:
+                compiled_trial = self.persistent_plan_cache.load(protocol_no, trial.get('_updated', None))
+                if compiled_trial is not None:
+                    persisted_tasks, age_criteria = compiled_trial
+                    self._compiled_trials[protocol_no] = ([(trial,) + task for task in persisted_tasks],
+                                                          age_criteria)
+                    continue
+            self._compiling[protocol_no] = self._compile_pool.submit(parallel_compilation.compile_trial,
+                                                                     protocol_no,
+                                                                     trial)
+
+    def _stop_compiling_trials(self):
+        if self._compile_pool is None:
+            return
+        for future in self._compiling.values():
+            future.cancel()
+        self._compiling = dict()
+        self._compile_pool.shutdown(wait=False)
+        self._compile_pool = None
+
+    async def _async_compile_trial(self, protocol_no: str) -> Tuple[List[Tuple], Set[str]]:
+        """
+        The compiled trial of a protocol number, compiled in advance (by _async_prefetch_queries or a compilation
+        worker process) if possible. Waiting for a compilation worker lets other tasks run in the meantime.
+        """
+        compiled_trial = self._compiled_trials.pop(protocol_no, None)
+        if compiled_trial is not None:
+            return compiled_trial
+        future = self._compiling.pop(protocol_no, None)
+        if future is None:
+            return self.compile_trial(protocol_no)
+        compiled_tasks, age_criteria = await asyncio.wrap_future(future)
+        trial = self.trials[protocol_no]
+        if self.persistent_plan_cache is not None:
+            self.persistent_plan_cache.record(protocol_no, trial.get('_updated', None), (compiled_tasks, age_criteria))
+        return [(trial,) + task for task in compiled_tasks], age_criteria
+
+    def get_compiler_settings(self) -> Dict[str, Any]:
+        """
+        The attributes of this MatchEngine which compiling a trial depends on, from which compilation worker
+        processes build their own MatchEngine (see parallel_compilation.init_compiler)
+        """
+        return {
+            'config': self.config,
+            'resource_dirs': self.resource_dirs,
+            'plugin_dir': self.plugin_dir,
+            'match_document_creator_class': self.match_document_creator_class,
+            'query_node_transformer_class': self.query_node_transformer_class,
+            'query_node_container_transformer_class': self.query_node_container_transformer_class,
+            'query_node_subsetter_class': self.query_node_subsetter_class,
+            # database secrets are never needed to compile
+            'db_secrets_class': None,
+            'match_on_closed': self.match_on_closed,
+            'factorize_match_trees': self.factorize_match_trees,
+            'memoize_query_transformers': self.memoize_query_transformers,
+            'canonical_hashes': self.canonical_hashes,
+            'debug': self.debug,
+            'visualize_match_paths': False,
+            'fig_dir': self.fig_dir,
+            'plan_cache': PlanCache(self.plan_cache.fingerprint) if self.plan_cache is not None else None,
+            'persistent_plan_cache': None
+        }
+
+    def compile_match_clause(self, match_clause: MatchClauseData) -> Tuple[List[Tuple], Set[str]]:
+        """
+        Create the match tree of a match clause, and translate each possible match path from the tree.
+        Returns the (match path, query) of each match path, or, if the factorize_match_trees flag is set, the single
+        (match tree, query of each node of the tree, match path and query of each path of the tree), and the age
+        criteria of the match clause
+        """
+        age_criteria = set()
+        match_tree = create_match_tree(self, match_clause)
+        if self.factorize_match_trees:
+            for node in match_tree.nodes.values():
+                for criteria in node['criteria_list']:
+                    for k, v in criteria.get('clinical', dict()).items():
+                        if k.lower() == 'age_numerical':
+                            age_criteria.add(v)
+            return [(match_tree,
+                     translate_match_tree(self, match_clause, match_tree),
+                     translate_match_tree_paths(self, match_clause, match_tree))], age_criteria
+
+        # for each match path, translate the path into valid mongo queries
+        tasks = list()
+        for match_path in get_match_paths(match_tree):
+            query = translate_match_path(self, match_clause, match_path)
+            for criteria_node in match_path.criteria_list:
+                for criteria in criteria_node.criteria:
+                    # check if node has any age criteria, to know to check for newly qualifying patients
+                    # or patients aging out
+                    for k, v in criteria.get('clinical', dict()).items():
+                        if k.lower() == 'age_numerical':
+                            age_criteria.add(v)
+            if self.debug:
+                log.info(f"Query: {query}")
+            tasks.append((match_path, query))
+        return tasks, age_criteria
+
+    async def _async_get_matches_for_trial(self, protocol_no: str) -> Dict[str, List[Dict]]:
+        """
+        Asynchronous function used by get_matches_for_trial, not meant to be called externally.
+        Gets the matches for a given trial
+        """
+        tasks, age_criteria = await self._async_compile_trial(protocol_no)
 
         clinical_ids_to_run = self.get_clinical_ids_for_protocol(protocol_no, age_criteria)
         if not self.skip_run_log_entry:
@@ -527,14 +847,23 @@ class MatchEngine(object):
         if not clinical_ids_to_run:
             log.info(f"No need to re-run {self.match_criteria_transform.trial_collection} {protocol_no}; skipping")
             return {}
-        for task in tasks:
-            self._task_q.put_nowait(QueryTask(*task,
-                                              clinical_ids_to_run))
+        # convert once, rather than once per match path
+        clinical_ids_to_run = self.cache.clinical_id_index.to_set(clinical_ids_to_run)
+        if self.factorize_match_trees:
+            for task in tasks:
+                self._task_q.put_nowait(MatchTreeTask(*task, clinical_ids_to_run))
+        else:
+            # the clinical IDs matching each shared prefix of the match paths of a match clause, for this trial
+            path_prefixes = dict() if self.share_match_path_prefixes else None
+            for task in tasks:
+                self._task_q.put_nowait(QueryTask(*task, clinical_ids_to_run, path_prefixes))
         if self.debug:
             log.info(f"Submitted {self._task_q.qsize()} QueryTasks to queue")
         if not self._task_q.qsize():
             self._matches[protocol_no] = dict()
         await self._task_q.join()
+        if self.cache.persistent is not None:
+            self.cache.persistent.flush()
         logging.info(f"Total patient matches: {len(self._matches.get(protocol_no, dict()))}")
         logging.info(
             f"Total {self.trial_match_collection} documents: {sum([len(matches) for matches in self._matches.get(protocol_no, dict()).values()])}")
@@ -568,14 +897,89 @@ class MatchEngine(object):
         projection = {'_id': 1, 'SAMPLE_ID': 1, 'VITAL_STATUS': 1, 'BIRTH_DATE_INT': 1}
         if not self.ignore_run_log:
             projection.update({'_updated': 1, 'run_history': 1})
+        if self.query_cache_path is not None:
+            projection.update({'_updated': 1})
         projection.update({
             item[0]: 1
             for item
             in self.config.get("extra_initial_lookup_fields", dict()).get("clinical", list())})
+        if self.in_memory_clinical_queries:
+            projection.update({field: 1 for field in self.get_clinical_query_fields()})
         return {result['_id']: result
                 for result in
                 self.db_ro.clinical.find(query, projection)}
 
+    def get_clinical_query_fields(self) -> Set[str]:
+        """
+        Clinical document fields which trial criteria can be queried on
+        """
+        return {trial_key_mapping['sample_key']
+                for query_level_mappings in self.match_criteria_transform.ctml_collection_mappings.values()
+                if query_level_mappings['query_collection'] == 'clinical'
+                for trial_key_mapping in query_level_mappings.get('trial_key_mappings', dict()).values()
+                if 'sample_key' in trial_key_mapping}
+
+    def get_extended_attribute_index(self, query_level: str = 'genomic') -> ExtendedAttributeIndex:
+        """
+        Build an inverted index over the extended attributes collection of a query level, covering the fields trial
+        criteria map to and the fields projected for the collection in config.json
+        """
+        query_level_mappings = self.match_criteria_transform.ctml_collection_mappings[query_level]
+        collection = query_level_mappings['query_collection']
+        join_field = query_level_mappings['join_field']
+        id_field = query_level_mappings['id_field']
+        fields = {trial_key_mapping['sample_key']
+                  for trial_key_mapping in query_level_mappings.get('trial_key_mappings', dict()).values()
+                  if trial_key_mapping.get('sample_key', None) is not None}
+        fields.update(self.match_criteria_transform.projections.get(collection, dict()).keys())
+        fields.difference_update({join_field, id_field})
+        query = dict() if self.sample_ids is None else {join_field: {'$in': list(self.clinical_ids)}}
+        projection = {field: 1 for field in fields | {join_field, id_field}}
+        return ExtendedAttributeIndex(self.cache.clinical_id_index,
+                                      query_level,
+                                      join_field,
+                                      id_field,
+                                      fields,
+                                      self.db_ro[collection].find(query, projection))
+
+    def get_plan_fingerprint(self) -> str:
+        """
+        Fingerprint of everything other than the match clauses themselves which compiled trials depend on
+        """
+        return plan_fingerprint(self.config,
+                                {
+                                    'query_node_transformer_class': self.query_node_transformer_class,
+                                    'query_node_container_transformer_class':
+                                        self.query_node_container_transformer_class,
+                                    'factorize_match_trees': self.factorize_match_trees,
+                                    # compiled queries carry their hashes
+                                    'canonical_hashes': self.canonical_hashes,
+                                    # decides which match clauses of a trial are compiled
+                                    'match_on_closed': self.match_on_closed
+                                },
+                                [self.plugin_dir, os.path.dirname(__file__)] + self.resource_dirs)
+
+    def get_query_statistics(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Number of clinical IDs queried and matched by each query hash in previous runs
+        """
+        if not self.db_init:
+            return dict()
+        return {result['_id']: (result['queried'], result['matched'])
+                for result in self.db_ro[QUERY_STATISTICS_COLLECTION].find()}
+
+    def save_query_statistics(self):
+        """
+        Persist the number of clinical IDs queried and matched by each query hash, including this run,
+        for the query planner of future runs
+        """
+        updates = [UpdateMany({'_id': query_hash},
+                              {'$set': {'queried': queried, 'matched': matched, '_updated': datetime.datetime.now()}},
+                              upsert=True)
+                   for query_hash, (queried, matched) in self.query_planner.statistics_updates().items()]
+        for chunk in chunk_list(updates, self.chunk_size):
+            self.db_rw[QUERY_STATISTICS_COLLECTION].bulk_write(chunk, ordered=False)
+
     def get_clinical_updated_mapping(self) -> Dict[ObjectId: datetime.datetime]:
         return {clinical_id: clinical_data.get('_updated', None) for clinical_id, clinical_data in
                 self._clinical_data.items()}
@@ -722,34 +1126,43 @@ class MatchEngine(object):
             self._clinical_ids_for_protocol_cache[protocol_no] = self.clinical_ids
             return self._clinical_ids_for_protocol_cache[protocol_no]
 
+        # protocols last run by the same runs share the result
+        signature = run_log_signature(run_log_entries, age_criterion)
+        if signature in self._clinical_ids_for_run_log_signature:
+            self._clinical_ids_for_protocol_cache[protocol_no] = self._clinical_ids_for_run_log_signature[signature]
+            return self._clinical_ids_for_protocol_cache[protocol_no]
+
         clinical_ids_to_not_run = set()
         clinical_ids_to_run = set()
 
         for run_log in run_log_entries:
             # All sample ids are accounted for, short circuit
-            if clinical_ids_to_not_run.union(clinical_ids_to_run) == self.clinical_ids:
+            # (both sets are subsets of self.clinical_ids, so comparing sizes is enough)
+            if (len(clinical_ids_to_run) + len(clinical_ids_to_not_run)
+                    - len(clinical_ids_to_run & clinical_ids_to_not_run)) == len(self.clinical_ids):
                 break
 
             run_log_clinical_ids = run_log['clinical_ids']
             is_all = 'all' in run_log_clinical_ids
             run_log_created_at = run_log['_created']
             prev_run_matched_on_deceased = run_log['run_params']['match_on_deceased']
+            run_log_clinical_id_set = None if is_all else set(run_log_clinical_ids.get('list', list()))
 
             # For all clinical_ids, check if clinical_id has been updated since
             # the last run with current protocol. If it has been updated, run.
-            for clinical_id, updated_at in self.clinical_update_mapping.items():
-                if self.match_on_deceased and clinical_id in self.clinical_deceased and not prev_run_matched_on_deceased:
-                    continue
-                if clinical_id not in self.clinical_ids:
-                    continue
-                if not self.match_on_deceased and clinical_id in self.clinical_deceased:
-                    clinical_ids_to_not_run.add(clinical_id)
-                    continue
-                if updated_at is None:
-                    clinical_ids_to_run.add(clinical_id)
-                elif updated_at > run_log_created_at and clinical_id not in clinical_ids_to_not_run:
-                    if is_all or clinical_id in run_log_clinical_ids['list']:
-                        clinical_ids_to_run.add(clinical_id)
+            clinical_ids_to_check = (self.clinical_ids - self.clinical_deceased
+                                     if self.match_on_deceased and not prev_run_matched_on_deceased
+                                     else self.clinical_ids)
+            if not self.match_on_deceased:
+                clinical_ids_to_not_run.update(clinical_ids_to_check & self.clinical_deceased)
+                clinical_ids_to_check = clinical_ids_to_check - self.clinical_deceased
+            clinical_ids_to_run.update(clinical_ids_to_check & self.clinical_update_index.never_updated)
+            updated_since_run = self.clinical_update_index.updated_since(run_log_created_at)
+            updated_since_run.intersection_update(clinical_ids_to_check)
+            updated_since_run.difference_update(clinical_ids_to_not_run)
+            if not is_all:
+                updated_since_run.intersection_update(run_log_clinical_id_set)
+            clinical_ids_to_run.update(updated_since_run)
 
             # Not all clinical_ids will be accounted for after checking the run_log entries.
             # For the remainder, check if any clinical_ids have aged in/out of eligibility and add
@@ -768,14 +1181,14 @@ class MatchEngine(object):
 
             elif 'list' in run_log_clinical_ids:
                 if self.match_on_deceased and not prev_run_matched_on_deceased:
-                    run_prev = set(run_log_clinical_ids['list']).intersection(
+                    run_prev = run_log_clinical_id_set.intersection(
                         self.clinical_ids - self.clinical_deceased)
                     run_now_not_run_prev = self.clinical_ids - run_prev
                     clinical_ids_to_run.update(run_now_not_run_prev - clinical_ids_to_not_run)
                     clinical_ids_to_run.update(newly_qualifying)
                     clinical_ids_to_not_run.update(run_prev - clinical_ids_to_run)
                 else:
-                    run_prev = set(run_log_clinical_ids['list']).intersection(self.clinical_ids)
+                    run_prev = run_log_clinical_id_set.intersection(self.clinical_ids)
                     run_now_not_run_prev = self.clinical_ids - run_prev
                     clinical_ids_to_run.update(run_now_not_run_prev - clinical_ids_to_not_run)
                     clinical_ids_to_run.update(newly_qualifying)
@@ -786,6 +1199,7 @@ class MatchEngine(object):
         # ensure that we have accounted for all clinical ids
         assert clinical_ids_to_run.union(clinical_ids_to_not_run) == self.clinical_ids
 
+        self._clinical_ids_for_run_log_signature[signature] = clinical_ids_to_run
         self._clinical_ids_for_protocol_cache[protocol_no] = clinical_ids_to_run
         return self._clinical_ids_for_protocol_cache[protocol_no]
 
@@ -799,102 +1213,72 @@ class MatchEngine(object):
         :param clinical_ids:
         :return:
         """
-        clinical_ids_to_run = set()
-        age_range_to_date_query = getattr(self.match_criteria_transform.query_transformers,
-                                          'age_range_to_date_int_query')
-        result_criteria_key_map = {
-            '$lte': lambda x, y: x <= y,
-            '$gte': lambda x, y: x >= y,
-            '$eq': lambda x, y: x == y,
-            '$lt': lambda x, y: x < y,
-            '$gt': lambda x, y: x > y
-        }
-        run_log_created_at = run_log['_created']
-        for clinical_id in clinical_ids:
-            birth_date = self.clinical_birth_dates[clinical_id]
-            continue_matching_age = True
-            for age_criteria in age_criterion:
-                translated_age_criteria_at_run = age_range_to_date_query(sample_key=None,
-                                                                         trial_value=age_criteria,
-                                                                         compare_date=run_log_created_at).results
-                translated_age_criteria__today = age_range_to_date_query(sample_key=None,
-                                                                         trial_value=age_criteria,
-                                                                         compare_date=self.starttime).results
-                if not continue_matching_age:
-                    break
-                for at_run, today in zip(translated_age_criteria_at_run, translated_age_criteria__today):
-                    if not continue_matching_age:
-                        break
-                    for ((_, at_run_criteria), (_, today_criteria)) in zip(at_run._query.items(),
-                                                                           today._query.items()):
-                        if not continue_matching_age:
-                            break
-                        for ((at_run_criteria_key, at_run_criteria_value),
-                             (today_criteria_key, today_criteria_value)) in zip(at_run_criteria.items(),
-                                                                                today_criteria.items()):
-                            if not continue_matching_age:
-                                break
-                            qualified_at_run = result_criteria_key_map[at_run_criteria_key](birth_date,
-                                                                                            at_run_criteria_value)
-                            qualifies_now = result_criteria_key_map[today_criteria_key](birth_date,
-                                                                                        today_criteria_value)
-                            if (qualified_at_run and not qualifies_now) or (qualifies_now and not qualified_at_run):
-                                clinical_ids_to_run.add(clinical_id)
-                                continue_matching_age = False
-        return clinical_ids_to_run
+        if not age_criterion:
+            return set()
+        changed = self.birth_date_index.changed_eligibility(age_criterion, run_log['_created'], self.starttime)
+        return changed.intersection(clinical_ids)
 
     def pre_process_trial_matches(self, trial_match: TrialMatch) -> Dict:
         """
-        Function which returns required fields for trial_match documents
-        """
-
-        new_trial_match = dict()
-        clinical_doc = self.cache.docs[trial_match.match_reason.clinical_id]
-        new_trial_match.update(self.format_trial_match_k_v(clinical_doc))
-        new_trial_match['clinical_id'] = self.cache.docs[trial_match.match_reason.clinical_id][
-            '_id']
-
-        new_trial_match.update(
-            {
-                'match_level': trial_match.match_clause_data.match_clause_level,
-                'internal_id': trial_match.match_clause_data.internal_id,
-                'reason_type': trial_match.match_reason.reason_name,
-                'q_depth': trial_match.match_reason.depth,
-                'q_width': trial_match.match_reason.width,
-                'code': trial_match.match_clause_data.code,
-                'trial_curation_level_status': 'closed' if trial_match.match_clause_data.is_suspended else 'open',
-                'trial_summary_status': trial_match.match_clause_data.status,
-                'coordinating_center': trial_match.match_clause_data.coordinating_center,
-                'show_in_ui': trial_match.match_reason.show_in_ui,
-                'query_hash': trial_match.match_criterion.hash()
-            })
-
-        # add trial fields except for extras
-        new_trial_match.update({
-            k: v
-            for k, v in trial_match.trial.items()
-            if k not in {'treatment_list', '_summary', 'status', '_elasticsearch', 'match'}
-        })
-
-        new_trial_match.update(
-            {
-                'match_path': '.'.join(
-                    [str(item) for item in trial_match.match_clause_data.parent_path])
-            })
-
-        new_trial_match['combo_coord'] = nested_object_hash(
-            {
-                'query_hash': new_trial_match['query_hash'],
-                'match_path': new_trial_match['match_path'],
-                self.match_criteria_transform.trial_identifier: new_trial_match[
-                    self.match_criteria_transform.trial_identifier]
-            })
-
-        new_trial_match['is_disabled'] = False
-        new_trial_match.pop("_updated", None)
-        new_trial_match.pop("last_updated", None)
-        new_trial_match.pop("_id", None)
-        return new_trial_match
+        Function which returns required fields for trial_match documents.
+
+        The fields of the clinical document, trial, match clause and match path are computed once, and merged into each
+        new trial_match document (see TrialMatchTemplate).
+        """
+        match_reason = trial_match.match_reason
+        template = self.get_trial_match_template(trial_match.trial)
+        clause_fields, path_fields = template.get_path_fields(trial_match.match_clause_data,
+                                                              trial_match.match_criterion)
+        return {
+            **self.get_clinical_match_fields(match_reason.clinical_id),
+            **clause_fields,
+            'reason_type': match_reason.reason_name,
+            'q_depth': match_reason.depth,
+            'q_width': match_reason.width,
+            'show_in_ui': match_reason.show_in_ui,
+            # add trial fields except for extras
+            **template.trial_fields,
+            **path_fields
+        }
+
+    def get_trial_match_template(self, trial: Trial) -> TrialMatchTemplate:
+        protocol_no = trial[self.match_criteria_transform.trial_identifier]
+        template = self._trial_match_templates.get(protocol_no, None)
+        if template is None or template.trial is not trial:
+            template = self._trial_match_templates[protocol_no] = TrialMatchTemplate(
+                trial,
+                self.match_criteria_transform.trial_identifier)
+        return template
+
+    def get_clinical_match_fields(self, clinical_id: ClinicalID) -> Dict:
+        """
+        The fields of trial_match documents copied from a clinical document, computed once per patient (or again, if
+        the clinical document is reloaded)
+        """
+        clinical_doc = self.cache.docs[clinical_id]
+        cached = self._clinical_match_fields.get(clinical_id, None)
+        if cached is None or cached[0] is not clinical_doc:
+            cached = self._clinical_match_fields[clinical_id] = (
+                clinical_doc,
+                clinical_match_fields(clinical_doc, self.format_trial_match_k_v(clinical_doc)))
+        return cached[1]
+
+    def get_match_hash_partial_digests(self, trial: Trial, clinical_id: ClinicalID) -> Tuple[PartialDigest,
+                                                                                             PartialDigest]:
+        """
+        The sections of trial_match documents shared by every match of a trial, and of a patient, from which their
+        composite hashes are computed (see match_hash.composite_match_hash)
+        """
+        protocol_no = trial[self.match_criteria_transform.trial_identifier]
+        trial_fields = self.get_trial_match_template(trial).trial_fields
+        trial_partial_digest = self._trial_partial_digests.get(protocol_no, None)
+        if trial_partial_digest is None or trial_partial_digest.values is not trial_fields:
+            trial_partial_digest = self._trial_partial_digests[protocol_no] = PartialDigest(trial_fields)
+        clinical_fields = self.get_clinical_match_fields(clinical_id)
+        clinical_partial_digest = self._clinical_partial_digests.get(clinical_id, None)
+        if clinical_partial_digest is None or clinical_partial_digest.values is not clinical_fields:
+            clinical_partial_digest = self._clinical_partial_digests[clinical_id] = PartialDigest(clinical_fields)
+        return trial_partial_digest, clinical_partial_digest
 
     def format_trial_match_k_v(self, clinical_doc):
         return {key.lower(): val for key, val in clinical_doc.items() if key != "_id"}
@@ -903,6 +1287,18 @@ class MatchEngine(object):
         """Stub function to be overriden by plugin"""
         return dict()
 
+    def create_trial_matches_batch(self,
+                                   trial_matches: List[TrialMatch],
+                                   pre_process_trial_matches: Callable[[TrialMatch], Dict]) -> List[Dict]:
+        """
+        Creates the trial_match documents of the trial matches of a query task, each pre-processed right before its
+        document is created. Overriden by plugins which create them in one batch; otherwise, create_trial_matches is
+        called for each trial match.
+        """
+        create_trial_matches = self.create_trial_matches
+        return [create_trial_matches(trial_match, pre_process_trial_matches(trial_match))
+                for trial_match in trial_matches]
+
     def results_transformer(self, results: Dict[ClinicalID, List[MatchReason]]):
         """Stub function to be overriden by plugin"""
 
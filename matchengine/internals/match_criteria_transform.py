@@ -8,8 +8,11 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from typing import (
         Callable,
-        Any
+        Any,
+        Dict,
+        Union
     )
+    from matchengine.internals.query_transform import QueryTransformerMemo
 
 
 class AllTransformersContainer(object):
@@ -46,6 +49,8 @@ class MatchCriteriaTransform(object):
     query_transformers: AllTransformersContainer
     transform: TransformFunctions
     valid_clinical_reasons: set
+    cacheable_transformers: Dict[str, bool]
+    query_transformer_memo: Union[QueryTransformerMemo, None]
     config: dict = None
     trial_key_mappings: dict = None
     trial_collection: str = None
@@ -83,6 +88,9 @@ class MatchCriteriaTransform(object):
             collection: {field: 1 for field in fields} for collection, fields in config["projections"].items()
         }
         self.query_transformers = AllTransformersContainer(self)
+        # whether each query transformer may be memoized, see query_transform.QueryTransformerMemo
+        self.cacheable_transformers = dict()
+        self.query_transformer_memo = None
         self.trial_collection = config.get('trial_collection', 'trial')
         self.trial_identifier = config.get('trial_identifier', 'protocol_no')
         self.match_trial_link_id = config.get('match_trial_link_id', self.trial_identifier)
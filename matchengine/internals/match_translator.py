@@ -5,8 +5,6 @@ from collections import deque
 from itertools import cycle, chain
 from typing import TYPE_CHECKING
 
-import networkx as nx
-
 from matchengine.internals.typing.matchengine_types import (
     MatchClauseData,
     ParentPath,
@@ -26,9 +24,11 @@ if TYPE_CHECKING:
         Generator,
         Dict,
         Any,
+        List,
         Tuple
     )
     from matchengine.internals.engine import MatchEngine
+    from matchengine.internals.utilities.clinical_id_set import ClinicalIDSet
 
 log = logging.getLogger("matchengine")
 
@@ -132,7 +132,7 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
     """
     match_clause = match_clause_data.match_clause
     process_q: deque[Tuple[NodeID, Dict[str, Any]]] = deque()
-    graph = nx.DiGraph()
+    graph = MatchTree()
     node_id: NodeID = NodeID(1)
     graph.add_node(0)  # root node is 0
     graph.nodes[0]['criteria_list'] = list()
@@ -152,15 +152,17 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
         of the digraphs which are an intermediate data structure used to generate mongo queries later.
         """
         import matplotlib.pyplot as plt
+        import networkx as nx
         from networkx.drawing.nx_agraph import graphviz_layout
         import os
         labels = {node: graph.nodes[node]['label'] for node in graph.nodes}
         for node in graph.nodes:
             if graph.nodes[node]['label_list']:
                 labels[node] = labels[node] + ' [' + ','.join(graph.nodes[node]['label_list']) + ']'
-        pos = graphviz_layout(graph, prog="dot", root=0)
+        nx_graph = graph.to_networkx()
+        pos = graphviz_layout(nx_graph, prog="dot", root=0)
         plt.figure(figsize=(30, 30))
-        nx.draw_networkx(graph, pos, with_labels=True, node_size=[600 for _ in graph.nodes], labels=labels)
+        nx.draw_networkx(nx_graph, pos, with_labels=True, node_size=[600 for _ in graph.nodes], labels=labels)
         plt.savefig(os.path.join(matchengine.fig_dir, (f'{match_clause_data.protocol_no}-'
                                                        f'{match_clause_data.match_clause_level}-'
                                                        f'{match_clause_data.internal_id}.png')))
@@ -189,7 +191,7 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
                     graph.nodes[parent_id]['criteria_list'].extend(criteria_list)
                     graph.nodes[parent_id]['label_list'].extend(label_list)
                 else:
-                    graph.add_edges_from([(parent_id, node_id)])
+                    graph.add_edge(parent_id, node_id)
                     graph.nodes[node_id].update({
                         'criteria_list': criteria_list,
                         'is_and': True,
@@ -215,16 +217,18 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
                 if parent_is_and:
                     parent_or_nodes = graph.nodes[parent_id]['or_nodes']
                     if not parent_or_nodes:
-                        graph.add_edges_from([(parent_id, or_node_id)])
+                        graph.add_edge(parent_id, or_node_id)
                         graph.nodes[parent_id]['or_nodes'] = {or_node_id}
                     else:
-                        successors = [
-                            (successor, or_node_id)
+                        # every path through the earlier or node continues through this one
+                        leaves = [
+                            successor
                             for parent_or_node in parent_or_nodes
-                            for successor in nx.descendants(graph, parent_or_node)
-                            if graph.out_degree(successor) == 0
+                            for successor in graph.descendants(parent_or_node)
+                            if not graph.successors[successor]
                         ]
-                        graph.add_edges_from(successors)
+                        for leaf in leaves:
+                            graph.add_edge(leaf, or_node_id)
                 else:
                     graph.add_edge(parent_id, or_node_id)
             else:
@@ -245,7 +249,7 @@ def create_match_tree(matchengine, match_clause_data: MatchClauseData) -> MatchT
 
     if matchengine.visualize_match_paths:
         graph_match_clause()
-    return MatchTree(graph)
+    return graph
 
 
 def get_match_paths(match_tree: MatchTree) -> Generator[MatchCriterion]:
@@ -253,18 +257,119 @@ def get_match_paths(match_tree: MatchTree) -> Generator[MatchCriterion]:
     Takes a MatchTree (from create_match_tree) and yields the criteria from each possible path on the tree,
     from the root node to each leaf node
     """
-    leaves = list()
-    for node in match_tree.nodes:
-        if match_tree.out_degree(node) == 0:
-            leaves.append(node)
-    for leaf in leaves:
-        for path in nx.all_simple_paths(match_tree, 0, leaf) if leaf != 0 else [[leaf]]:
-            match_path = MatchCriterion(list())
-            for depth, node in enumerate(path):
-                if match_tree.nodes[node]['criteria_list']:
-                    match_path.add_criteria(MatchCriteria(match_tree.nodes[node]['criteria_list'], depth, node))
-            if match_path:
-                yield match_path
+    for path in get_node_paths(match_tree):
+        match_path = path_to_match_criterion(match_tree, path)
+        if match_path:
+            yield match_path
+
+
+def get_node_paths(match_tree: MatchTree) -> Generator[List[NodeID]]:
+    """
+    The nodes of each possible path on a MatchTree, from the root node to each leaf node, in the order of
+    get_match_paths
+    """
+    # expand the tree depth first into every path from the root, grouped by the leaf the path ends at
+    paths_by_leaf = {node: list() for node, children in match_tree.successors.items() if not children}
+    if 0 in paths_by_leaf:
+        paths_by_leaf[0].append([0])
+    else:
+        path = [0]
+        stack = [iter(match_tree.successors[0])]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                path.pop()
+            elif match_tree.successors[node]:
+                path.append(node)
+                stack.append(iter(match_tree.successors[node]))
+            else:
+                paths_by_leaf[node].append(path + [node])
+    for paths in paths_by_leaf.values():
+        yield from paths
+
+
+def get_matching_match_paths(match_tree: MatchTree,
+                             matched: Dict[Tuple[NodeID, int], ClinicalIDSet]
+                             ) -> Generator[Tuple[Tuple[NodeID, ...], ClinicalIDSet]]:
+    """
+    Takes a MatchTree and the clinical IDs matching each of its nodes at each of its depths (from
+    query.evaluate_match_tree), and yields the nodes of only the paths from the root to a leaf which some clinical IDs
+    match every node of, with those clinical IDs. Branches are not descended once no clinical IDs are left.
+    """
+    if not matched[(0, 0)]:
+        return
+    if not match_tree.successors[0]:
+        yield (0,), matched[(0, 0)]
+        return
+    path = [0]
+    path_clinical_ids = [matched[(0, 0)]]
+    stack = [iter(match_tree.successors[0])]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            path.pop()
+            path_clinical_ids.pop()
+            continue
+        clinical_ids = path_clinical_ids[-1] & matched[(node, len(path))]
+        if not clinical_ids:
+            continue
+        if match_tree.successors[node]:
+            path.append(node)
+            path_clinical_ids.append(clinical_ids)
+            stack.append(iter(match_tree.successors[node]))
+        else:
+            yield tuple(path) + (node,), clinical_ids
+
+
+def path_to_match_criterion(match_tree: MatchTree, path: List[NodeID]) -> MatchCriterion:
+    """
+    The criteria of each node along a path from the root of a MatchTree
+    """
+    match_path = MatchCriterion(list())
+    for depth, node in enumerate(path):
+        if match_tree.nodes[node]['criteria_list']:
+            match_path.add_criteria(MatchCriteria(match_tree.nodes[node]['criteria_list'], depth, node))
+    return match_path
+
+
+def translate_match_tree(matchengine: MatchEngine,
+                         match_clause_data: MatchClauseData,
+                         match_tree: MatchTree) -> Dict[Tuple[NodeID, int], MultiCollectionQuery]:
+    """
+    Translate the criteria of each node of a MatchTree on their own, so the tree can be evaluated without expanding
+    it into match paths (see query.evaluate_match_tree). Nodes without criteria have no query.
+
+    A node reachable at several depths (e.g. through or nodes chained one after another) is translated once per
+    depth, so its queries are the same as those of the nodes of the match paths through it.
+    """
+    node_queries = dict()
+    for node, depths in match_tree.depths().items():
+        criteria_list = match_tree.nodes[node]['criteria_list']
+        if criteria_list:
+            for depth in depths:
+                match_criterion = MatchCriterion([MatchCriteria(criteria_list, depth, node)])
+                node_queries[(node, depth)] = translate_match_path(matchengine, match_clause_data, match_criterion)
+    return node_queries
+
+
+def translate_match_tree_paths(matchengine: MatchEngine,
+                               match_clause_data: MatchClauseData,
+                               match_tree: MatchTree
+                               ) -> Dict[Tuple[NodeID, ...], Tuple[MatchCriterion, MultiCollectionQuery]]:
+    """
+    Translate each match path of a MatchTree, keyed by the nodes of the path (as yielded by
+    get_matching_match_paths), so that the match paths a factorized match tree matches are not translated again
+    while matching. Paths without criteria have no query.
+    """
+    path_queries = dict()
+    for path in get_node_paths(match_tree):
+        match_path = path_to_match_criterion(match_tree, path)
+        if match_path:
+            path_queries[tuple(path)] = (match_path,
+                                         translate_match_path(matchengine, match_clause_data, match_path))
+    return path_queries
 
 
 def translate_match_path(matchengine,
@@ -292,15 +397,22 @@ def translate_match_path(matchengine,
                         continue
 
                     sample_value_function_name = trial_key_settings.get('sample_value', 'nomap')
-                    sample_function = getattr(matchengine.match_criteria_transform.query_transformers,
-                                              sample_value_function_name)
                     sample_function_args = dict(sample_key=trial_key.upper(),
                                                 trial_value=trial_value,
                                                 parent_path=match_clause_data.parent_path,
                                                 trial_path=node_name,
                                                 trial_key=trial_key)
                     sample_function_args.update(trial_key_settings)
-                    result: QueryTransformerResult = sample_function(**sample_function_args)
+                    match_criteria_transform = matchengine.match_criteria_transform
+                    if match_criteria_transform.query_transformer_memo is not None:
+                        result: QueryTransformerResult = match_criteria_transform.query_transformer_memo.transform(
+                            match_criteria_transform,
+                            sample_value_function_name,
+                            sample_function_args)
+                    else:
+                        sample_function = getattr(match_criteria_transform.query_transformers,
+                                                  sample_value_function_name)
+                        result: QueryTransformerResult = sample_function(**sample_function_args)
                     to_create = len(result.results) - 1
                     created_nodes = [query_node.__copy__()
                                      for _
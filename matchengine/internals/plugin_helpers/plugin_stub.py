@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Callable, List
 
 if TYPE_CHECKING:
     from matchengine.internals.match_criteria_transform import (
@@ -34,8 +34,21 @@ class TrialMatchDocumentCreator(object):
                              new_trial_match: Dict) -> Dict:
         pass
 
+    # optional; the trial_match documents of the trial matches of a query task, created in one call so that values shared
+    # by the trial matches can be computed once.  pre_process_trial_matches must be called for each trial match right
+    # before creating its document (as documents may depend on the documents created before them), and its result
+    # used as new_trial_match.  Unless a plugin overrides it, create_trial_matches is called for each trial match
+    # instead.
+    def create_trial_matches_batch(self: MatchEngine, trial_matches: List[TrialMatch],
+                                   pre_process_trial_matches: Callable[[TrialMatch], Dict]) -> List[Dict]:
+        pass
+
 
 class QueryTransformerContainer(object):
+    # whether the transformers of the container may be memoized, unless declared otherwise with the cacheable or
+    # not_cacheable decorators of matchengine.internals.query_transform.  Transformers are only memoized once audited,
+    # and declared cacheable.
+    _cacheable: bool = False
     _: MatchCriteriaTransform
     transform: TransformFunctions
     resources: Dict
@@ -3,13 +3,21 @@ from __future__ import annotations
 import datetime
 import json
 from types import MethodType
-from typing import Type
+from typing import TYPE_CHECKING, Type
 
 from dateutil.relativedelta import relativedelta
 
 from matchengine.internals.match_criteria_transform import MatchCriteriaTransform
 from matchengine.internals.plugin_helpers.plugin_stub import QueryTransformerContainer
-from matchengine.internals.typing.matchengine_types import QueryTransformerResult
+from matchengine.internals.typing.matchengine_types import QueryPart, QueryTransformerResult
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Callable,
+        Dict,
+        Tuple
+    )
 
 
 def is_negate(trial_value):
@@ -24,6 +32,25 @@ def is_negate(trial_value):
     return trial_value, negate
 
 
+def cacheable(method: Callable) -> Callable:
+    """
+    Declare that a query transformer's result depends only on the trial curation key/value it is called with, its
+    trial key settings, and today's date, so that it may be memoized (see QueryTransformerMemo).
+    Overrides the _cacheable default of the QueryTransformerContainer the transformer belongs to.
+    """
+    method.cacheable = True
+    return method
+
+
+def not_cacheable(method: Callable) -> Callable:
+    """
+    Declare that a query transformer's result depends on anything else (e.g. the parent_path of the match clause),
+    so that it is always called.
+    """
+    method.cacheable = False
+    return method
+
+
 def attach_transformers_to_match_criteria_transform(match_criteria_transform: MatchCriteriaTransform,
                                                     query_transformer_container: Type[QueryTransformerContainer]):
     for attr in dir(query_transformer_container):
@@ -32,9 +59,73 @@ def attach_transformers_to_match_criteria_transform(match_criteria_transform: Ma
             setattr(match_criteria_transform.query_transformers,
                     attr,
                     MethodType(method, match_criteria_transform.query_transformers))
+            match_criteria_transform.cacheable_transformers[attr] = getattr(method,
+                                                                            'cacheable',
+                                                                            query_transformer_container._cacheable)
+
+
+class QueryTransformerMemo(object):
+    """
+    Results of cacheable query transformers, so that a trial curation key/value used by many match clauses (e.g. a
+    large oncotree mapping, or an age) is transformed once.
+
+    Results are keyed by the transformer, the trial path/key/value (and class of the value) it is called with, and
+    today's date (which age transformers compare against).  For a given config, the trial path and key also decide the
+    trial key settings passed to the transformer.  Query node transformers modify the query parts of a result, so each
+    call is given its own copy of the memoized result.
+    """
+    __slots__ = (
+        "results", "hits", "misses"
+    )
+
+    def __init__(self):
+        self.results: Dict[Tuple, QueryTransformerResult] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def transform(self,
+                  match_criteria_transform: MatchCriteriaTransform,
+                  sample_value_function_name: str,
+                  sample_function_args: Dict[str, Any]) -> QueryTransformerResult:
+        sample_function = getattr(match_criteria_transform.query_transformers, sample_value_function_name)
+        if not match_criteria_transform.cacheable_transformers.get(sample_value_function_name, False):
+            return sample_function(**sample_function_args)
+        # the class of the trial value is part of the key, as e.g. True, 1 and 1.0 are equal keys of a dict
+        trial_value = sample_function_args['trial_value']
+        key = (sample_value_function_name,
+               sample_function_args['trial_path'],
+               sample_function_args['trial_key'],
+               trial_value.__class__,
+               trial_value,
+               datetime.date.today())
+        try:
+            result = self.results.get(key, None)
+        except TypeError:
+            # trial values which can't be hashed (e.g. lists) aren't memoized
+            return sample_function(**sample_function_args)
+        if result is None:
+            self.misses += 1
+            result = sample_function(**sample_function_args)
+            if result is None:
+                return result
+            self.results[key] = result
+        else:
+            self.hits += 1
+        copied_result = QueryTransformerResult()
+        copied_result.results = [QueryPart(dict(query_part.query),
+                                           query_part.negate,
+                                           query_part.render,
+                                           query_part.mcq_invalidating)
+                                 for query_part in result.results]
+        return copied_result
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
 
 
 class BaseTransformers(QueryTransformerContainer):
+    @cacheable
     def age_range_to_date_query(self, **kwargs):
         sample_key = kwargs['sample_key']
         trial_value = kwargs['trial_value']
@@ -59,6 +150,7 @@ class BaseTransformers(QueryTransformerContainer):
         query_datetime = datetime.datetime(query_date.year, query_date.month, query_date.day, query_date.hour, 0, 0, 0)
         return QueryTransformerResult({sample_key: {operator_map[operator]: query_datetime}}, False)
 
+    @cacheable
     def age_range_to_date_int_query(self, **kwargs):
         sample_key = kwargs['sample_key']
         trial_value = kwargs['trial_value']
@@ -82,6 +174,7 @@ class BaseTransformers(QueryTransformerContainer):
         query_date = current_date + (- relativedelta(years=years, months=months))
         return QueryTransformerResult({sample_key: {operator_map[operator]: int(query_date.strftime('%Y%m%d'))}}, False)
 
+    @cacheable
     def nomap(self, **kwargs):
         trial_path = kwargs['trial_path']
         trial_key = kwargs['trial_key']
@@ -90,6 +183,7 @@ class BaseTransformers(QueryTransformerContainer):
         trial_value, negate = is_negate(trial_value)
         return QueryTransformerResult({sample_key: trial_value}, negate)
 
+    @cacheable
     def external_file_mapping(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
@@ -105,6 +199,7 @@ class BaseTransformers(QueryTransformerContainer):
         else:
             return QueryTransformerResult({sample_key: match_value}, negate)
 
+    @cacheable
     def to_upper(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
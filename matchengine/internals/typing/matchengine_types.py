@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import copy
 import datetime
+import sys
+from collections import deque
 from itertools import chain
 from typing import (
     NewType,
@@ -10,18 +13,19 @@ from typing import (
     List,
     Dict,
     Any,
-    Set
+    Set,
+    Iterable
 )
 
 from bson import ObjectId
-from networkx import DiGraph
 
+from matchengine.internals.utilities.clinical_id_set import ClinicalIDIndex, ClinicalIDSet
 from matchengine.internals.utilities.object_comparison import nested_object_hash
+from matchengine.internals.utilities.persistent_cache import PersistentQueryCache
 
 Trial = NewType("Trial", dict)
 ParentPath = NewType("ParentPath", Tuple[Union[str, int]])
 MatchClause = NewType("MatchClause", List[Dict[str, Any]])
-MatchTree = NewType("MatchTree", DiGraph)
 NodeID = NewType("NodeID", int)
 MatchClauseLevel = NewType("MatchClauseLevel", str)
 MongoQueryResult = NewType("MongoQueryResult", Dict[str, Any])
@@ -56,7 +60,7 @@ class IndexUpdateTask(object):
 class QueryTask(object):
     __slots__ = (
         "trial", "match_clause_data", "match_path",
-        "query", "clinical_ids"
+        "query", "clinical_ids", "path_prefixes"
     )
 
     def __init__(
@@ -65,8 +69,10 @@ class QueryTask(object):
             match_clause_data: MatchClauseData,
             match_path: MatchCriterion,
             query: MultiCollectionQuery,
-            clinical_ids: Set[ClinicalID]
+            clinical_ids: Set[ClinicalID],
+            path_prefixes: Dict[Tuple[int, Tuple[int, ...]], asyncio.Future] = None
     ):
+        self.path_prefixes = path_prefixes
         self.clinical_ids = clinical_ids
         self.query = query
         self.match_path = match_path
@@ -74,6 +80,29 @@ class QueryTask(object):
         self.trial = trial
 
 
+class MatchTreeTask(object):
+    __slots__ = (
+        "trial", "match_clause_data", "match_tree",
+        "node_queries", "path_queries", "clinical_ids"
+    )
+
+    def __init__(
+            self,
+            trial: Trial,
+            match_clause_data: MatchClauseData,
+            match_tree: MatchTree,
+            node_queries: Dict[Tuple[NodeID, int], MultiCollectionQuery],
+            path_queries: Dict[Tuple[NodeID, ...], Tuple[MatchCriterion, MultiCollectionQuery]],
+            clinical_ids: Set[ClinicalID]
+    ):
+        self.clinical_ids = clinical_ids
+        self.path_queries = path_queries
+        self.node_queries = node_queries
+        self.match_tree = match_tree
+        self.match_clause_data = match_clause_data
+        self.trial = trial
+
+
 class UpdateTask(object):
     __slots__ = (
         "ops", "protocol_no"
@@ -100,7 +129,8 @@ class RunLogUpdateTask(object):
         self.protocol_no = protocol_no
 
 
-Task = NewType("Task", Union[PoisonPill, CheckIndicesTask, IndexUpdateTask, QueryTask, UpdateTask, RunLogUpdateTask])
+Task = NewType("Task", Union[PoisonPill, CheckIndicesTask, IndexUpdateTask, QueryTask, MatchTreeTask, UpdateTask,
+                             RunLogUpdateTask])
 
 
 class MatchCriteria(object):
@@ -119,6 +149,94 @@ class MatchCriteria(object):
         self.node_id = node_id
 
 
+class MatchTree(object):
+    """
+    A match clause as a rooted (at node 0), directed acyclic graph, see match_translator.create_match_tree.
+    The attributes of each node are kept in a dict, and its children in a list, both in insertion order.
+    """
+    __slots__ = (
+        "nodes", "successors", "predecessors"
+    )
+
+    def __init__(self):
+        self.nodes: Dict[NodeID, Dict[str, Any]] = dict()
+        self.successors: Dict[NodeID, List[NodeID]] = dict()
+        self.predecessors: Dict[NodeID, List[NodeID]] = dict()
+
+    def add_node(self, node_id: NodeID):
+        if node_id not in self.nodes:
+            self.nodes[node_id] = dict()
+            self.successors[node_id] = list()
+            self.predecessors[node_id] = list()
+
+    def add_edge(self, parent_id: NodeID, child_id: NodeID):
+        self.add_node(parent_id)
+        self.add_node(child_id)
+        if child_id not in self.successors[parent_id]:
+            self.successors[parent_id].append(child_id)
+            self.predecessors[child_id].append(parent_id)
+
+    def descendants(self, node_id: NodeID) -> Set[NodeID]:
+        """
+        All nodes reachable from node_id, found breadth first
+        """
+        descendants = set()
+        queue = deque([node_id])
+        while queue:
+            for child_id in self.successors[queue.popleft()]:
+                if child_id not in descendants and child_id != node_id:
+                    descendants.add(child_id)
+                    queue.append(child_id)
+        return descendants
+
+    def depths(self) -> Dict[NodeID, List[int]]:
+        """
+        The depths (number of edges from the root) of every path from the root to each node, in increasing order
+        """
+        depths = {node_id: set() for node_id in self.nodes}
+        depths[0].add(0)
+        for node_id in self.topological_order():
+            for child_id in self.successors[node_id]:
+                depths[child_id].update(depth + 1 for depth in depths[node_id])
+        return {node_id: sorted(node_depths) for node_id, node_depths in depths.items()}
+
+    def topological_order(self) -> List[NodeID]:
+        """
+        All nodes, each after every one of its parents
+        """
+        in_degree = {node_id: len(parents) for node_id, parents in self.predecessors.items()}
+        order = [node_id for node_id, degree in in_degree.items() if not degree]
+        for node_id in order:
+            for child_id in self.successors[node_id]:
+                in_degree[child_id] -= 1
+                if not in_degree[child_id]:
+                    order.append(child_id)
+        return order
+
+    @property
+    def edges(self) -> List[Tuple[NodeID, NodeID]]:
+        return [(parent_id, child_id) for parent_id, children in self.successors.items() for child_id in children]
+
+    @property
+    def in_degree(self) -> List[Tuple[NodeID, int]]:
+        return [(node_id, len(parents)) for node_id, parents in self.predecessors.items()]
+
+    @property
+    def out_degree(self) -> List[Tuple[NodeID, int]]:
+        return [(node_id, len(children)) for node_id, children in self.successors.items()]
+
+    def to_networkx(self):
+        """
+        Convert to a networkx DiGraph, for drawing
+        """
+        import networkx as nx
+        graph = nx.DiGraph()
+        for node_id, attributes in self.nodes.items():
+            graph.add_node(node_id, **attributes)
+        graph.add_edges_from(self.edges)
+        return graph
+
+
 class MatchCriterion(object):
     __slots__ = (
         "criteria_list", "_hash"
@@ -450,17 +568,165 @@ class TrialMatch(object):
 
 
 class Cache(object):
+    """
+    Accumulates query results over a run.
+
+    For each query hash, the clinical IDs which have been queried, and those which matched, are kept as bitsets.
+    The id cache of a query hash only holds entries for matching clinical IDs, mapping them to the ID returned
+    from a clinical query, or the tuple of IDs returned from an extended attributes query.
+    """
     __slots__ = (
-        "docs", "ids", "in_process"
+        "docs", "ids", "in_process",
+        "clinical_id_index", "queried", "matched",
+        "in_flight", "statistics", "persistent"
     )
     docs: Dict
     ids: Dict
-    in_process: Dict
-
-    def __init__(self):
+    in_process: Dict[str, List[Tuple[ClinicalIDSet, asyncio.Future]]]
+    clinical_id_index: ClinicalIDIndex
+    queried: Dict[str, ClinicalIDSet]
+    matched: Dict[str, ClinicalIDSet]
+    in_flight: Dict[str, ClinicalIDSet]
+    statistics: Dict[str, List[int]]
+    persistent: Union[PersistentQueryCache, None]
+
+    def __init__(self, clinical_id_index: ClinicalIDIndex = None, persistent: PersistentQueryCache = None):
         self.docs = dict()
         self.ids = dict()
         self.in_process = dict()
+        self.clinical_id_index = ClinicalIDIndex() if clinical_id_index is None else clinical_id_index
+        # per query hash, the clinical IDs which have been queried, those of which returned results, and those
+        # currently being queried
+        self.queried = dict()
+        self.matched = dict()
+        self.in_flight = dict()
+        # per query hash, the number of clinical IDs queried and matched during this run
+        self.statistics = dict()
+        # query results of previous runs, loaded the first time a query is claimed
+        self.persistent = persistent
+
+    def claim(self,
+              query_hash: str,
+              clinical_ids: Iterable[ClinicalID]) -> Tuple[ClinicalIDSet,
+                                                           Union[asyncio.Future, None],
+                                                           Set[asyncio.Future]]:
+        """
+        Split clinical_ids into those which have not yet been queried for query_hash, and futures for those
+        which another worker is already fetching.
+
+        Clinical IDs which need to be queried are registered as in process under a new future, which the caller
+        must resolve with Cache.release once the query has finished (or failed).
+        """
+        if self.persistent is not None and query_hash not in self.queried:
+            self.load_persisted(query_hash)
+        self.ids.setdefault(query_hash, dict())
+        in_process = self.in_process.setdefault(query_hash, list())
+        empty_set = self.clinical_id_index.empty_set
+        queried = self.queried.setdefault(query_hash, empty_set())
+        self.matched.setdefault(query_hash, empty_set())
+        in_flight = self.in_flight.setdefault(query_hash, empty_set())
+
+        need_new = self.clinical_id_index.to_set(clinical_ids)
+        need_new -= queried
+        waiting_on = set()
+        if in_process and need_new & in_flight:
+            waiting_on = {in_process_future
+                          for in_process_ids, in_process_future in in_process
+                          if need_new & in_process_ids}
+            need_new -= in_flight
+
+        future = None
+        if need_new:
+            future = asyncio.get_event_loop().create_future()
+            # a failed query may have no waiters; retrieve the exception so it is not logged as unhandled
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            in_process.append((need_new.copy(), future))
+            in_flight |= need_new
+        return need_new, future, waiting_on
+
+    def release(self,
+                query_hash: str,
+                clinical_ids: ClinicalIDSet,
+                future: asyncio.Future,
+                exception: BaseException = None):
+        """
+        Mark clinical_ids as no longer in process for query_hash and wake all workers waiting on future.
+
+        If the query succeeded, clinical_ids are recorded as queried, and those with an entry in the id cache as
+        matched, so the same query is skipped for them in the future.
+        If the query failed, the exception is raised in the waiting workers, and the clinical IDs are left
+        unqueried so that a retried task will query them again.
+        """
+        in_process = self.in_process.get(query_hash, list())
+        in_process[:] = [claimed for claimed in in_process if claimed[1] is not future]
+        self.in_flight[query_hash] -= clinical_ids
+        if exception is None:
+            id_cache = self.ids[query_hash]
+            if len(id_cache) < len(clinical_ids):
+                matched = [clinical_id for clinical_id in id_cache if clinical_id in clinical_ids]
+            else:
+                matched = [clinical_id for clinical_id in clinical_ids if clinical_id in id_cache]
+            for clinical_id in matched:
+                # the returned IDs are no longer added to, so are kept as a tuple rather than a set
+                if id_cache[clinical_id].__class__ is set:
+                    id_cache[clinical_id] = tuple(id_cache[clinical_id])
+            self.queried[query_hash] |= clinical_ids
+            self.matched[query_hash] |= matched
+            statistics = self.statistics.setdefault(query_hash, [0, 0])
+            statistics[0] += len(clinical_ids)
+            statistics[1] += len(matched)
+            if self.persistent is not None:
+                self.persistent.record(query_hash, clinical_ids, {clinical_id: id_cache[clinical_id]
+                                                                  for clinical_id in matched})
+        if future.done():
+            return
+        if exception is None:
+            future.set_result(None)
+        elif exception.__class__ is asyncio.CancelledError:
+            future.cancel()
+        else:
+            future.set_exception(exception)
+
+    def load_persisted(self, query_hash: str):
+        """
+        Record the valid results of a query from previous runs as queried, so they aren't queried again
+        """
+        persisted = self.persistent.load(query_hash)
+        id_cache = self.ids.setdefault(query_hash, dict())
+        for clinical_id, result in persisted.items():
+            if result is not None:
+                id_cache[clinical_id] = tuple(result) if result.__class__ is set else result
+        self.queried[query_hash] = self.clinical_id_index.to_set(persisted)
+        self.matched[query_hash] = self.clinical_id_index.to_set(id_cache)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Approximate number of bytes held by each part of the cache (shared objects, such as the clinical IDs
+        used as keys, are not counted)
+        """
+        return {
+            "docs": sys.getsizeof(self.docs) + sum(map(sys.getsizeof, self.docs.values())),
+            "ids": sum(sys.getsizeof(id_cache) + sum(map(sys.getsizeof, id_cache.values()))
+                       for id_cache in self.ids.values()),
+            "queried": sum(clinical_ids.words.nbytes for clinical_ids in self.queried.values()),
+            "matched": sum(clinical_ids.words.nbytes for clinical_ids in self.matched.values()),
+            "in_flight": sum(clinical_ids.words.nbytes for clinical_ids in self.in_flight.values()),
+            "clinical_id_index": (sys.getsizeof(self.clinical_id_index.clinical_ids)
+                                  + sys.getsizeof(self.clinical_id_index.positions))
+        }
+
+    @staticmethod
+    async def wait_for(futures: Set[asyncio.Future]):
+        """
+        Wait until every query other workers are running for the needed clinical IDs has finished.
+        asyncio.wait is used rather than asyncio.gather, as gather would cancel the shared futures
+        if the waiting task was cancelled.
+        """
+        if not futures:
+            return
+        done, _ = await asyncio.wait(futures)
+        for future in done:
+            future.result()
 
 
 class Secrets(object):
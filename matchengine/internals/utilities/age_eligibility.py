@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import datetime
+from numbers import Real
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import (
+        Callable,
+        Dict,
+        FrozenSet,
+        Iterable,
+        List,
+        Set,
+        Tuple
+    )
+    from matchengine.internals.typing.matchengine_types import (
+        ClinicalID,
+        QueryTransformerResult
+    )
+
+COMPARISON_OPERATORS = {
+    '$lte': np.less_equal,
+    '$gte': np.greater_equal,
+    '$eq': np.equal,
+    '$lt': np.less,
+    '$gt': np.greater
+}
+
+
+class BirthDateIndex(object):
+    """
+    The BIRTH_DATE_INT of every clinical document in a NumPy array, to find the patients whose eligibility for the age
+    criteria of a trial changed between a previous run and this one (see MatchEngine.get_newly_qualifying_patients)
+    with one comparison per age criterion, rather than one transformer call per patient.
+
+    Patients without a numeric BIRTH_DATE_INT can't be compared to an age threshold, so are never considered to have
+    aged in or out of a trial.
+    """
+    __slots__ = (
+        "clinical_ids", "birth_dates", "age_range_to_date_query",
+        "_thresholds", "_changed"
+    )
+
+    def __init__(self,
+                 clinical_birth_dates: Dict[ClinicalID, int],
+                 age_range_to_date_query: Callable[..., QueryTransformerResult]):
+        dated = [(clinical_id, birth_date)
+                 for clinical_id, birth_date in clinical_birth_dates.items()
+                 if isinstance(birth_date, Real) and birth_date.__class__ is not bool]
+        self.clinical_ids: List[ClinicalID] = [clinical_id for clinical_id, _ in dated]
+        # BIRTH_DATE_INT values (YYYYMMDD) are exact as float64
+        self.birth_dates = np.fromiter((birth_date for _, birth_date in dated), dtype=np.float64, count=len(dated))
+        self.age_range_to_date_query = age_range_to_date_query
+        self._thresholds: Dict[Tuple[str, datetime.datetime], List[Tuple[str, int]]] = dict()
+        self._changed: Dict[Tuple[FrozenSet[str], datetime.datetime, datetime.datetime], Set[ClinicalID]] = dict()
+
+    def thresholds(self, age_criteria: str, compare_date: datetime.datetime) -> List[Tuple[str, int]]:
+        """
+        The (operator, BIRTH_DATE_INT) comparisons an age criterion translates to on a given date
+        """
+        key = (age_criteria, compare_date)
+        if key not in self._thresholds:
+            self._thresholds[key] = [(operator, value)
+                                     for query_part in self.age_range_to_date_query(sample_key=None,
+                                                                                    trial_value=age_criteria,
+                                                                                    compare_date=compare_date).results
+                                     for criteria in query_part.query.values()
+                                     for operator, value in criteria.items()]
+        return self._thresholds[key]
+
+    def changed_eligibility(self,
+                            age_criterion: Iterable[str],
+                            then: datetime.datetime,
+                            now: datetime.datetime) -> Set[ClinicalID]:
+        """
+        Clinical IDs which qualified for any of the age criteria on one date, but not the other
+        """
+        key = (frozenset(age_criterion), then, now)
+        if key not in self._changed:
+            changed = np.zeros(len(self.clinical_ids), dtype=bool)
+            for age_criteria in key[0]:
+                for (operator, then_value), (_, now_value) in zip(self.thresholds(age_criteria, then),
+                                                                  self.thresholds(age_criteria, now)):
+                    compare = COMPARISON_OPERATORS[operator]
+                    changed |= compare(self.birth_dates, then_value) != compare(self.birth_dates, now_value)
+            self._changed[key] = {self.clinical_ids[position] for position in np.flatnonzero(changed)}
+        return self._changed[key]
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import (
+        Dict,
+        Iterable,
+        Iterator,
+        List,
+        Union
+    )
+    from matchengine.internals.typing.matchengine_types import ClinicalID
+
+WORD_BITS = 64
+# explicitly little endian, so that unpacking the bytes of the words yields positions in order
+WORD_DTYPE = np.dtype('<u8')
+
+
+class ClinicalIDIndex(object):
+    """
+    A mapping between clinical IDs and dense integer positions, shared by every ClinicalIDSet of a run.
+    Clinical IDs are given the next free position the first time they are seen.
+    """
+    __slots__ = (
+        "clinical_ids", "positions"
+    )
+
+    def __init__(self, clinical_ids: Iterable[ClinicalID] = tuple()):
+        self.clinical_ids: List[ClinicalID] = list()
+        self.positions: Dict[ClinicalID, int] = dict()
+        for clinical_id in clinical_ids:
+            self.position(clinical_id)
+
+    def __len__(self):
+        return len(self.clinical_ids)
+
+    def position(self, clinical_id: ClinicalID) -> int:
+        position = self.positions.get(clinical_id, None)
+        if position is None:
+            position = self.positions[clinical_id] = len(self.clinical_ids)
+            self.clinical_ids.append(clinical_id)
+        return position
+
+    def empty_set(self) -> ClinicalIDSet:
+        return ClinicalIDSet(self, np.zeros(0, dtype=WORD_DTYPE))
+
+    def to_set(self, clinical_ids: Iterable[ClinicalID]) -> ClinicalIDSet:
+        """
+        Return a new ClinicalIDSet holding clinical_ids
+        """
+        if clinical_ids.__class__ is ClinicalIDSet and clinical_ids.index is self:
+            return clinical_ids.copy()
+        positions = np.fromiter((self.position(clinical_id) for clinical_id in clinical_ids), dtype=np.int64)
+        return ClinicalIDSet.from_positions(self, positions)
+
+
+class ClinicalIDSet(object):
+    """
+    A set of clinical IDs, stored as a bitset over the positions of a ClinicalIDIndex, so that set algebra
+    between sets of the same index is done with vectorized word operations.
+
+    Iterating yields clinical IDs (in position order), so a ClinicalIDSet can be passed anywhere an iterable of
+    clinical IDs is expected.
+    """
+    __slots__ = (
+        "index", "words"
+    )
+    __hash__ = None
+
+    def __init__(self, index: ClinicalIDIndex, words: np.ndarray):
+        self.index = index
+        self.words = words
+
+    @classmethod
+    def from_positions(cls, index: ClinicalIDIndex, positions: np.ndarray) -> ClinicalIDSet:
+        words = np.zeros(-(-len(index) // WORD_BITS), dtype=WORD_DTYPE)
+        if len(positions):
+            np.bitwise_or.at(words,
+                             positions // WORD_BITS,
+                             np.left_shift(np.uint64(1), (positions % WORD_BITS).astype(np.uint64)))
+        return cls(index, words)
+
+    def positions(self) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(self.words.view(np.uint8), bitorder='little'))
+
+    def copy(self) -> ClinicalIDSet:
+        return ClinicalIDSet(self.index, self.words.copy())
+
+    def _aligned(self, other: Union[ClinicalIDSet, Iterable[ClinicalID]]) -> np.ndarray:
+        """
+        Return the words of other, padded to the length of these words.  These words are padded in place if other
+        has more words, which may be the case if the index has grown since this set was created.
+        """
+        if other.__class__ is not ClinicalIDSet or other.index is not self.index:
+            other = self.index.to_set(other)
+        other_words = other.words
+        if len(other_words) > len(self.words):
+            self.words = np.concatenate([self.words,
+                                         np.zeros(len(other_words) - len(self.words), dtype=WORD_DTYPE)])
+        elif len(other_words) < len(self.words):
+            other_words = np.concatenate([other_words,
+                                          np.zeros(len(self.words) - len(other_words), dtype=WORD_DTYPE)])
+        return other_words
+
+    def __iand__(self, other):
+        other_words = self._aligned(other)
+        np.bitwise_and(self.words, other_words, out=self.words)
+        return self
+
+    def __ior__(self, other):
+        other_words = self._aligned(other)
+        np.bitwise_or(self.words, other_words, out=self.words)
+        return self
+
+    def __isub__(self, other):
+        other_words = self._aligned(other)
+        np.bitwise_and(self.words, np.invert(other_words), out=self.words)
+        return self
+
+    def __and__(self, other):
+        result = self.copy()
+        result &= other
+        return result
+
+    def __or__(self, other):
+        result = self.copy()
+        result |= other
+        return result
+
+    def __sub__(self, other):
+        result = self.copy()
+        result -= other
+        return result
+
+    def __len__(self):
+        return int(np.unpackbits(self.words.view(np.uint8)).sum())
+
+    def __bool__(self):
+        return bool(self.words.any())
+
+    def __contains__(self, clinical_id: ClinicalID):
+        position = self.index.positions.get(clinical_id, None)
+        if position is None or position // WORD_BITS >= len(self.words):
+            return False
+        return bool((int(self.words[position // WORD_BITS]) >> (position % WORD_BITS)) & 1)
+
+    def __iter__(self) -> Iterator[ClinicalID]:
+        clinical_ids = self.index.clinical_ids
+        return (clinical_ids[position] for position in self.positions().tolist())
+
+    def __eq__(self, other):
+        if other.__class__ is ClinicalIDSet and other.index is self.index:
+            difference = self.copy()
+            other_words = difference._aligned(other)
+            return not np.bitwise_xor(difference.words, other_words).any()
+        elif isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(clinical_id in self for clinical_id in other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ClinicalIDSet({set(self)})"
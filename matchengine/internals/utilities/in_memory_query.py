@@ -0,0 +1,446 @@
+from __future__ import annotations
+
+import datetime
+import re
+from collections import defaultdict
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from matchengine.internals.utilities.clinical_id_set import ClinicalIDSet
+
+if TYPE_CHECKING:
+    from typing import (
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Union
+    )
+    from bson import ObjectId
+    from matchengine.internals.utilities.clinical_id_set import ClinicalIDIndex
+    from matchengine.internals.typing.matchengine_types import (
+        ClinicalID,
+        MongoQuery
+    )
+
+    Predicate = Callable[[np.ndarray], np.ndarray]
+    RowsGetter = Callable[[], np.ndarray]
+
+RANGE_OPERATORS = {
+    '$gt': np.greater,
+    '$gte': np.greater_equal,
+    '$lt': np.less,
+    '$lte': np.less_equal
+}
+
+# integers beyond this can't be represented exactly in a float64 column
+MAX_EXACT_FLOAT_INT = 2 ** 53
+
+REGEX_OPTIONS = {
+    'i': re.IGNORECASE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'x': re.VERBOSE
+}
+
+
+def value_key(value):
+    """
+    Key a scalar field or query value so that two keys are equal if and only if mongo considers the values equal,
+    e.g. 1 and 1.0 share a key, but True and 1 do not.
+
+    Returns None for values whose mongo equality semantics are not reproduced here (arrays, embedded documents,
+    regular expressions, NaN, ...).
+    """
+    value_class = value.__class__
+    if value is None:
+        return 0, None
+    elif value_class is bool:
+        return 1, value
+    elif isinstance(value, (int, float)):
+        # NaN is not equal to itself
+        return (2, value) if value == value else None
+    elif value_class is str:
+        return 3, value
+    elif isinstance(value, datetime.datetime):
+        return 4, value
+    return None
+
+
+def all_of(predicates: List[Predicate]) -> Predicate:
+    def predicate(positions: np.ndarray) -> np.ndarray:
+        mask = np.ones(len(positions), dtype=bool)
+        for sub_predicate in predicates:
+            mask &= sub_predicate(positions)
+        return mask
+
+    return predicate
+
+
+def any_of(predicates: List[Predicate]) -> Predicate:
+    def predicate(positions: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(positions), dtype=bool)
+        for sub_predicate in predicates:
+            mask |= sub_predicate(positions)
+        return mask
+
+    return predicate
+
+
+def negation_of(sub_predicate: Predicate) -> Predicate:
+    def predicate(positions: np.ndarray) -> np.ndarray:
+        return ~sub_predicate(positions)
+
+    return predicate
+
+
+class ClinicalColumn(object):
+    """
+    A single clinical field, stored as dictionary-encoded value codes (for equality) alongside a float column
+    (for range comparisons), where non-numeric values are NaN and so never satisfy a comparison.
+
+    Missing fields are encoded as None, as mongo matches missing fields on {field: None}.
+    """
+    __slots__ = (
+        "codes", "code_lookup", "numeric", "supported"
+    )
+
+    def __init__(self, values: List):
+        self.code_lookup = dict()
+        self.codes = np.empty(len(values), dtype=np.int32)
+        self.numeric = np.full(len(values), np.nan, dtype=np.float64)
+        self.supported = True
+        for idx, value in enumerate(values):
+            key = value_key(value)
+            if key is None or (key[0] == 2 and abs(value) > MAX_EXACT_FLOAT_INT):
+                # leave any query on this field to the database
+                self.supported = False
+                return
+            if key[0] == 2:
+                self.numeric[idx] = value
+            self.codes[idx] = self.code_lookup.setdefault(key, len(self.code_lookup))
+
+    def equals_any(self, values: List) -> Union[Predicate, None]:
+        keys = [value_key(value) for value in values]
+        if any(key is None for key in keys):
+            return None
+        codes = np.array([self.code_lookup[key] for key in keys if key in self.code_lookup], dtype=np.int32)
+
+        def predicate(positions: np.ndarray) -> np.ndarray:
+            return np.isin(self.codes[positions], codes)
+
+        return predicate
+
+    def compare(self, operator: str, operand) -> Union[Predicate, None]:
+        # only numeric comparisons are supported; mongo only compares values of the same type
+        if (operand.__class__ is bool
+                or not isinstance(operand, (int, float))
+                or operand != operand
+                or abs(operand) > MAX_EXACT_FLOAT_INT):
+            return None
+        compare = RANGE_OPERATORS[operator]
+
+        def predicate(positions: np.ndarray) -> np.ndarray:
+            return compare(self.numeric[positions], operand)
+
+        return predicate
+
+
+class InMemoryClinicalEvaluator(object):
+    """
+    Evaluates clinical queries against clinical documents already loaded into memory, rather than sending them to
+    the database.  Like the clinical _updated mapping used by the run log, this reflects the clinical documents as
+    they were when the MatchEngine was instantiated.
+
+    Rows are the positions of the clinical IDs in the run's ClinicalIDIndex, so sets of clinical IDs are evaluated
+    without looking up each clinical ID.  Queries are compiled into predicates over these positions once per query
+    hash.  Queries using anything other than implicit/explicit $and, $or, $eq, $ne, $in, $nin and numeric
+    $gt/$gte/$lt/$lte on loaded fields compile to None, and should be sent to the database instead.
+    """
+    __slots__ = (
+        "clinical_ids", "columns", "_predicates"
+    )
+
+    def __init__(self,
+                 clinical_id_index: ClinicalIDIndex,
+                 clinical_data: Dict[ClinicalID, Dict],
+                 fields: Iterable[str]):
+        self.clinical_ids = clinical_id_index.to_set(clinical_data.keys())
+        docs = [clinical_data.get(clinical_id, dict()) for clinical_id in clinical_id_index.clinical_ids]
+        self.columns = dict()
+        for field in fields:
+            column = ClinicalColumn([doc.get(field, None) for doc in docs])
+            if column.supported:
+                self.columns[field] = column
+        self._predicates: Dict[str, Union[Predicate, None]] = dict()
+
+    def supports(self, query_hash: str, query: MongoQuery) -> bool:
+        if query_hash not in self._predicates:
+            self._predicates[query_hash] = self._compile(query)
+        return self._predicates[query_hash] is not None
+
+    def evaluate(self, query_hash: str, query: MongoQuery, clinical_ids: ClinicalIDSet) -> ClinicalIDSet:
+        """
+        Return the subset of clinical_ids whose documents match query.  The query must be supported, and
+        clinical_ids must be a subset of the clinical IDs loaded into the evaluator.
+        """
+        if not self.supports(query_hash, query):
+            raise ValueError(f"Query can't be evaluated in memory: {query}")
+        positions = clinical_ids.positions()
+        return ClinicalIDSet.from_positions(clinical_ids.index, positions[self._predicates[query_hash](positions)])
+
+    def _compile(self, query: MongoQuery) -> Union[Predicate, None]:
+        if query.__class__ is not dict:
+            return None
+        predicates = list()
+        for key, value in query.items():
+            if key in {'$and', '$or'}:
+                if value.__class__ is not list or not value:
+                    return None
+                sub_predicates = [self._compile(sub_query) for sub_query in value]
+                if any(sub_predicate is None for sub_predicate in sub_predicates):
+                    return None
+                predicates.append(all_of(sub_predicates) if key == '$and' else any_of(sub_predicates))
+            elif key in self.columns:
+                predicate = self._compile_field(self.columns[key], value)
+                if predicate is None:
+                    return None
+                predicates.append(predicate)
+            else:
+                return None
+        return all_of(predicates)
+
+    @staticmethod
+    def _compile_field(column: ClinicalColumn, value) -> Union[Predicate, None]:
+        if value.__class__ is not dict:
+            return column.equals_any([value])
+
+        # a dict without operators is an exact embedded document match
+        if not value or not all(operator.startswith('$') for operator in value):
+            return None
+        predicates = list()
+        for operator, operand in value.items():
+            if operator in {'$eq', '$ne'}:
+                predicate = column.equals_any([operand])
+            elif operator in {'$in', '$nin'}:
+                predicate = column.equals_any(operand) if operand.__class__ is list else None
+            elif operator in RANGE_OPERATORS:
+                predicate = column.compare(operator, operand)
+            else:
+                predicate = None
+            if predicate is None:
+                return None
+            predicates.append(negation_of(predicate) if operator in {'$ne', '$nin'} else predicate)
+        return all_of(predicates)
+
+
+def union_of(rows_getters: List[RowsGetter]) -> RowsGetter:
+    def rows_getter() -> np.ndarray:
+        all_rows = [get_rows() for get_rows in rows_getters]
+        return np.unique(np.concatenate(all_rows)) if all_rows else np.empty(0, dtype=np.int32)
+
+    return rows_getter
+
+
+def intersection_of(rows_getters: List[RowsGetter], row_count: int) -> RowsGetter:
+    def rows_getter() -> np.ndarray:
+        if not rows_getters:
+            return np.arange(row_count, dtype=np.int32)
+        # intersect the smallest posting lists first, so empty results are found as early as possible
+        all_rows = sorted((get_rows() for get_rows in rows_getters), key=len)
+        rows = all_rows[0]
+        for other_rows in all_rows[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, other_rows, assume_unique=True)
+        return rows
+
+    return rows_getter
+
+
+def complement_of(sub_rows_getter: RowsGetter, row_count: int) -> RowsGetter:
+    def rows_getter() -> np.ndarray:
+        return np.setdiff1d(np.arange(row_count, dtype=np.int32), sub_rows_getter(), assume_unique=True)
+
+    return rows_getter
+
+
+class ExtendedAttributeIndex(object):
+    """
+    An inverted index over the documents of an extended attributes collection (e.g. genomic), built once per run.
+
+    For every indexed field, each distinct value maps to the sorted rows of the documents which have that value
+    (missing fields are indexed under None).  Queries are answered by intersecting and unioning these posting
+    lists; regular expressions and numeric ranges are evaluated over the distinct values of a field rather than
+    over every document.
+
+    Queries which can't be answered from the index (unindexed fields, array valued fields, unsupported operators)
+    compile to None, and should be sent to the database instead.
+    """
+    __slots__ = (
+        "clinical_id_index", "query_level", "join_field",
+        "id_field", "postings", "row_count",
+        "row_clinical_positions", "row_doc_ids", "_queries"
+    )
+
+    def __init__(self,
+                 clinical_id_index: ClinicalIDIndex,
+                 query_level: str,
+                 join_field: str,
+                 id_field: str,
+                 fields: Iterable[str],
+                 docs: Iterable[Dict]):
+        self.clinical_id_index = clinical_id_index
+        self.query_level = query_level
+        self.join_field = join_field
+        self.id_field = id_field
+        self.row_doc_ids: List[ObjectId] = list()
+        row_clinical_positions = list()
+        postings = {field: defaultdict(list) for field in fields}
+        unsupported = set()
+        row = 0
+        for doc in docs:
+            clinical_id = doc.get(join_field, None)
+            if clinical_id is None:
+                continue
+            row_clinical_positions.append(clinical_id_index.position(clinical_id))
+            self.row_doc_ids.append(doc[id_field])
+            for field, field_postings in postings.items():
+                key = value_key(doc.get(field, None))
+                if key is None:
+                    unsupported.add(field)
+                else:
+                    field_postings[key].append(row)
+            row += 1
+        self.row_count = row
+        self.row_clinical_positions = np.array(row_clinical_positions, dtype=np.int64)
+        self.postings = {
+            field: {key: np.array(rows, dtype=np.int32) for key, rows in field_postings.items()}
+            for field, field_postings in postings.items()
+            if field not in unsupported
+        }
+        self._queries: Dict[str, Union[RowsGetter, None]] = dict()
+
+    def find(self,
+             query_hash: str,
+             query: MongoQuery,
+             clinical_ids: ClinicalIDSet) -> Union[List[Dict], None]:
+        """
+        Return the documents matching query for the given clinical IDs, projected to the join and id fields, as
+        the equivalent database query would.  Returns None if the query can't be answered from the index.
+        """
+        if query_hash not in self._queries:
+            self._queries[query_hash] = self._compile(query)
+        rows_getter = self._queries[query_hash]
+        if rows_getter is None:
+            return None
+        rows = rows_getter()
+        row_clinical_positions = self.row_clinical_positions[rows]
+        wanted = np.unpackbits(clinical_ids.words.view(np.uint8), bitorder='little').view(bool)
+        in_range = row_clinical_positions < len(wanted)
+        rows = rows[in_range][wanted[row_clinical_positions[in_range]]]
+        clinical_id_list = self.clinical_id_index.clinical_ids
+        return [
+            {self.join_field: clinical_id_list[self.row_clinical_positions[row]], self.id_field: self.row_doc_ids[row]}
+            for row in rows.tolist()
+        ]
+
+    def _compile(self, query: MongoQuery) -> Union[RowsGetter, None]:
+        if query.__class__ is not dict:
+            return None
+        rows_getters = list()
+        for key, value in query.items():
+            if key in {'$and', '$or'}:
+                if value.__class__ is not list or not value:
+                    return None
+                sub_rows_getters = [self._compile(sub_query) for sub_query in value]
+                if any(sub_rows_getter is None for sub_rows_getter in sub_rows_getters):
+                    return None
+                rows_getters.append(intersection_of(sub_rows_getters, self.row_count)
+                                    if key == '$and'
+                                    else union_of(sub_rows_getters))
+            elif key in self.postings:
+                rows_getter = self._compile_field(self.postings[key], value)
+                if rows_getter is None:
+                    return None
+                rows_getters.append(rows_getter)
+            else:
+                return None
+        return intersection_of(rows_getters, self.row_count)
+
+    def _compile_field(self, field_postings: Dict, value) -> Union[RowsGetter, None]:
+        if value.__class__ is re.Pattern:
+            return self._postings_union(field_postings, self._matching_keys(field_postings, value))
+        elif value.__class__ is not dict:
+            return self._postings_union(field_postings, self._equal_keys([value]))
+
+        # a dict without operators is an exact embedded document match
+        if not value or not all(operator.startswith('$') for operator in value):
+            return None
+        rows_getters = list()
+        for operator, operand in value.items():
+            if operator in {'$eq', '$ne'}:
+                keys = self._equal_keys([operand])
+            elif operator in {'$in', '$nin'}:
+                keys = self._equal_keys(operand) if operand.__class__ is list else None
+            elif operator in RANGE_OPERATORS:
+                keys = self._keys_in_range(field_postings, operator, operand)
+            elif operator == '$regex':
+                pattern = self._regex(operand, value.get('$options', str()))
+                keys = self._matching_keys(field_postings, pattern) if pattern is not None else None
+            elif operator == '$options' and '$regex' in value:
+                continue
+            else:
+                keys = None
+            if keys is None:
+                return None
+            rows_getter = self._postings_union(field_postings, keys)
+            rows_getters.append(complement_of(rows_getter, self.row_count)
+                                if operator in {'$ne', '$nin'}
+                                else rows_getter)
+        return intersection_of(rows_getters, self.row_count)
+
+    @staticmethod
+    def _postings_union(field_postings: Dict, keys: Union[List, None]) -> Union[RowsGetter, None]:
+        if keys is None:
+            return None
+        postings = [field_postings[key] for key in keys if key in field_postings]
+        if len(postings) == 1:
+            rows = postings[0]
+            return lambda: rows
+        return union_of([lambda rows=rows: rows for rows in postings])
+
+    @staticmethod
+    def _equal_keys(values: List) -> Union[List, None]:
+        keys = [value_key(value) for value in values]
+        return None if any(key is None for key in keys) else keys
+
+    @staticmethod
+    def _keys_in_range(field_postings: Dict, operator: str, operand) -> Union[List, None]:
+        # only numeric comparisons are supported; mongo only compares values of the same type
+        if operand.__class__ is bool or not isinstance(operand, (int, float)) or operand != operand:
+            return None
+        compare = RANGE_OPERATORS[operator]
+        return [key for key in field_postings if key[0] == 2 and compare(key[1], operand)]
+
+    @staticmethod
+    def _regex(pattern, options: str):
+        if not all(option in REGEX_OPTIONS for option in options):
+            return None
+        flags = 0
+        for option in options:
+            flags |= REGEX_OPTIONS[option]
+        try:
+            if pattern.__class__ is re.Pattern:
+                return re.compile(pattern.pattern, pattern.flags | flags) if flags else pattern
+            elif pattern.__class__ is str:
+                return re.compile(pattern, flags)
+        except re.error:
+            pass
+        return None
+
+    @staticmethod
+    def _matching_keys(field_postings: Dict, pattern: re.Pattern) -> List:
+        # regular expressions only match string values
+        return [key for key in field_postings if key[0] == 3 and pattern.search(key[1])]
@@ -0,0 +1,110 @@
+"""
+Hashes of trial_match documents composed from precomputed digests of their sections.
+
+Most of a trial_match document is copied from the trial (the same for every match of the trial) and the clinical
+document (the same for every match of the patient); only a few fields are specific to a match reason.  Rather than
+hashing every document in full, the digest of each key/value of the trial and clinical sections is computed once, and
+reused for every document in which the value is the very same object.  The digests of the remaining (match reason)
+fields are memoized by value, as the same scalar values (gene names, match levels, flags, ...) recur across documents.
+
+The composite hash of a document is the sum (modulo 2**160) of the SHA1 digests of the canonical encodings of each of
+its key/value pairs, so it depends only on the content of the document, and not on which section a value came from,
+or on the order of keys.  The composite hash of a document is different from its nested_object_hash.
+
+Migrating existing trial_match documents
+----------------------------------------
+The hash of a trial_match document decides whether a match has changed since the previous run, so the first run with
+canonical hashes (--canonical-hashes), or with composite hashes (--canonical-hashes --compose-match-hashes), finds no
+existing match with the same hash as a new one.  Every current match of each trial run is inserted again, and every
+existing match disabled, once; from then on, matches are diffed as usual.  Query hashes change too, so the persistent
+query cache (--query-cache) and query statistics start over.  To migrate:
+
+1. optionally, drop existing matches (--drop) first, rather than keeping a disabled copy of each
+2. run with --canonical-hashes (and --compose-match-hashes, if wanted), and --force so that every patient is matched
+   again
+3. keep the same flags on every following run; switching back rewrites every match again
+
+Composite hashes need --canonical-hashes, as they don't reproduce the digests of previous versions.
+"""
+from __future__ import annotations
+
+import hashlib
+from typing import TYPE_CHECKING
+
+from matchengine.internals.utilities.object_comparison import canonical_encoding
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        Hashable,
+        Iterable,
+        Set,
+        Tuple
+    )
+
+DIGEST_MODULUS = 2 ** 160
+
+# digests of key/value pairs with scalar values, keyed by (key, class of the value, value), as e.g. 1, 1.0 and True are
+# equal keys of a dict.  Cleared once it holds MEMO_SIZE digests, to bound memory use.
+MEMO_SIZE = 2 ** 16
+_memoized_classes = {str, int, float, bool, type(None)}
+_member_digest_memo: Dict[Tuple[Hashable, type, Any], int] = dict()
+
+_missing = object()
+
+
+def member_digest(key: Hashable, value: Any) -> int:
+    """
+    The digest of a single key/value pair of a trial_match document
+    """
+    return int.from_bytes(hashlib.sha1((canonical_encoding(key) + canonical_encoding(value)).encode(
+        'utf-8',
+        'surrogatepass')).digest(), 'big')
+
+
+class PartialDigest(object):
+    """
+    A section of trial_match documents (e.g. the fields of a trial, or of a clinical document), with the digests of its
+    key/value pairs, computed the first time each is used.
+
+    Values are recognised by identity, so sections must not be modified in place once their digests are in use; like
+    the trial_match documents themselves, which share these values, rather than copying them.
+    """
+    __slots__ = (
+        "values", "digests"
+    )
+
+    def __init__(self, values: Dict):
+        self.values = values
+        self.digests: Dict[Hashable, int] = dict()
+
+
+def composite_match_hash(document: Dict, partial_digests: Iterable[PartialDigest], exclude: Set[str]) -> str:
+    """
+    The composite hash of a trial_match document (without its exclude keys), reusing the digests of its sections
+    """
+    sections = [(partial_digest.values, partial_digest.digests) for partial_digest in partial_digests]
+    total = 0
+    for key, value in document.items():
+        if key in exclude:
+            continue
+        for values, digests in sections:
+            if values.get(key, _missing) is value:
+                digest = digests.get(key, None)
+                if digest is None:
+                    digest = digests[key] = member_digest(key, value)
+                break
+        else:
+            value_class = value.__class__
+            if value_class in _memoized_classes:
+                memo_key = (key, value_class, value)
+                digest = _member_digest_memo.get(memo_key, None)
+                if digest is None:
+                    if len(_member_digest_memo) >= MEMO_SIZE:
+                        _member_digest_memo.clear()
+                    digest = _member_digest_memo[memo_key] = member_digest(key, value)
+            else:
+                digest = member_digest(key, value)
+        total += digest
+    return '%040x' % (total % DIGEST_MODULUS)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from matchengine.internals.utilities.object_comparison import nested_object_hash
+
+if TYPE_CHECKING:
+    from typing import (
+        Dict,
+        Tuple
+    )
+    from matchengine.internals.typing.matchengine_types import (
+        MatchClauseData,
+        MatchCriterion,
+        ParentPath,
+        Trial
+    )
+
+# trial fields which aren't copied to trial_match documents
+TRIAL_EXTRAS = {'treatment_list', '_summary', 'status', '_elasticsearch', 'match'}
+
+# fields removed from trial_match documents, wherever they were copied from
+EXCLUDED_FIELDS = {'_updated', 'last_updated', '_id'}
+
+
+def clinical_match_fields(clinical_doc: Dict, clinical_fields: Dict) -> Dict:
+    """
+    The fields of trial_match documents copied from a clinical document, given its fields as formatted by
+    MatchEngine.format_trial_match_k_v
+    """
+    clinical_fields = {k: v for k, v in clinical_fields.items() if k not in EXCLUDED_FIELDS}
+    clinical_fields['clinical_id'] = clinical_doc['_id']
+    return clinical_fields
+
+
+class TrialMatchTemplate(object):
+    """
+    The fields of trial_match documents shared by every match of a trial, and by every match of each match path of the
+    trial, computed once rather than for every trial_match document (see MatchEngine.pre_process_trial_matches).
+
+    trial_match documents are built by merging these fields, so the same values are shared by every document; fields
+    must not be modified in place.
+    """
+    __slots__ = (
+        "trial", "trial_identifier", "trial_fields",
+        "path_fields"
+    )
+
+    def __init__(self, trial: Trial, trial_identifier: str):
+        self.trial = trial
+        self.trial_identifier = trial_identifier
+        self.trial_fields: Dict = {k: v
+                                   for k, v in trial.items()
+                                   if k not in TRIAL_EXTRAS and k not in EXCLUDED_FIELDS}
+        self.path_fields: Dict[Tuple[ParentPath, str], Tuple[Dict, Dict]] = dict()
+
+    def get_path_fields(self,
+                        match_clause_data: MatchClauseData,
+                        match_criterion: MatchCriterion) -> Tuple[Dict, Dict]:
+        """
+        The fields of the match clause and match path of trial_match documents; the first are merged before the fields
+        of the match reason and trial, the second after them.
+        """
+        query_hash = match_criterion.hash()
+        key = (match_clause_data.parent_path, query_hash)
+        path_fields = self.path_fields.get(key, None)
+        if path_fields is None:
+            match_path = '.'.join([str(item) for item in match_clause_data.parent_path])
+            path_fields = self.path_fields[key] = (
+                {
+                    'match_level': match_clause_data.match_clause_level,
+                    'internal_id': match_clause_data.internal_id,
+                    'code': match_clause_data.code,
+                    'trial_curation_level_status': 'closed' if match_clause_data.is_suspended else 'open',
+                    'trial_summary_status': match_clause_data.status,
+                    'coordinating_center': match_clause_data.coordinating_center,
+                    'query_hash': query_hash
+                },
+                {
+                    'match_path': match_path,
+                    'combo_coord': nested_object_hash(
+                        {
+                            'query_hash': query_hash,
+                            'match_path': match_path,
+                            self.trial_identifier: self.trial_fields[self.trial_identifier]
+                        }),
+                    'is_disabled': False
+                }
+            )
+        return path_fields
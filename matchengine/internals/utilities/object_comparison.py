@@ -15,6 +15,32 @@ LEADING = sys.getsizeof(str()) - TRAILING
 # supported non-mutable classes
 k_iterover = {list, set}
 
+# NOTE: We cannot use a non-cryptographic hash as we do not want collisions - hashes are not used for cache eviction,
+# and collisions could be detrimental to matching.  However, cryptographically secure hashing is not necessary.  As
+# such, even though SHA1 should be considered 'broken' in a cryptographic sense, it is a valid use case here.  MD5 would
+# work as well, however even though it is even less secure, it takes longer on modern hardware, as modern CPUs have
+# SHA tooling.  If, for some reason in the future, malicious users start attaching SHA1-colliding PDFs to data, this can
+# be changed to SHA256...
+_hash_function = hashlib.sha1
+
+# whether nested_object_hash produces the digests of previous matchengine versions (the default) rather than those of
+# the canonical encoding, see set_legacy_hashing
+_legacy = True
+
+
+def set_legacy_hashing(legacy: bool) -> bool:
+    """
+    Switch nested_object_hash between the digests of previous matchengine versions (the default) and the canonical
+    encoding, returning the previous setting so that it can be restored.
+
+    Hashes are persisted (e.g. the hash of trial_match documents, which decides whether a match has changed since the
+    last run), so changing the encoding makes every existing trial_match document look changed on the next run.
+    Deployments switch to the canonical encoding once they are ready to rewrite them (see match_hash).
+    """
+    global _legacy
+    previous, _legacy = _legacy, legacy
+    return previous
+
 
 def nested_object_hash(item):
     """
@@ -25,6 +51,71 @@ def nested_object_hash(item):
     function), and values (e.g. dict values, list items, or set members) can be any object with a __hash__ function,
     or another of dict, list, or set.
 
+    The hash does not depend on the order of dict keys, or of list items.
+    """
+    if _legacy:
+        return legacy_nested_object_hash(item)
+    return canonical_digest(item).hex()
+
+
+def canonical_digest(item) -> bytes:
+    """
+    The digest of the canonical encoding of an object (see canonical_encoding).  For a dict, list or set, this is the
+    digest of its sorted encoded members, so that a nested object is hashed one level at a time, rather than as one
+    large string.
+    """
+    item_class = item.__class__
+    if item_class is dict:
+        members = sorted([canonical_encoding(k) + canonical_encoding(v) for k, v in item.items()])
+    elif item_class in k_iterover:
+        members = sorted([canonical_encoding(v) for v in item])
+    else:
+        members = [canonical_encoding(item)]
+    return _digest_members(members)
+
+
+def _digest_members(members) -> bytes:
+    # encoding as UTF-8 (rather than reading the underlying bytes of the string) is safe for any character
+    return _hash_function(''.join(members).encode('utf-8', 'surrogatepass')).digest()
+
+
+def canonical_encoding(item) -> str:
+    """
+    A deterministic, type tagged, self delimiting encoding of an object.
+
+    Scalars are tagged with their class, so that e.g. 1, 1.0, True and '1' are all different, and strings are prefixed
+    with their length.  dicts, lists and sets are encoded as the digest of their sorted members (see canonical_digest),
+    so that their encoding is short and doesn't depend on member order.  Tuples are encoded as the digest of their
+    members, in order.
+    """
+    item_class = item.__class__
+    if item_class is str:
+        return f's{len(item)}:{item}'
+    elif item_class is dict:
+        return f'd{canonical_digest(item).hex()}'
+    elif item_class in k_iterover:
+        return f'l{canonical_digest(item).hex()}'
+    elif item is None:
+        return 'n'
+    elif item_class is bool:
+        return 't' if item else 'f'
+    elif item_class is int:
+        return f'i{item};'
+    elif item_class is float:
+        return f'r{item!r};'
+    elif item_class is tuple:
+        return f'u{_digest_members([canonical_encoding(member) for member in item]).hex()}'
+    else:
+        # e.g. ObjectId, datetime, compiled regular expressions
+        name = item_class.__name__
+        value = item.__str__()
+        return f'o{len(name)}:{name}{len(value)}:{value}'
+
+
+def legacy_nested_object_hash(item):
+    """
+    nested_object_hash as implemented before the canonical encoding, to reproduce existing digests.
+
     NOTE: for performance reasons, as this function can easily be called 100,000s of times per run, the implementation
     does some funky things.
     As such, this will only (likely) work with cpython (the default implementation of the language).
@@ -63,23 +154,18 @@ def nested_object_hash(item):
     output.sort()
     out_str = output.__str__()
 
-    # For performance reasons, instead of creating a new bytes object to take the hash of, get a pointer to the
-    # underlying bytes.
+    # For an ASCII string, CPython stores one byte per character, so the underlying bytes are the ASCII encoding.
+    if out_str.isascii():
+        return _hash_function(out_str.encode('ascii')).hexdigest()
+
+    # Otherwise, previous versions hashed the underlying bytes of the string directly, which for a multi-byte string are
+    # not its characters (the leading bytes of such strings are longer, and the characters take more than one byte
+    # each).  The same bytes are read here, so that these digests are reproduced as well.
     # First, we get the memory address of the resulting output string (in CPython, the id() function returns the address
     # of the object in memory), and add to it the number of leading bytes of a python str object, to get the address of
     # the beginning of the string's contents.  We create a cast of a c_byte array of length string length, at the
-    # computed address, to get a reference representing to the underlying string bytes.  This is passed to
-    # hashlib.sha1 to get the hash, and the digest is returned.
-
-    # NOTE: We cannot use a non-cryptographic hash as we do not want collisions - this function is not used for
-    # cache eviction, and collisions could be detrimental to matching.  However, cryptographically secure hashing is not
-    # necessary.  As such, even though SHA1 should be considered 'broken' in a cryptographic sense, it is a valid use
-    # case here.  MD5 would work as well, however even though it is even less secure, it takes longer on modern
-    # hardware, as modern CPUs have AES tooling.  If, for some reason in the future, malicious users start attaching
-    # SHA1-colliding PDFs to data, this can be changed to SHA256...
-
-    # TODO: instead of using str.__len__(), find a solution that won't break on multi-byte characters...
-    return hashlib.sha1(
+    # computed address, to get a reference representing to the underlying string bytes.
+    return _hash_function(
         cast(
             id(out_str) + LEADING,
             POINTER(
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import concurrent.futures
+import multiprocessing
+from typing import TYPE_CHECKING
+
+from matchengine.internals.match_criteria_transform import MatchCriteriaTransform
+from matchengine.internals.query_transform import QueryTransformerMemo
+from matchengine.internals.utilities.object_comparison import set_legacy_hashing
+from matchengine.internals.utilities.utilities import find_plugins
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        List,
+        Set,
+        Tuple,
+        Union
+    )
+    from matchengine.internals.engine import MatchEngine
+    from matchengine.internals.typing.matchengine_types import Trial
+
+# the MatchEngine used to compile trials in a compilation worker process, see init_compiler
+_compiler: Union[MatchEngine, None] = None
+
+
+def init_compiler(settings: Dict[str, Any]):
+    """
+    Initializer of compilation worker processes.
+
+    Compiling a trial needs only the config, resources and plugins of a MatchEngine, so the worker process builds a
+    MatchEngine without calling __init__ (i.e. without any database connections or event loop), from the settings
+    returned by MatchEngine.get_compiler_settings, and loads the plugins into it.
+    """
+    global _compiler
+    from matchengine.internals.engine import MatchEngine
+    compiler = MatchEngine.__new__(MatchEngine)
+    for key, value in settings.items():
+        setattr(compiler, key, value)
+    set_legacy_hashing(not compiler.canonical_hashes)
+    compiler.match_criteria_transform = MatchCriteriaTransform(compiler.config, compiler.resource_dirs)
+    find_plugins(compiler)
+    if compiler.memoize_query_transformers:
+        compiler.match_criteria_transform.query_transformer_memo = QueryTransformerMemo()
+    _compiler = compiler
+
+
+def create_compile_pool(compile_workers: int, settings: Dict[str, Any]) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    A pool of compilation worker processes, initialized with init_compiler.
+
+    Workers are spawned rather than forked, so that they don't inherit the database connections (and their monitoring
+    threads) or the event loop of the MatchEngine; everything they need is in settings.
+    """
+    return concurrent.futures.ProcessPoolExecutor(compile_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=init_compiler,
+                                                  initargs=(settings,))
+
+
+def compile_trial(protocol_no: str, trial: Trial) -> Tuple[List[Tuple], Set[str]]:
+    """
+    Compile a trial in a compilation worker process. The trial itself is left out of the returned tasks, as the
+    parent process already has it.
+    """
+    _compiler.trials = {protocol_no: trial}
+    tasks, age_criteria = _compiler.compile_trial(protocol_no)
+    return [task[1:] for task in tasks], age_criteria
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import datetime
+import pickle
+import sqlite3
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        Iterable,
+        List,
+        Tuple
+    )
+    from matchengine.internals.typing.matchengine_types import ClinicalID
+
+# fixed, so that the pickled clinical IDs used as keys are the same across python versions
+PICKLE_PROTOCOL = 4
+
+# pending matches and queried clinical IDs are written once there are this many of them
+FLUSH_SIZE = 100000
+
+
+class PersistentQueryCache(object):
+    """
+    An on-disk (SQLite) copy of the id caches of previous runs, keyed by query hash and clinical ID.
+
+    Only matches are stored one row per clinical ID; the clinical IDs queried by a run are stored as one "queried"
+    marker per query hash and flush, so that the (far more numerous) clinical IDs which didn't match take no row of
+    their own.  The result of a clinical ID is the match cached by the last run which queried it, or None if that run
+    found no match.
+
+    A cached result is only used while the clinical document it was cached for has not been updated (according to
+    its _updated field) since the run which cached it started.  Clinical documents without an _updated field are
+    always queried again.
+    """
+    __slots__ = (
+        "path", "connection", "clinical_updated",
+        "cached_at", "pending_matches", "pending_queried",
+        "pending_size", "flush_size"
+    )
+
+    def __init__(self,
+                 path: str,
+                 clinical_updated: Dict[ClinicalID, datetime.datetime],
+                 cached_at: datetime.datetime,
+                 flush_size: int = FLUSH_SIZE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS query_matches ("
+                                "query_hash TEXT NOT NULL, "
+                                "clinical_id BLOB NOT NULL, "
+                                "result BLOB NOT NULL, "
+                                "cached_at TEXT NOT NULL, "
+                                "PRIMARY KEY (query_hash, clinical_id))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS query_queried ("
+                                "query_hash TEXT NOT NULL, "
+                                "clinical_ids BLOB NOT NULL, "
+                                "cached_at TEXT NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS query_queried_hash ON query_queried (query_hash)")
+        self.connection.commit()
+        self.clinical_updated = clinical_updated
+        self.cached_at = cached_at
+        self.flush_size = flush_size
+        self.pending_matches: List[Tuple[str, bytes, bytes, str]] = list()
+        self.pending_queried: Dict[str, List[ClinicalID]] = dict()
+        self.pending_size = 0
+
+    def load(self, query_hash: str) -> Dict[ClinicalID, Any]:
+        """
+        Return the valid cached results of a query, by clinical ID
+        """
+        # the last run which queried each clinical ID
+        last_queried: Dict[ClinicalID, str] = dict()
+        markers = self.connection.execute("SELECT clinical_ids, cached_at FROM query_queried WHERE query_hash = ?",
+                                          (query_hash,)).fetchall()
+        for pickled_clinical_ids, cached_at in markers:
+            for clinical_id in pickle.loads(pickled_clinical_ids):
+                if last_queried.get(clinical_id, str()) < cached_at:
+                    last_queried[clinical_id] = cached_at
+        matches = dict()
+        superseded = list()
+        rows = self.connection.execute("SELECT clinical_id, result, cached_at FROM query_matches WHERE query_hash = ?",
+                                       (query_hash,))
+        for pickled_clinical_id, pickled_result, cached_at in rows:
+            clinical_id = pickle.loads(pickled_clinical_id)
+            if last_queried.get(clinical_id, str()) > cached_at:
+                # queried again by a later run, which didn't match
+                superseded.append((query_hash, pickled_clinical_id))
+            else:
+                matches[clinical_id] = pickle.loads(pickled_result)
+        if len(markers) > 1 or superseded:
+            self._compact(query_hash, last_queried, superseded)
+
+        results = dict()
+        for clinical_id, cached_at in last_queried.items():
+            updated = self.clinical_updated.get(clinical_id, None)
+            if updated is not None and updated <= datetime.datetime.fromisoformat(cached_at):
+                results[clinical_id] = matches.get(clinical_id, None)
+        return results
+
+    def _compact(self, query_hash: str, last_queried: Dict[ClinicalID, str], superseded: List[Tuple[str, bytes]]):
+        """
+        Replace the queried markers of a query with one per run, holding the clinical IDs that run queried last, and
+        drop matches of clinical IDs queried again by a later run
+        """
+        by_run: Dict[str, List[ClinicalID]] = dict()
+        for clinical_id, cached_at in last_queried.items():
+            by_run.setdefault(cached_at, list()).append(clinical_id)
+        with self.connection:
+            self.connection.execute("DELETE FROM query_queried WHERE query_hash = ?", (query_hash,))
+            self.connection.executemany("INSERT INTO query_queried VALUES (?, ?, ?)",
+                                        [(query_hash, pickle.dumps(clinical_ids, protocol=PICKLE_PROTOCOL), cached_at)
+                                         for cached_at, clinical_ids in by_run.items()])
+            self.connection.executemany("DELETE FROM query_matches WHERE query_hash = ? AND clinical_id = ?",
+                                        superseded)
+
+    def record(self, query_hash: str, clinical_ids: Iterable[ClinicalID], matches: Dict[ClinicalID, Any]):
+        """
+        Queue the clinical IDs queried for a query, and the results of those which matched, to be written on the next
+        flush (which happens as soon as flush_size of them are pending)
+        """
+        cached_at = self.cached_at.isoformat()
+        queried = self.pending_queried.setdefault(query_hash, list())
+        queried_before = len(queried)
+        queried.extend(clinical_ids)
+        self.pending_matches.extend((query_hash,
+                                     pickle.dumps(clinical_id, protocol=PICKLE_PROTOCOL),
+                                     pickle.dumps(result, protocol=PICKLE_PROTOCOL),
+                                     cached_at)
+                                    for clinical_id, result in matches.items())
+        self.pending_size += len(queried) - queried_before + len(matches)
+        if self.pending_size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_size:
+            cached_at = self.cached_at.isoformat()
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO query_matches VALUES (?, ?, ?, ?)",
+                                            self.pending_matches)
+                self.connection.executemany("INSERT INTO query_queried VALUES (?, ?, ?)",
+                                            [(query_hash,
+                                              pickle.dumps(clinical_ids, protocol=PICKLE_PROTOCOL),
+                                              cached_at)
+                                             for query_hash, clinical_ids in self.pending_queried.items()])
+            self.pending_matches = list()
+            self.pending_queried = dict()
+            self.pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import datetime
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        Iterable,
+        List,
+        Set,
+        Tuple,
+        Union
+    )
+    from matchengine.internals.typing.matchengine_types import MatchClauseData
+
+
+class PlanCache(object):
+    """
+    Compiled match clauses (see MatchEngine.compile_match_clause), so that a match clause curated identically in
+    several trials is only compiled once.
+
+    Plans are keyed by the match clause, its parent path (which is passed to query transformers), and a fingerprint
+    of everything else compilation depends on: the config, the plugins and the resource files.
+    The key is order sensitive, unlike nested_object_hash, as the order of the criteria of a match clause decides
+    the order of its match paths and match reasons.
+
+    Cached plans are shared between trials as they are; nothing downstream of compilation modifies them.
+    """
+    __slots__ = (
+        "fingerprint", "plans", "hits",
+        "misses"
+    )
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.plans: Dict[str, Tuple[List[Tuple], Set[str]]] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, match_clause_data: MatchClauseData) -> str:
+        return hashlib.sha1(json.dumps([self.fingerprint,
+                                        match_clause_data.parent_path,
+                                        match_clause_data.match_clause],
+                                       sort_keys=True,
+                                       default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> Union[Tuple[List[Tuple], Set[str]], None]:
+        plan = self.plans.get(key, None)
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return plan
+
+    def put(self, key: str, plan: Tuple[List[Tuple], Set[str]]):
+        self.plans[key] = plan
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def plan_fingerprint(config: Dict, settings: Dict[str, Any], source_dirs: Iterable[str]) -> str:
+    """
+    Hash the config, settings which change how trials are compiled (e.g. plugin class names), and the contents of
+    every file in source_dirs (e.g. the plugin and resource directories)
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([config, settings], sort_keys=True, default=str).encode())
+    for source_dir in source_dirs:
+        for path in sorted(glob.glob(os.path.join(source_dir, '**', '*'), recursive=True)):
+            if not os.path.isfile(path) or '__pycache__' in path:
+                continue
+            digest.update(os.path.relpath(path, source_dir).encode())
+            with open(path, 'rb') as file_handle:
+                digest.update(file_handle.read())
+    return digest.hexdigest()
+
+
+class PersistentPlanCache(object):
+    """
+    An on-disk (SQLite) copy of the compiled trials of previous runs (see MatchEngine.compile_trial), keyed by
+    protocol number.
+
+    A compiled trial is only used while the trial has not been updated (according to its _updated field) since it
+    was compiled, and the plan fingerprint (config, plugins, resource files and matchengine's own source) is the
+    same.  Trials without an _updated field are always compiled again.
+    """
+    __slots__ = (
+        "path", "connection", "fingerprint",
+        "pending", "hits", "misses"
+    )
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS compiled_trials ("
+                                "protocol_no TEXT NOT NULL PRIMARY KEY, "
+                                "trial_updated TEXT NOT NULL, "
+                                "fingerprint TEXT NOT NULL, "
+                                "plan BLOB NOT NULL)")
+        self.connection.commit()
+        self.fingerprint = fingerprint
+        self.pending: List[Tuple[str, str, str, bytes]] = list()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, protocol_no: str, trial_updated: Union[datetime.datetime, str, None]) -> Union[Tuple[List[Tuple],
+                                                                                                  Set[str]], None]:
+        """
+        Return the valid compiled trial of a protocol number, if there is one
+        """
+        row = None
+        if trial_updated is not None:
+            row = self.connection.execute("SELECT plan FROM compiled_trials "
+                                          "WHERE protocol_no = ? AND trial_updated = ? AND fingerprint = ?",
+                                          (protocol_no, str(trial_updated), self.fingerprint)).fetchone()
+        plan = None
+        if row is not None:
+            try:
+                plan = pickle.loads(row[0])
+            except Exception:
+                plan = None
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return plan
+
+    def record(self,
+               protocol_no: str,
+               trial_updated: Union[datetime.datetime, str, None],
+               plan: Tuple[List[Tuple], Set[str]]):
+        """
+        Queue a compiled trial to be written on the next flush
+        """
+        if trial_updated is None:
+            return
+        self.pending.append((protocol_no,
+                             str(trial_updated),
+                             self.fingerprint,
+                             pickle.dumps(plan, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO compiled_trials VALUES (?, ?, ?, ?)", self.pending)
+            self.pending = list()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -11,18 +11,27 @@ from matchengine.internals.typing.matchengine_types import (
     ClinicalMatchReason,
     ExtendedMatchReason,
     MongoQuery,
+    MultiCollectionQuery,
     Cache, MatchReason
 )
+from matchengine.internals.utilities.list_utils import chunk_list
 from matchengine.internals.utilities.utilities import perform_db_call
 
 if TYPE_CHECKING:
     from bson import ObjectId
     from matchengine.internals.engine import MatchEngine
+    from matchengine.internals.utilities.clinical_id_set import ClinicalIDSet
     from matchengine.internals.typing.matchengine_types import (
         ClinicalID,
-        MultiCollectionQuery
+        MatchClauseData,
+        MatchCriterion,
+        MatchTree,
+        NodeID,
+        QueryNode,
+        QueryPart
     )
     from typing import (
+        Awaitable,
         Tuple,
         Set,
         List,
@@ -31,186 +40,566 @@ if TYPE_CHECKING:
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('matchengine')
 
+# maximum number of clinical IDs sent in a single combined clinical query
+COMBINED_QUERY_CHUNK_SIZE = 20000
+
 
 async def execute_clinical_queries(matchengine: MatchEngine,
                                    multi_collection_query: MultiCollectionQuery,
-                                   clinical_ids: Set[ClinicalID]) -> Tuple[Set[ObjectId],
-                                                                           Dict[ClinicalID, List[ClinicalMatchReason]]]:
+                                   clinical_ids: Set[ClinicalID],
+                                   match_reasons: bool = True) -> Tuple[ClinicalIDSet,
+                                                                        Dict[ClinicalID, List[ClinicalMatchReason]]]:
     """
     Take in a list of queries and only execute the clinical ones. Take the resulting clinical ids, and pass that
     to the next clinical query. Repeat for all clinical queries, continuously subsetting the returned ids.
     Finally, return all clinical IDs which matched every query, and match reasons.
 
+    If the combine_clinical_queries flag is set, all query parts of a QueryNode are fetched with a single
+    aggregation before being applied one after another.
+
+    If the in_memory_clinical_queries flag is set, query parts which can be evaluated against the clinical
+    documents loaded at startup are never sent to the database.
+
     Match Reasons are not used by default, but are composed of QueryNode objects and a clinical ID.
+    They are not built if match_reasons is not set.
     """
     reasons = defaultdict(list)
-    reasons_cache = set()
+    # the clinical IDs which fulfilled each (show_in_ui, query part hash, query depth)
+    reasons_cache = dict()
     query_parts_by_hash = dict()
-    for _clinical in multi_collection_query.clinical:
-        for query_node in _clinical.query_nodes:
-            query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
-            collection = query_level_mappings["query_collection"]
-            join_field = query_level_mappings["join_field"]
-            id_field = query_level_mappings["id_field"]
-            show_in_ui, clinical_ids = matchengine.clinical_query_node_clinical_ids_subsetter(query_node, clinical_ids)
-            for query_part in query_node.query_parts:
-                if not query_part.render:
-                    continue
-
-                query_parts_by_hash[query_part.hash()] = query_part
-                # hash the inner query to use as a reference for returned clinical ids, if necessary
-                query_hash = query_part.hash()
-                if query_hash not in matchengine.cache.ids:
-                    matchengine.cache.ids[query_hash] = dict()
-
-                # create a nested id_cache where the key is the clinical ID being queried and the vals
-                # are the clinical IDs returned
-                id_cache = matchengine.cache.ids[query_hash]
-                queried_ids = set(id_cache.keys())
-                still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
-                need_new = clinical_ids - queried_ids - still_waiting_for
-                matchengine.cache.in_process.setdefault(query_hash, set()).update(need_new)
-
-                if need_new:
-                    new_query = {'$and': [{join_field: {'$in': list(need_new)}}, query_part.query]}
-                    if matchengine.debug:
-                        log.info(f"{query_part.query}")
-                    projection = {id_field: 1, join_field: 1}
-                    docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
-
-                    # save returned ids
-                    for doc in docs:
-                        id_cache[doc[id_field]] = doc[join_field]
-
-                    # save IDs NOT returned as None so if a query is run in the future which is the same, it will skip
-                    for unfound in need_new - set(id_cache.keys()):
-                        id_cache[unfound] = None
-                    matchengine.cache.in_process[query_hash].difference_update(need_new)
-
-                while True:
-                    still_waiting_for.intersection_update(matchengine.cache.in_process[query_hash])
-                    if not still_waiting_for:
-                        break
-                    await asyncio.sleep(0.01)
-                for clinical_id in list(clinical_ids):
-
-                    # an exclusion criteria returned a clinical document hence doc is not a match
-                    if id_cache[clinical_id] is not None and query_part.negate:
-                        clinical_ids.remove(clinical_id)
-                        if (query_node.hash(), clinical_id, query_node.query_depth) in reasons_cache:
-                            reasons_cache.remove((show_in_ui, query_part.hash(), clinical_id, query_node.query_depth))
-
-                    # clinical doc fulfills exclusion criteria
-                    elif id_cache[clinical_id] is None and query_part.negate:
-                        reasons_cache.add((show_in_ui, query_part.hash(), clinical_id, query_node.query_depth))
-
-                    # doc meets inclusion criteria
-                    elif id_cache[clinical_id] is not None and not query_part.negate:
-                        reasons_cache.add((show_in_ui, query_part.hash(), clinical_id, query_node.query_depth))
-
-                    # no clinical doc returned for an inclusion criteria query, so remove _id from future queries
-                    elif id_cache[clinical_id] is None and not query_part.negate:
-                        clinical_ids.remove(clinical_id)
-                        if (query_node.hash(), clinical_id) in reasons_cache:
-                            reasons_cache.remove((show_in_ui, query_part.hash(), clinical_id, query_node.query_depth))
-
-    for show_in_ui, query_node_hash, clinical_id, depth in reasons_cache:
-        reasons[clinical_id].append(
-            ClinicalMatchReason(query_parts_by_hash[query_node_hash], clinical_id, depth, show_in_ui))
+    clinical_id_index = matchengine.cache.clinical_id_index
+    planner = matchengine.query_planner
+    query_nodes = (planner.plan_clinical_query_nodes(multi_collection_query)
+                   if planner is not None
+                   else [query_node
+                         for query_node_container in multi_collection_query.clinical
+                         for query_node in query_node_container.query_nodes])
+    for query_node in query_nodes:
+        # once no clinical ids are left the path can no longer match, so don't issue any further queries
+        if not clinical_ids:
+            break
+        query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
+        show_in_ui, clinical_ids = matchengine.clinical_query_node_clinical_ids_subsetter(query_node, clinical_ids)
+        clinical_ids = clinical_id_index.to_set(clinical_ids)
+        query_parts = [query_part for query_part in query_node.query_parts if query_part.render]
+        if planner is not None:
+            query_parts = planner.plan_clinical_query_parts(query_parts)
+        if matchengine.clinical_evaluator is not None:
+            evaluate_clinical_query_parts_in_memory(matchengine, query_level_mappings, query_parts, clinical_ids)
+        if matchengine.combine_clinical_queries:
+            await fetch_clinical_query_parts_combined(matchengine, query_level_mappings, query_parts, clinical_ids)
+        for query_part in query_parts:
+            query_parts_by_hash[query_part.hash()] = query_part
+            # hash the inner query to use as a reference for returned clinical ids, if necessary
+            query_hash = query_part.hash()
+            if not matchengine.combine_clinical_queries:
+                await fetch_clinical_query_part(matchengine, query_level_mappings, query_part, clinical_ids)
+
+            # an exclusion criteria is fulfilled by clinical IDs which did not return a clinical document,
+            # an inclusion criteria by those that did. the rest are removed from future queries
+            if query_part.negate:
+                clinical_ids -= matchengine.cache.matched[query_hash]
+            else:
+                clinical_ids &= matchengine.cache.matched[query_hash]
+            if not match_reasons:
+                continue
+            reason_key = (show_in_ui, query_hash, query_node.query_depth)
+            if reason_key in reasons_cache:
+                reasons_cache[reason_key] |= clinical_ids
+            else:
+                reasons_cache[reason_key] = clinical_ids.copy()
+
+    reasons_cache_items = reasons_cache.items()
+    if planner is not None:
+        # match reasons are listed in the curated order of the query parts, regardless of the order they were run in
+        curated_order = dict()
+        for query_node_container in multi_collection_query.clinical:
+            for query_node in query_node_container.query_nodes:
+                for query_part in query_node.query_parts:
+                    curated_order.setdefault(query_part.hash(), len(curated_order))
+        reasons_cache_items = sorted(reasons_cache_items, key=lambda item: curated_order[item[0][1]])
+    for (show_in_ui, query_part_hash, depth), reason_clinical_ids in reasons_cache_items:
+        for clinical_id in reason_clinical_ids:
+            reasons[clinical_id].append(
+                ClinicalMatchReason(query_parts_by_hash[query_part_hash], clinical_id, depth, show_in_ui))
     return clinical_ids, reasons
 
 
+def evaluate_clinical_query_parts_in_memory(matchengine: MatchEngine,
+                                            query_level_mappings: Dict,
+                                            query_parts: List[QueryPart],
+                                            clinical_ids: ClinicalIDSet):
+    """
+    Fill the id caches of clinical query parts from the in-memory clinical evaluator for the clinical IDs which
+    have not yet been queried.  Query parts the evaluator can't handle are left for the database.
+    """
+    if not (query_level_mappings["query_collection"] == 'clinical'
+            and query_level_mappings["id_field"] == '_id'
+            and query_level_mappings["join_field"] == '_id'):
+        return
+    evaluator = matchengine.clinical_evaluator
+    for query_part in query_parts:
+        query_hash = query_part.hash()
+        if not evaluator.supports(query_hash, query_part.query):
+            continue
+        # evaluation doesn't yield to other workers, so the claim is released before any other worker can wait on it
+        need_new, future, _ = matchengine.cache.claim(query_hash, clinical_ids & evaluator.clinical_ids)
+        if not need_new:
+            continue
+        try:
+            matched = evaluator.evaluate(query_hash, query_part.query, need_new)
+        except BaseException as e:
+            matchengine.cache.release(query_hash, need_new, future, e)
+            raise
+        if matchengine.debug:
+            log.info(f"{query_part.query} evaluated in memory")
+        id_cache = matchengine.cache.ids[query_hash]
+        for clinical_id in matched:
+            id_cache[clinical_id] = clinical_id
+        matchengine.cache.release(query_hash, need_new, future)
+
+
+async def fetch_clinical_query_part(matchengine: MatchEngine,
+                                    query_level_mappings: Dict,
+                                    query_part: QueryPart,
+                                    clinical_ids: Set[ClinicalID]):
+    """
+    Ensure the id cache for a clinical query part has an entry for every clinical ID passed, querying the
+    clinical IDs which have not yet been queried for.
+    """
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+    query_hash = query_part.hash()
+    id_cache = matchengine.cache.ids.setdefault(query_hash, dict())
+    need_new, future, waiting_on = matchengine.cache.claim(query_hash, clinical_ids)
+
+    if need_new:
+        new_query = {'$and': [{join_field: {'$in': list(need_new)}}, query_part.query]}
+        if matchengine.debug:
+            log.info(f"{query_part.query}")
+        projection = {id_field: 1, join_field: 1}
+        try:
+            docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
+        except BaseException as e:
+            matchengine.cache.release(query_hash, need_new, future, e)
+            raise
+
+        # save returned ids. IDs NOT returned are recorded as queried on release, so if a query is run in the future
+        # which is the same, it will skip
+        for doc in docs:
+            id_cache[doc[id_field]] = doc[join_field]
+        matchengine.cache.release(query_hash, need_new, future)
+
+    # wait for any other workers which are already querying for some of the needed clinical ids
+    await matchengine.cache.wait_for(waiting_on)
+
+
+async def fetch_clinical_query_parts_combined(matchengine: MatchEngine,
+                                              query_level_mappings: Dict,
+                                              query_parts: List[QueryPart],
+                                              clinical_ids: Set[ClinicalID]):
+    """
+    Like fetch_clinical_query_part, but for all query parts of a clinical QueryNode at once.
+
+    Rather than sending one find per query part, a single aggregation is sent which matches the union of the
+    clinical IDs needed by any query part, then uses a $facet stage to return the matching IDs of each
+    query part separately, so each query part's id cache can be filled from the one response.
+    The union of needed clinical IDs is split into chunks of COMBINED_QUERY_CHUNK_SIZE to keep each
+    $facet result below the 16MB document limit.
+    """
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+    claims = list()
+    waiting_on = set()
+    for query_part in query_parts:
+        query_hash = query_part.hash()
+        need_new, future, query_part_waiting_on = matchengine.cache.claim(query_hash, clinical_ids)
+        waiting_on.update(query_part_waiting_on)
+        if need_new:
+            claims.append((query_part, query_hash, need_new, future))
+
+    if claims:
+        all_need_new = reduce(operator.or_, [need_new for _, _, need_new, _ in claims])
+        projection = {id_field: 1, join_field: 1}
+        facets = {
+            str(idx): [{'$match': (query_part.query
+                                   if need_new == all_need_new
+                                   else {'$and': [{join_field: {'$in': list(need_new)}}, query_part.query]})},
+                       {'$project': projection}]
+            for idx, (query_part, _, need_new, _) in enumerate(claims)
+        }
+        if matchengine.debug:
+            log.info(f"{[query_part.query for query_part, _, _, _ in claims]}")
+        pipelines = [
+            [{'$match': {join_field: {'$in': chunk}}}, {'$facet': facets}]
+            for chunk in chunk_list(list(all_need_new), COMBINED_QUERY_CHUNK_SIZE)
+        ]
+        try:
+            results = await asyncio.gather(*[
+                matchengine.async_db_ro[collection].aggregate(pipeline).to_list(None)
+                for pipeline in pipelines
+            ])
+        except BaseException as e:
+            for _, query_hash, need_new, future in claims:
+                matchengine.cache.release(query_hash, need_new, future, e)
+            raise
+
+        for idx, (_, query_hash, need_new, future) in enumerate(claims):
+            id_cache = matchengine.cache.ids[query_hash]
+            # save returned ids. IDs NOT returned are recorded as queried on release
+            for result in results:
+                for doc in result[0][str(idx)]:
+                    id_cache[doc[id_field]] = doc[join_field]
+            matchengine.cache.release(query_hash, need_new, future)
+
+    # wait for any other workers which are already querying for some of the needed clinical ids
+    await matchengine.cache.wait_for(waiting_on)
+
+
 async def execute_extended_queries(
         matchengine: MatchEngine,
         multi_collection_query: MultiCollectionQuery,
         initial_clinical_ids: Set[ClinicalID],
-        reasons: Dict[ClinicalID, List[MatchReason]]) -> Tuple[Set[ObjectId],
-                                                               Dict[str, Set[ObjectId]],
-                                                               Dict[ClinicalID, List[MatchReason]]]:
-    # This function will execute to filter patients on extended clinical/genomic attributes
-    clinical_ids = {clinical_id: set() for clinical_id in initial_clinical_ids}
+        reasons: Dict[ClinicalID, List[MatchReason]],
+        match_reasons: bool = True) -> Tuple[ClinicalIDSet,
+                                             Dict[str, Set[ObjectId]],
+                                             Dict[ClinicalID, List[MatchReason]]]:
+    # This function will execute to filter patients on extended clinical/genomic attributes.
+    # If match_reasons is not set, only the matching clinical IDs are returned, without any reasons or extended IDs
+    clinical_id_index = matchengine.cache.clinical_id_index
+    clinical_ids = clinical_id_index.to_set(initial_clinical_ids)
     qnc_qn_tracker = dict()
-    for qnc_idx, query_node_container in enumerate(multi_collection_query.extended_attributes):
-        query_node_container_clinical_ids = list()
+    planner = matchengine.query_planner
+    query_node_containers = (planner.plan_extended_query_node_containers(multi_collection_query)
+                             if planner is not None
+                             else enumerate(multi_collection_query.extended_attributes))
+    for qnc_idx, query_node_container in query_node_containers:
+        # once no clinical ids are left the path can no longer match, so don't issue any further queries
+        if not clinical_ids:
+            break
         # TODO: add test for this - duplicate criteria causing empty qnc
         if not query_node_container.query_nodes:
             continue
-        for qn_idx, query_node in enumerate(query_node_container.query_nodes):
-            query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
-            collection = query_level_mappings["query_collection"]
-            join_field = query_level_mappings["join_field"]
-            id_field = query_level_mappings["id_field"]
-            query_node_container_clinical_ids.append(
-                matchengine.extended_query_node_clinical_ids_subsetter(query_node, clinical_ids.keys())
-            )
-            show_in_ui, working_clinical_ids = query_node_container_clinical_ids[qn_idx]
-            if not working_clinical_ids:
-                continue
-
-            # Create a nested id_cache where the key is the clinical ID being queried and the vals
-            # are the extended_attributes IDs returned
-            query_hash = query_node.raw_query_hash()
-            if query_hash not in matchengine.cache.ids:
-                matchengine.cache.ids[query_hash] = dict()
-            id_cache = matchengine.cache.ids[query_hash]
-            queried_ids = set(id_cache.keys())
-            still_waiting_for = matchengine.cache.in_process.setdefault(query_hash, set())
-            need_new = working_clinical_ids - queried_ids - still_waiting_for
-            matchengine.cache.in_process.setdefault(query_hash, set()).update(need_new)
-            query = query_node.extract_raw_query()
-
-            if need_new:
-                new_query = query
-                new_query['$and'] = new_query.get('$and', list())
-                new_query['$and'].insert(0, {join_field: {'$in': list(need_new)}})
-
-                projection = {id_field: 1, join_field: 1}
-                genomic_docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
-                if matchengine.debug:
-                    log.info(f"{new_query} returned {genomic_docs}")
-
-                for genomic_doc in genomic_docs:
-                    # If the clinical id of a returned extended_attributes doc is not present in the cache, add it.
-                    if genomic_doc[join_field] not in id_cache:
-                        id_cache[genomic_doc[join_field]] = set()
-                    id_cache[genomic_doc[join_field]].add(genomic_doc[id_field])
-
-                # Clinical IDs which do not return extended_attributes docs need to be recorded to cache exclusions
-                for unfound in need_new - set(id_cache.keys()):
-                    id_cache[unfound] = None
-                matchengine.cache.in_process[query_hash].difference_update(need_new)
-            while True:
-                still_waiting_for.intersection_update(matchengine.cache.in_process[query_hash])
-                if not still_waiting_for:
-                    break
-                await asyncio.sleep(0.01)
-            returned_clinical_ids = {clinical_id
-                                     for clinical_id, genomic_docs
-                                     in id_cache.items()
-                                     if genomic_docs is not None}
-            not_returned_clinical_ids = working_clinical_ids - returned_clinical_ids
-            working_clinical_ids.intersection_update((
-                not_returned_clinical_ids
-                if query_node.exclusion
-                else returned_clinical_ids
-            ))
-        current_clinical_ids = set(clinical_ids.keys())
-        qnc_clinical_ids = {
-            clinical_id
-            for clinical_id
-            in reduce(operator.or_, map(operator.itemgetter(1), query_node_container_clinical_ids), set())
-        }
-        for invalid_clinical in current_clinical_ids - qnc_clinical_ids:
-            all_qnc_qn_to_remove = clinical_ids.pop(invalid_clinical)
-            for qnc_qn_to_remove in all_qnc_qn_to_remove:
-                qnc_qn_tracker[qnc_qn_to_remove][1].remove(invalid_clinical)
+        query_node_container_clinical_ids = list()
+        for query_node in query_node_container.query_nodes:
+            show_in_ui, working_clinical_ids = matchengine.extended_query_node_clinical_ids_subsetter(query_node,
+                                                                                                     clinical_ids)
+            query_node_container_clinical_ids.append((show_in_ui, clinical_id_index.to_set(working_clinical_ids)))
+
+        # query nodes within a container are alternatives to one another, so they are queried concurrently
+        await gather_bounded(matchengine.query_node_concurrency, [
+            execute_extended_query_node(matchengine, query_node, working_clinical_ids)
+            for query_node, (_, working_clinical_ids) in zip(query_node_container.query_nodes,
+                                                              query_node_container_clinical_ids)
+            if working_clinical_ids
+        ])
+        # clinical ids remain valid if they matched any of the container's query nodes
+        clinical_ids = reduce(operator.or_,
+                              map(operator.itemgetter(1), query_node_container_clinical_ids),
+                              clinical_id_index.empty_set())
         for qn_idx, qn_results in enumerate(query_node_container_clinical_ids):
-            for valid_clinical_id in qn_results[1] & qnc_clinical_ids:
-                clinical_ids[valid_clinical_id].add((qnc_idx, qn_idx))
             qnc_qn_tracker[(qnc_idx, qn_idx)] = qn_results
 
+    if not match_reasons:
+        return clinical_ids, dict(), reasons
+
+    # clinical ids invalidated by a later container are no longer matches of the query nodes of earlier containers
+    for _, found_clinical_ids in qnc_qn_tracker.values():
+        found_clinical_ids &= clinical_ids
+
+    # match reasons are listed in the curated order of the query nodes, regardless of the order they were run in
+    qnc_qn_tracker = dict(sorted(qnc_qn_tracker.items()))
     reasons, all_extended = get_reasons(qnc_qn_tracker, multi_collection_query, matchengine.cache, reasons)
-    return set(clinical_ids.keys()), all_extended, reasons
+    return clinical_ids, all_extended, reasons
+
+
+async def execute_extended_query_node(matchengine: MatchEngine,
+                                      query_node: QueryNode,
+                                      working_clinical_ids: ClinicalIDSet):
+    """
+    Query the extended attributes collection of a query node (or the extended attribute index, if one was built
+    for the query node's level) for the working clinical IDs which have not yet been queried, then subset the
+    working clinical IDs in place to those which match the query node (or, for exclusion query nodes, those which
+    do not).
+    """
+    query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_node.query_level]
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+
+    # Create a nested id_cache where the key is the clinical ID being queried and the vals
+    # are the extended_attributes IDs returned
+    query_hash = query_node.raw_query_hash()
+    need_new, future, waiting_on = matchengine.cache.claim(query_hash, working_clinical_ids)
+    id_cache = matchengine.cache.ids[query_hash]
+
+    if need_new:
+        query = query_node.extract_raw_query()
+        index = matchengine.extended_attribute_index
+        # the raw query is cached on the query node, so copy it rather than adding the clinical ids to it
+        new_query = dict(query)
+        new_query['$and'] = [{join_field: {'$in': list(need_new)}}] + query.get('$and', list())
+
+        projection = {id_field: 1, join_field: 1}
+        try:
+            genomic_docs = (index.find(query_hash, query, need_new)
+                            if index is not None and index.query_level == query_node.query_level
+                            else None)
+            if genomic_docs is None:
+                genomic_docs = await matchengine.async_db_ro[collection].find(new_query, projection).to_list(None)
+        except BaseException as e:
+            matchengine.cache.release(query_hash, need_new, future, e)
+            raise
+        if matchengine.debug:
+            log.info(f"{new_query} returned {genomic_docs}")
+
+        for genomic_doc in genomic_docs:
+            # If the clinical id of a returned extended_attributes doc is not present in the cache, add it.
+            if genomic_doc[join_field] not in id_cache:
+                id_cache[genomic_doc[join_field]] = set()
+            id_cache[genomic_doc[join_field]].add(genomic_doc[id_field])
+
+        # Clinical IDs which do not return extended_attributes docs are recorded as queried (but not matched) on
+        # release to cache exclusions
+        matchengine.cache.release(query_hash, need_new, future)
+
+    # wait for any other workers which are already querying for some of the needed clinical ids
+    await matchengine.cache.wait_for(waiting_on)
+    if query_node.exclusion:
+        working_clinical_ids -= matchengine.cache.matched[query_hash]
+    else:
+        working_clinical_ids &= matchengine.cache.matched[query_hash]
+
+
+async def match_multi_collection_query(matchengine: MatchEngine,
+                                       multi_collection_query: MultiCollectionQuery,
+                                       clinical_ids: ClinicalIDSet) -> ClinicalIDSet:
+    """
+    The clinical IDs which match both the clinical and the extended attributes queries of multi_collection_query,
+    without building any match reasons
+    """
+    if multi_collection_query.clinical:
+        clinical_ids, _ = await execute_clinical_queries(matchengine,
+                                                         multi_collection_query,
+                                                         clinical_ids,
+                                                         match_reasons=False)
+    if clinical_ids and multi_collection_query.extended_attributes:
+        clinical_ids, _, _ = await execute_extended_queries(matchengine,
+                                                            multi_collection_query,
+                                                            clinical_ids,
+                                                            defaultdict(list),
+                                                            match_reasons=False)
+    return clinical_ids
+
+
+def match_path_node_query(multi_collection_query: MultiCollectionQuery, node_id: int) -> MultiCollectionQuery:
+    """
+    The part of the query of a match path which was translated from the criteria of a single node of the match tree
+    """
+    return MultiCollectionQuery(
+        [query_node_container
+         for query_node_container in multi_collection_query.extended_attributes
+         if query_node_container.query_nodes and query_node_container.query_nodes[0].node_id == node_id],
+        [query_node_container
+         for query_node_container in multi_collection_query.clinical
+         if query_node_container.query_nodes and query_node_container.query_nodes[0].node_id == node_id]
+    )
+
+
+async def match_path_prefix_clinical_ids(matchengine: MatchEngine,
+                                         path_prefixes: Dict[Tuple[int, Tuple[int, ...]], asyncio.Future],
+                                         match_clause_data: MatchClauseData,
+                                         match_path: MatchCriterion,
+                                         multi_collection_query: MultiCollectionQuery,
+                                         clinical_ids: ClinicalIDSet) -> ClinicalIDSet:
+    """
+    The clinical IDs which match every node of a match path but the last.
+
+    Match paths of a match clause share the nodes near the root of the match tree, so the clinical IDs matching
+    each prefix of node IDs are computed only once (by whichever path gets to it first) and kept in path_prefixes,
+    each prefix narrowing down the clinical IDs of the prefix one node shorter.
+    The returned clinical IDs are shared, so must not be modified in place.
+    """
+    prefix = tuple()
+    for criteria in match_path.criteria_list[:-1]:
+        prefix += (criteria.node_id,)
+        key = (id(match_clause_data), prefix)
+        future = path_prefixes.get(key, None)
+        if future is None:
+            node_query = match_path_node_query(multi_collection_query, criteria.node_id)
+            future = path_prefixes[key] = asyncio.ensure_future(
+                match_multi_collection_query(matchengine, node_query, clinical_ids))
+        try:
+            clinical_ids = await asyncio.shield(future)
+        except Exception:
+            # let a retried task compute the prefix again
+            if path_prefixes.get(key, None) is future:
+                del path_prefixes[key]
+            raise
+        if not clinical_ids:
+            break
+    return clinical_ids
+
+
+async def evaluate_match_tree(matchengine: MatchEngine,
+                              match_tree: MatchTree,
+                              node_queries: Dict[Tuple[NodeID, int], MultiCollectionQuery],
+                              clinical_ids: ClinicalIDSet) -> Dict[Tuple[NodeID, int], ClinicalIDSet]:
+    """
+    Evaluate a match tree without expanding it into match paths. Returns, for each node at each of its depths, the
+    clinical IDs which match every node of some path from the root through that node at that depth to a leaf.
+
+    Going down the tree, the query of each node at each depth is run once, only for the clinical IDs which matched
+    one of its parents at the depth above. Going back up, the clinical IDs of each node are intersected with the union
+    of those of its children at the depth below.
+    """
+    clinical_id_index = matchengine.cache.clinical_id_index
+    order = match_tree.topological_order()
+    depths = match_tree.depths()
+    reached = dict()
+    for node_id in order:
+        parents = match_tree.predecessors[node_id]
+        for depth in depths[node_id]:
+            node_clinical_ids = (clinical_id_index.to_set(clinical_ids)
+                                 if not parents
+                                 else reduce(operator.or_, [reached[(parent_id, depth - 1)]
+                                                            for parent_id in parents
+                                                            if (parent_id, depth - 1) in reached]))
+            if node_clinical_ids and (node_id, depth) in node_queries:
+                node_clinical_ids = await match_multi_collection_query(matchengine,
+                                                                       node_queries[(node_id, depth)],
+                                                                       node_clinical_ids)
+            reached[(node_id, depth)] = node_clinical_ids
+
+    matched = dict()
+    for node_id in reversed(order):
+        children = match_tree.successors[node_id]
+        for depth in depths[node_id]:
+            matched[(node_id, depth)] = (reached[(node_id, depth)] & reduce(operator.or_,
+                                                                            [matched[(child_id, depth + 1)]
+                                                                             for child_id in children])
+                                         if children
+                                         else reached[(node_id, depth)])
+    return matched
+
+
+async def gather_bounded(limit: int, coroutines: List[Awaitable]) -> List:
+    """
+    Like asyncio.gather, but with at most limit of the coroutines running at any one time
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run_bounded(coroutine) for coroutine in coroutines])
+
+
+async def prefetch_queries(matchengine: MatchEngine,
+                           clinical_query_parts: Dict[str, Tuple[str, QueryPart]],
+                           extended_query_nodes: Dict[str, QueryNode],
+                           clinical_ids: ClinicalIDSet,
+                           restrict: bool):
+    """
+    Run each distinct clinical query part and extended query node once for all of clinical_ids, filling their id
+    caches, then load the documents any trial match may need into the document cache.  Trials matched afterwards
+    are answered from the cache without further database reads.
+
+    Unless restrict is set, queries are sent without a list of clinical IDs, i.e. over the whole collection, and
+    documents of other clinical IDs are ignored.
+    """
+    if matchengine.clinical_evaluator is not None:
+        query_parts_by_level = defaultdict(list)
+        for query_level, query_part in clinical_query_parts.values():
+            query_parts_by_level[query_level].append(query_part)
+        for query_level, query_parts in query_parts_by_level.items():
+            query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_level]
+            evaluate_clinical_query_parts_in_memory(matchengine, query_level_mappings, query_parts, clinical_ids)
+
+    await gather_bounded(matchengine.num_workers, [
+        prefetch_query(matchengine, query_level, query_hash, query_part.query, clinical_ids, restrict, False)
+        for query_hash, (query_level, query_part) in clinical_query_parts.items()
+    ] + [
+        prefetch_query(matchengine, query_node.query_level, query_hash, query_node.extract_raw_query(), clinical_ids,
+                       restrict, True)
+        for query_hash, query_node in extended_query_nodes.items()
+    ])
+
+    # extended documents are only reported for query nodes which are not exclusions
+    needed_extended = defaultdict(set)
+    for query_hash, query_node in extended_query_nodes.items():
+        if query_node.exclusion:
+            continue
+        for reference_ids in matchengine.cache.ids[query_hash].values():
+            if reference_ids is not None:
+                needed_extended[query_node.query_level].update(reference_ids)
+    needed_clinical = [clinical_id for clinical_id in clinical_ids if clinical_id not in matchengine.cache.docs]
+    db_calls = [get_docs_results(matchengine, chunk, dict())
+                for chunk in chunk_list(needed_clinical, COMBINED_QUERY_CHUNK_SIZE)]
+    for query_level, extended_ids in needed_extended.items():
+        extended_ids = [extended_id for extended_id in extended_ids if extended_id not in matchengine.cache.docs]
+        db_calls.extend(get_docs_results(matchengine, list(), {query_level: chunk})
+                        for chunk in chunk_list(extended_ids, COMBINED_QUERY_CHUNK_SIZE))
+    for results in await gather_bounded(matchengine.num_workers, db_calls):
+        for outer_result in results:
+            for result in outer_result:
+                matchengine.cache.docs[result["_id"]] = result
+
+
+async def prefetch_query(matchengine: MatchEngine,
+                         query_level: str,
+                         query_hash: str,
+                         query: Dict,
+                         clinical_ids: ClinicalIDSet,
+                         restrict: bool,
+                         extended: bool):
+    """
+    Fill the id cache of a single clinical query part or (if extended is set) extended query node for every
+    clinical ID which has not yet been queried.
+    """
+    query_level_mappings = matchengine.match_criteria_transform.ctml_collection_mappings[query_level]
+    collection = query_level_mappings["query_collection"]
+    join_field = query_level_mappings["join_field"]
+    id_field = query_level_mappings["id_field"]
+    need_new, future, waiting_on = matchengine.cache.claim(query_hash, clinical_ids)
+
+    if need_new:
+        index = matchengine.extended_attribute_index
+        projection = {id_field: 1, join_field: 1}
+        try:
+            docs = (index.find(query_hash, query, need_new)
+                    if extended and index is not None and index.query_level == query_level
+                    else None)
+            if docs is None:
+                queries = ([{'$and': [{join_field: {'$in': chunk}}, query]}
+                            for chunk in chunk_list(list(need_new), COMBINED_QUERY_CHUNK_SIZE)]
+                           if restrict
+                           else [query])
+                if matchengine.debug:
+                    log.info(f"Prefetching {query}")
+                results = await asyncio.gather(*[
+                    matchengine.async_db_ro[collection].find(chunk_query, projection).to_list(None)
+                    for chunk_query in queries
+                ])
+                docs = [doc for result in results for doc in result]
+        except BaseException as e:
+            matchengine.cache.release(query_hash, need_new, future, e)
+            raise
+
+        id_cache = matchengine.cache.ids[query_hash]
+        for doc in docs:
+            if doc[join_field] not in need_new:
+                continue
+            if extended:
+                id_cache.setdefault(doc[join_field], set()).add(doc[id_field])
+            else:
+                id_cache[doc[id_field]] = doc[join_field]
+        matchengine.cache.release(query_hash, need_new, future)
+
+    await matchengine.cache.wait_for(waiting_on)
 
 
 def get_reasons(qnc_qn_tracker: Dict[Tuple: int, List[ClinicalID]],
@@ -223,14 +612,17 @@ def get_reasons(qnc_qn_tracker: Dict[Tuple: int, List[ClinicalID]],
     for (qnc_idx, qn_idx), (show_in_ui, found_clinical_ids) in qnc_qn_tracker.items():
         genomic_query_node_container = multi_collection_query.extended_attributes[qnc_idx]
         query_node = genomic_query_node_container.query_nodes[qn_idx]
+        if not found_clinical_ids:
+            continue
+        id_cache = cache.ids[query_node.raw_query_hash()]
+        # the number of clinical IDs the query node has been run for
+        clinical_width = len(cache.queried[query_node.raw_query_hash()])
         for clinical_id in found_clinical_ids:
-            reference_ids = cache.ids[query_node.raw_query_hash()][clinical_id]
+            reference_ids = id_cache.get(clinical_id, None)
             if reference_ids is not None:
                 all_extended[query_node.query_level].update(reference_ids)
             for reference_id in (reference_ids if reference_ids is not None else [None]):
-                id_cache = cache.ids[query_node.raw_query_hash()]
-                reference_width = len(id_cache[clinical_id]) if reference_id is not None else -1
-                clinical_width = len(id_cache)
+                reference_width = len(reference_ids) if reference_id is not None else -1
                 reasons[clinical_id].append(
                     ExtendedMatchReason(
                         query_node,
@@ -252,10 +644,13 @@ async def get_docs_results(matchengine: MatchEngine, needed_clinical, needed_ext
     :return:
     """
     clinical_projection = matchengine.match_criteria_transform.projections["clinical"]
-    clinical_query = MongoQuery({"_id": {"$in": list(needed_clinical)}})
     db_calls = list()
-    db_calls.append(perform_db_call(matchengine, "clinical", clinical_query, clinical_projection))
+    if needed_clinical:
+        clinical_query = MongoQuery({"_id": {"$in": list(needed_clinical)}})
+        db_calls.append(perform_db_call(matchengine, "clinical", clinical_query, clinical_projection))
     for extended_collection, extended_ids in needed_extended.items():
+        if not extended_ids:
+            continue
         genomic_query = MongoQuery({"_id": {"$in": list(extended_ids)}})
         projection = matchengine.match_criteria_transform.projections[extended_collection]
         db_calls.append(perform_db_call(matchengine, extended_collection, genomic_query, projection))
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import (
+        Dict,
+        List,
+        Tuple,
+        Union
+    )
+    from matchengine.internals.typing.matchengine_types import (
+        Cache,
+        MultiCollectionQuery,
+        QueryNode,
+        QueryNodeContainer,
+        QueryPart
+    )
+
+QUERY_STATISTICS_COLLECTION = 'query_statistics'
+# queries which have never been run are assumed to match every clinical ID, so that they are run after queries
+# which are known to be selective, but otherwise keep their curated order
+UNKNOWN_SELECTIVITY = 1.0
+
+
+class QueryPlanner(object):
+    """
+    Orders the queries of a MultiCollectionQuery, most selective first, using the fraction of clinical IDs each
+    query shape (query hash) matched in previous runs (statistics) and so far in this run (the cache).
+    """
+    __slots__ = (
+        "cache", "statistics"
+    )
+
+    def __init__(self, cache: Cache, statistics: Dict[str, Tuple[int, int]] = None):
+        self.cache = cache
+        # per query hash, the number of clinical IDs queried and matched in previous runs
+        self.statistics = dict() if statistics is None else statistics
+
+    def match_fraction(self, query_hash: str) -> Union[float, None]:
+        queried, matched = self.statistics.get(query_hash, (0, 0))
+        run_queried, run_matched = self.cache.statistics.get(query_hash, (0, 0))
+        queried += run_queried
+        matched += run_matched
+        return matched / queried if queried else None
+
+    def query_part_selectivity(self, query_part: QueryPart) -> float:
+        fraction = self.match_fraction(query_part.hash())
+        if fraction is None:
+            return UNKNOWN_SELECTIVITY
+        return 1 - fraction if query_part.negate else fraction
+
+    def clinical_query_node_selectivity(self, query_node: QueryNode) -> float:
+        selectivity = 1.0
+        for query_part in query_node.query_parts:
+            if query_part.render:
+                selectivity *= self.query_part_selectivity(query_part)
+        return selectivity
+
+    def extended_query_node_selectivity(self, query_node: QueryNode) -> float:
+        fraction = self.match_fraction(query_node.raw_query_hash())
+        if fraction is None:
+            return UNKNOWN_SELECTIVITY
+        return 1 - fraction if query_node.exclusion else fraction
+
+    def query_node_container_selectivity(self, query_node_container: QueryNodeContainer) -> float:
+        # query nodes within a container are alternatives, so the selectivity of their union is bounded by the sum
+        if not query_node_container.query_nodes:
+            return UNKNOWN_SELECTIVITY
+        return min(1.0, sum(map(self.extended_query_node_selectivity, query_node_container.query_nodes)))
+
+    def plan_clinical_query_nodes(self, multi_collection_query: MultiCollectionQuery) -> List[QueryNode]:
+        return sorted((query_node
+                       for query_node_container in multi_collection_query.clinical
+                       for query_node in query_node_container.query_nodes),
+                      key=self.clinical_query_node_selectivity)
+
+    def plan_clinical_query_parts(self, query_parts: List[QueryPart]) -> List[QueryPart]:
+        return sorted(query_parts, key=self.query_part_selectivity)
+
+    def plan_extended_query_node_containers(
+            self,
+            multi_collection_query: MultiCollectionQuery) -> List[Tuple[int, QueryNodeContainer]]:
+        """
+        Return the extended query node containers, most selective first, with their index in the
+        MultiCollectionQuery.
+        """
+        return sorted(enumerate(multi_collection_query.extended_attributes),
+                      key=lambda indexed: self.query_node_container_selectivity(indexed[1]))
+
+    def extended_first(self, multi_collection_query: MultiCollectionQuery) -> bool:
+        """
+        Whether the extended queries of a MultiCollectionQuery are expected to leave fewer clinical IDs than its
+        clinical queries, and so should be used to narrow down the clinical IDs before the clinical queries are run.
+        """
+        clinical_selectivity = 1.0
+        for query_node_container in multi_collection_query.clinical:
+            for query_node in query_node_container.query_nodes:
+                clinical_selectivity *= self.clinical_query_node_selectivity(query_node)
+        extended_selectivity = 1.0
+        for query_node_container in multi_collection_query.extended_attributes:
+            extended_selectivity *= self.query_node_container_selectivity(query_node_container)
+        return extended_selectivity < clinical_selectivity
+
+    def statistics_updates(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Return the statistics of previous runs combined with those of this run, for every query run in this run.
+        """
+        updates = dict()
+        for query_hash, (run_queried, run_matched) in self.cache.statistics.items():
+            queried, matched = self.statistics.get(query_hash, (0, 0))
+            updates[query_hash] = (queried + run_queried, matched + run_matched)
+        return updates
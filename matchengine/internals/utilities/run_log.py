@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from bisect import bisect_right
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import datetime
+    from typing import (
+        Dict,
+        Hashable,
+        Iterable,
+        List,
+        Set,
+        Tuple,
+        Union
+    )
+    from matchengine.internals.typing.matchengine_types import ClinicalID
+
+
+class ClinicalUpdateIndex(object):
+    """
+    The clinical IDs of a run, sorted once by the _updated timestamp of their clinical documents, so that the clinical
+    IDs updated since a run log entry was created are a slice rather than a scan over every clinical document
+    (see MatchEngine.get_clinical_ids_for_protocol)
+    """
+    __slots__ = (
+        "timestamps", "clinical_ids", "never_updated"
+    )
+
+    def __init__(self, clinical_update_mapping: Dict[ClinicalID, Union[datetime.datetime, None]]):
+        updated = sorted(((updated_at, clinical_id)
+                          for clinical_id, updated_at in clinical_update_mapping.items()
+                          if updated_at is not None),
+                         key=lambda item: item[0])
+        self.timestamps: List[datetime.datetime] = [updated_at for updated_at, _ in updated]
+        self.clinical_ids: List[ClinicalID] = [clinical_id for _, clinical_id in updated]
+        # clinical documents without an _updated field are always run
+        self.never_updated: Set[ClinicalID] = {clinical_id
+                                               for clinical_id, updated_at in clinical_update_mapping.items()
+                                               if updated_at is None}
+
+    def updated_since(self, timestamp: datetime.datetime) -> Set[ClinicalID]:
+        """
+        Clinical IDs whose clinical document was updated strictly after timestamp
+        """
+        return set(self.clinical_ids[bisect_right(self.timestamps, timestamp):])
+
+
+def run_log_signature(run_log_entries: List[Dict], age_criterion: Iterable[str]) -> Tuple[Hashable, ...]:
+    """
+    Everything reconciling the run log entries of a protocol depends on (see MatchEngine.get_clinical_ids_for_protocol),
+    so that protocols run by the same previous runs, with the same age criteria, share the clinical IDs to run
+    """
+    return (frozenset(age_criterion),) + tuple((run_log['_created'],
+                                                ('all'
+                                                 if 'all' in run_log['clinical_ids']
+                                                 else frozenset(run_log['clinical_ids'].get('list', list()))),
+                                                run_log['run_params']['match_on_deceased'])
+                                               for run_log in run_log_entries)
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from bson import ObjectId
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        Iterable,
+        List,
+        Tuple,
+        Union
+    )
+
+# sort value of a dimension when no field of the dimension matches
+DEFAULT_SORT_INDEX = 99
+
+_missing = object()
+
+
+class SortOrderEvaluator(object):
+    """
+    The trial_match_sorting config, compiled once into a flat list of (dimension, field, lookup table, ANY_VALUE)
+    tuples, from which the sort_order of trial_match documents is computed (see utilities.get_sort_order).
+
+    Lookup tables are the sorting values of each field, keyed by the string value of the field in trial_match documents;
+    if the field has an ANY_VALUE sorting value, that value is used whenever the field is in a document, and the table
+    isn't used.
+    """
+    __slots__ = (
+        "dimensions", "fields", "trial_identifier",
+        "_identifier_sort_values"
+    )
+
+    def __init__(self, trial_match_sorting: List[Dict[str, Dict[str, int]]], trial_identifier: str):
+        self.dimensions = len(trial_match_sorting)
+        self.fields: List[Tuple[int, str, Dict[str, int], Union[int, None]]] = [
+            (dimension, sort_key, sorting_vals, sorting_vals.get("ANY_VALUE", None))
+            for dimension, sort_dimension in enumerate(trial_match_sorting)
+            for sort_key, sorting_vals in sort_dimension.items()
+        ]
+        self.trial_identifier = trial_identifier
+        self._identifier_sort_values: Dict[Any, List[int]] = dict()
+
+    def sort_order(self, match_document: Dict) -> List[int]:
+        sort_array = [DEFAULT_SORT_INDEX] * self.dimensions
+        get_value = match_document.get
+        for dimension, sort_key, sorting_vals, any_value in self.fields:
+            trial_match_val = get_value(sort_key, _missing)
+            if trial_match_val is _missing:
+                continue
+            if any_value is None:
+                matched_sort_int = sorting_vals.get(trial_match_val
+                                                    if trial_match_val.__class__ is str
+                                                    else str(trial_match_val), None)
+                if matched_sort_int is None:
+                    continue
+            else:
+                matched_sort_int = any_value
+            if matched_sort_int < sort_array[dimension]:
+                sort_array[dimension] = matched_sort_int
+
+        # If an idenfitifer is not a protocol id (e.g. 17-251) then skip replacing
+        identifier = match_document.get(self.trial_identifier, None)
+        if not (isinstance(identifier, ObjectId) or identifier is None):
+            sort_array.extend(self.identifier_sort_values(identifier))
+        return sort_array
+
+    def sort_orders(self, match_documents: Iterable[Dict]) -> List[List[int]]:
+        """
+        The sort_order of each of match_documents, in order
+        """
+        sort_order = self.sort_order
+        return [sort_order(match_document) for match_document in match_documents]
+
+    def identifier_sort_values(self, identifier: str) -> List[int]:
+        sort_values = self._identifier_sort_values.get(identifier, None)
+        if sort_values is None:
+            sort_values = self._identifier_sort_values[identifier] = [int(identifier.replace("-", ""))]
+        return sort_values
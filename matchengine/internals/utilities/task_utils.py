@@ -12,14 +12,17 @@ from pymongo.errors import (
     CursorNotFound,
     ServerSelectionTimeoutError)
 
+from matchengine.internals.match_translator import get_matching_match_paths
 from matchengine.internals.utilities.list_utils import chunk_list
 from matchengine.internals.typing.matchengine_types import (
     TrialMatch, IndexUpdateTask,
     MatchReason, UpdateTask,
-    RunLogUpdateTask, ClinicalID
+    RunLogUpdateTask, ClinicalID,
+    QueryTask, MatchTreeTask
 )
+from matchengine.internals.utilities.match_hash import composite_match_hash
 from matchengine.internals.utilities.object_comparison import nested_object_hash
-from matchengine.internals.utilities.utilities import get_sort_order
+from matchengine.internals.utilities.query import evaluate_match_tree, match_path_prefix_clinical_ids
 
 if TYPE_CHECKING:
     from matchengine.internals.engine import MatchEngine
@@ -100,8 +103,17 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
         log.info((f"Worker: {worker_id}, {trial_identifier}: {task.trial[trial_identifier]} got new QueryTask, "
                   f"{matchengine._task_q.qsize()} tasks left in queue"))
     try:
-        results: Dict[ClinicalID, List[MatchReason]] = await matchengine.run_query(task.query,
-                                                                                   task.clinical_ids)
+        clinical_ids = task.clinical_ids
+        if task.path_prefixes is not None and len(task.match_path.criteria_list) > 1:
+            clinical_ids = await match_path_prefix_clinical_ids(matchengine,
+                                                                task.path_prefixes,
+                                                                task.match_clause_data,
+                                                                task.match_path,
+                                                                task.query,
+                                                                clinical_ids)
+        results: Dict[ClinicalID, List[MatchReason]] = (await matchengine.run_query(task.query, clinical_ids)
+                                                        if clinical_ids
+                                                        else dict())
     except Exception as e:
         results = dict()
         log.error(f"ERROR: Worker: {worker_id}, error: {e}")
@@ -125,6 +137,7 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
         matchengine.results_transformer(results)
         if not results:
             matchengine.matches.setdefault(task.match_clause_data.protocol_no, dict())
+        trial_matches = list()
         for _, sample_results in results.items():
             for result in sample_results:
                 matchengine.queue_task_count += 1
@@ -137,21 +150,32 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
                                                 result,
                                                 matchengine.starttime)
 
-                # allow user to extend trial_match objects in plugin functions
-                # generate required fields on trial match doc before
-                # generate sort_order and hash fields after all fields are added
-                new_match_proto = matchengine.pre_process_trial_matches(match_context_data)
-                match_document = matchengine.create_trial_matches(match_context_data, new_match_proto)
-                sort_order = get_sort_order(matchengine, match_document)
-                match_document['sort_order'] = sort_order
+                trial_matches.append(match_context_data)
+
+        # allow user to extend trial_match objects in plugin functions, which may create the trial_match documents of a
+        # task in one batch (see TrialMatchDocumentCreator)
+        # generate required fields on trial match doc before, one trial match at a time
+        match_documents = matchengine.create_trial_matches_batch(trial_matches, matchengine.pre_process_trial_matches)
+
+        # generate sort_order and hash fields after all fields are added
+        sort_orders = matchengine.sort_order_evaluator.sort_orders(match_documents)
+        for match_context_data, match_document, sort_order in zip(trial_matches, match_documents, sort_orders):
+            match_document['sort_order'] = sort_order
+            if matchengine.compose_match_hashes:
+                match_document['hash'] = composite_match_hash(
+                    match_document,
+                    matchengine.get_match_hash_partial_digests(task.trial,
+                                                               match_context_data.match_reason.clinical_id),
+                    {'hash', 'is_disabled'})
+            else:
                 to_hash = {key: match_document[key] for key in match_document if key not in {'hash', 'is_disabled'}}
                 match_document['hash'] = nested_object_hash(to_hash)
-                match_document['_me_id'] = matchengine.run_id.hex
+            match_document['_me_id'] = matchengine.run_id.hex
 
-                matchengine.matches.setdefault(task.trial[trial_identifier],
-                                               dict()).setdefault(match_document['sample_id'],
-                                                                  list()).append(match_document)
-                by_sample_id[match_document['sample_id']].append(match_document)
+            matchengine.matches.setdefault(task.trial[trial_identifier],
+                                           dict()).setdefault(match_document['sample_id'],
+                                                              list()).append(match_document)
+            by_sample_id[match_document['sample_id']].append(match_document)
 
     except Exception as e:
         matchengine.loop.stop()
@@ -162,6 +186,49 @@ async def run_query_task(matchengine: MatchEngine, task, worker_id):
     matchengine.task_q.task_done()
 
 
+async def run_match_tree_task(matchengine: MatchEngine, task: MatchTreeTask, worker_id):
+    """
+    Evaluate a whole match tree at once, then queue a QueryTask for each match path which some clinical IDs match,
+    for only those clinical IDs. The queries of those QueryTasks have all been run for the clinical IDs already,
+    so they only build the match reasons and trial matches from the cache.
+    """
+    trial_identifier = matchengine.match_criteria_transform.trial_identifier
+    if matchengine.debug:
+        log.info((f"Worker: {worker_id}, {trial_identifier}: {task.trial[trial_identifier]} got new MatchTreeTask, "
+                  f"{matchengine._task_q.qsize()} tasks left in queue"))
+    try:
+        matched = await evaluate_match_tree(matchengine, task.match_tree, task.node_queries, task.clinical_ids)
+        matchengine.matches.setdefault(task.match_clause_data.protocol_no, dict())
+        for path, clinical_ids in get_matching_match_paths(task.match_tree, matched):
+            path_query = task.path_queries.get(path, None)
+            if path_query is None:
+                continue
+            match_path, query = path_query
+            matchengine.task_q.put_nowait(QueryTask(task.trial,
+                                                    task.match_clause_data,
+                                                    match_path,
+                                                    query,
+                                                    clinical_ids))
+        matchengine.task_q.task_done()
+    except Exception as e:
+        log.error(f"ERROR: Worker: {worker_id}, error: {e}")
+        log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
+        if e.__class__ is AutoReconnect:
+            matchengine.task_q.put_nowait(task)
+            matchengine.task_q.task_done()
+        elif e.__class__ is CursorNotFound:
+            matchengine.task_q.put_nowait(task)
+            matchengine.task_q.task_done()
+        elif e.__class__ is ServerSelectionTimeoutError:
+            matchengine.task_q.put_nowait(task)
+            matchengine.task_q.task_done()
+        else:
+            matchengine.loop.stop()
+            log.error(f"ERROR: Worker: {worker_id}, error: {e}")
+            log.error(f"TRACEBACK: {traceback.print_tb(e.__traceback__)}")
+            raise e
+
+
 async def run_poison_pill(matchengine: MatchEngine, task, worker_id):
     if matchengine.debug:
         log.info(f"Worker: {worker_id} got PoisonPill")
@@ -7,8 +7,6 @@ import sys
 from types import MethodType
 from typing import TYPE_CHECKING
 
-from bson import ObjectId
-
 from matchengine.internals import query_transform
 from matchengine.internals.database_connectivity.mongo_connection import MongoDBConnection
 from matchengine.internals.plugin_helpers.plugin_stub import (
@@ -90,6 +88,11 @@ def find_plugins(matchengine: MatchEngine):
                                                'results_transformer',
                                                matchengine.results_transformer),
                                        matchengine))
+                    create_trial_matches_batch = getattr(item, 'create_trial_matches_batch', None)
+                    if create_trial_matches_batch is not TrialMatchDocumentCreator.create_trial_matches_batch:
+                        setattr(matchengine,
+                                'create_trial_matches_batch',
+                                MethodType(create_trial_matches_batch, matchengine))
             elif issubclass(item, DBSecrets):
                 if item_name == matchengine.db_secrets_class:
                     if matchengine.debug:
@@ -156,30 +159,7 @@ def get_sort_order(matchengine: MatchEngine, match_document: Dict) -> list:
     14. DFCI Coordinating Center
     15. All other Coordinating centers
     16. Protocol Number
-    """
-    sort_map = matchengine.config['trial_match_sorting']
-    sort_array = list()
-
-    for sort_dimension in sort_map:
-        sort_index = 99
-        for sort_key in sort_dimension:
-            if sort_key in match_document:
-                sorting_vals = sort_dimension[sort_key]
-                is_any = sorting_vals.get("ANY_VALUE", None)
-                trial_match_val = str(match_document[sort_key]) if is_any is None else "ANY_VALUE"
-
-                if (trial_match_val is not None and trial_match_val in sorting_vals) or is_any is not None:
-                    matched_sort_int = sort_dimension[sort_key][trial_match_val]
-                    if matched_sort_int < sort_index:
-                        sort_index = matched_sort_int
 
-        sort_array.append(sort_index)
-
-    # If an idenfitifer is not a protocol id (e.g. 17-251) then skip replacing
-    identifier = match_document.get(matchengine.match_criteria_transform.trial_identifier, None)
-    if isinstance(identifier, ObjectId) or identifier is None:
-        pass
-    else:
-        sort_array.append(int(identifier.replace("-", "")))
-
-    return sort_array
+    The config is compiled once per run (see MatchEngine.sort_order_evaluator).
+    """
+    return matchengine.sort_order_evaluator.sort_order(match_document)
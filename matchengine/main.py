@@ -32,7 +32,22 @@ def main(run_args):
             drop_accept=run_args.confirm_drop,
             exit_after_drop=run_args.drop_and_exit,
             resource_dirs=run_args.extra_resource_dirs,
-            bypass_warnings=run_args.bypass_warnings
+            bypass_warnings=run_args.bypass_warnings,
+            combine_clinical_queries=run_args.combine_clinical_queries,
+            query_node_concurrency=run_args.query_node_concurrency[0],
+            in_memory_clinical_queries=run_args.in_memory_clinical_queries,
+            index_extended_attributes=run_args.index_extended_attributes,
+            plan_queries=run_args.plan_queries,
+            prefetch_queries=run_args.prefetch_queries,
+            query_cache_path=run_args.query_cache_path,
+            factorize_match_trees=run_args.factorize_match_trees,
+            share_match_path_prefixes=run_args.share_match_path_prefixes,
+            cache_compiled_plans=run_args.cache_compiled_plans,
+            plan_cache_path=run_args.plan_cache_path,
+            compile_workers=run_args.compile_workers[0],
+            memoize_query_transformers=run_args.memoize_query_transformers,
+            canonical_hashes=run_args.canonical_hashes,
+            compose_match_hashes=run_args.compose_match_hashes
     ) as me:
         me.get_matches_for_all_trials()
         if not args.dry:
@@ -122,6 +137,54 @@ if __name__ == "__main__":
                         help="Confirm you wish --drop; skips confirmation prompt")
     subp_p.add_argument("--bypass-warnings", dest="bypass_warnings", action="store_true", default=False,
                         help="Bypass warnings")
+    subp_p.add_argument("--combine-clinical-queries", dest="combine_clinical_queries", action="store_true",
+                        default=False,
+                        help="Fetch all clinical criteria of a query node in a single database round trip")
+    subp_p.add_argument("--in-memory-clinical-queries", dest="in_memory_clinical_queries", action="store_true",
+                        default=False,
+                        help="Evaluate clinical criteria against clinical documents loaded at startup where possible, "
+                             "rather than querying the database")
+    subp_p.add_argument("--index-extended-attributes", dest="index_extended_attributes", action="store_true",
+                        default=False,
+                        help="Build an in-memory index over the genomic collection at startup and answer genomic "
+                             "criteria from it where possible, rather than querying the database")
+    subp_p.add_argument("--plan-queries", dest="plan_queries", action="store_true", default=False,
+                        help="Run the most selective queries of each match path first, based on the fraction of "
+                             "patients each query matched in previous runs")
+    subp_p.add_argument("--prefetch-queries", dest="prefetch_queries", action="store_true", default=False,
+                        help="Compile every trial first and run each distinct query once for all patients, then "
+                             "match the trials from the cached results")
+    subp_p.add_argument("--query-cache", dest="query_cache_path", default=None,
+                        help="Path to a local SQLite file in which query results are kept between runs. Results "
+                             "are reused for patients whose clinical document has not been updated since")
+    subp_p.add_argument("--factorize-match-trees", dest="factorize_match_trees", action="store_true", default=False,
+                        help="Evaluate each match clause as a whole, running the query of each criterion once, and "
+                             "only build the match paths which patients actually match")
+    subp_p.add_argument("--share-match-path-prefixes", dest="share_match_path_prefixes", action="store_true",
+                        default=False,
+                        help="Find the patients matching the criteria which the match paths of a match clause share "
+                             "near the root only once, rather than once per match path")
+    subp_p.add_argument("--cache-compiled-plans", dest="cache_compiled_plans", action="store_true", default=False,
+                        help="Compile match clauses curated identically in several trials only once")
+    subp_p.add_argument("--plan-cache", dest="plan_cache_path", default=None,
+                        help="Path to a local SQLite file in which compiled trials are kept between runs. A trial is "
+                             "only compiled again once it, the config or the plugins have changed")
+    subp_p.add_argument("--memoize-query-transformers", dest="memoize_query_transformers", action="store_true",
+                        default=False,
+                        help="Transform each trial curation key/value used by several match clauses only once")
+    subp_p.add_argument("--canonical-hashes", dest="canonical_hashes", action="store_true", default=False,
+                        help="Hash trial_match documents and queries with a canonical encoding, safe for any character, "
+                             "rather than as previous matchengine versions did. Changes every hash; see "
+                             "matchengine.internals.utilities.match_hash for how to migrate existing matches")
+    subp_p.add_argument("--compose-match-hashes", dest="compose_match_hashes", action="store_true", default=False,
+                        help="With --canonical-hashes, hash trial_match documents from digests of their trial and "
+                             "clinical fields computed once per trial and patient. Changes every hash; see "
+                             "matchengine.internals.utilities.match_hash for how to migrate existing matches")
+    subp_p.add_argument("--query-node-concurrency", dest="query_node_concurrency", nargs=1, type=int, default=[4],
+                        help="Maximum number of sibling query nodes of a match path queried at the same time")
+    subp_p.add_argument("--compile-workers", dest="compile_workers", nargs=1, type=int, default=[0],
+                        help="Number of processes compiling trials ahead of matching them. By default, each trial "
+                             "is compiled just before it is matched")
     subp_p.add_argument("--workers", nargs=1, type=int, default=[cpu_count() * 5])
     subp_p.add_argument('--db', dest='db_name', default=None, required=False, help=db_name_help)
     subp_p.add_argument('--o', dest="csv_output", action="store_true", default=False, required=False,
@@ -5,11 +5,12 @@ import re
 
 from dateutil.relativedelta import relativedelta
 
-from matchengine.internals.query_transform import QueryTransformerContainer
+from matchengine.internals.query_transform import QueryTransformerContainer, cacheable
 from matchengine.internals.typing.matchengine_types import QueryTransformerResult
 
 
 class DFCIQueryTransformers(QueryTransformerContainer):
+    @cacheable
     def tmb_range_to_query(self, **kwargs):
         sample_key = kwargs['sample_key']
         trial_value = kwargs['trial_value']
@@ -26,6 +27,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
             numeric = '0' + numeric
         return QueryTransformerResult({sample_key: {operator_map[operator]: float(numeric)}}, False)
 
+    @cacheable
     def bool_from_text(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
@@ -34,6 +36,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         elif trial_value.upper() == 'FALSE':
             return QueryTransformerResult({sample_key: False}, False)
 
+    @cacheable
     def cnv_map(self, **kwargs):
         # Heterozygous deletion,
         # Gain,
@@ -57,6 +60,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         else:
             return QueryTransformerResult({sample_key: trial_value}, negate)
 
+    @cacheable
     def variant_category_map(self, **kwargs):
         trial_value = kwargs['trial_value']
         sample_key = kwargs['sample_key']
@@ -81,6 +85,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         else:
             return QueryTransformerResult({sample_key: trial_value.upper()}, negate)
 
+    @cacheable
     def wildcard_regex(self, **kwargs):
         """
         When trial curation criteria include a wildcard prefix (e.g. WILDCARD_PROTEIN_CHANGE), a extended_attributes query must
@@ -107,6 +112,7 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         return QueryTransformerResult({kwargs['sample_key']: {'$regex': re.compile(trial_value, re.IGNORECASE)}},
                                       negate)
 
+    @cacheable
     def mmr_ms_map(self, **kwargs):
         mmr_map = {
             'MMR-Proficient': 'Proficient (MMR-P / MSS)',
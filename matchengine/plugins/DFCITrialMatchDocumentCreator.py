@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import operator
 from itertools import chain
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Callable, List
 
 from matchengine.internals.plugin_helpers.plugin_stub import TrialMatchDocumentCreator
 
@@ -126,7 +126,6 @@ def get_clinical_details(clinical_doc, query):
     if all((q_tmb, c_tmb)):
         alteration.append(f"TMB = {c_tmb}")
         match_type = "tmb"
-        clinical_doc.update({'variant_category': 'TMB'})
     else:
         match_type = "generic_clinical"
 
@@ -232,30 +231,71 @@ class DFCITrialMatchDocumentCreator(TrialMatchDocumentCreator):
         Create a trial match document to be inserted into the db. Add clinical, extended_attributes, and trial details as specified
         in config.json
         """
-        query = trial_match.match_reason.extract_raw_query()
-        clinical_doc = self.cache.docs[trial_match.match_reason.clinical_id]
-        new_trial_match.update({'cancer_type_match': get_cancer_type_match(trial_match)})
-
-        if trial_match.match_reason.reason_name == 'genomic':
-            genomic_doc = self.cache.docs.setdefault(trial_match.match_reason.reference_id, None)
-            if genomic_doc is None:
-                new_trial_match.update(format_trial_match_k_v(format_exclusion_match(trial_match)))
-            else:
-                new_trial_match.update(
-                    format_trial_match_k_v(get_genomic_details(genomic_doc, trial_match)))
-        elif trial_match.match_reason.reason_name == 'prior_treatments':
-            prior_treatments_doc = self.cache.docs[trial_match.match_reason.genomic_id]
-            new_trial_match.update({"prior_treatment_id": trial_match.match_reason.genomic_id})
-            new_trial_match.update(
-                {k: v for k, v in prior_treatments_doc.items() if
-                 not k.startswith('_')})
-        elif trial_match.match_reason.reason_name == 'clinical':
-            new_trial_match.update(
-                format_trial_match_k_v(get_clinical_details(clinical_doc, query)))
+        return create_trial_match(self, trial_match, new_trial_match, get_cancer_type_match(trial_match), dict())
 
-        new_trial_match.pop("_updated", None)
-        new_trial_match.pop("last_updated", None)
-        return new_trial_match
+    def create_trial_matches_batch(self,
+                                   trial_matches: List[TrialMatch],
+                                   pre_process_trial_matches: Callable[[TrialMatch], Dict]) -> List[Dict]:
+        """
+        create_trial_matches for the trial matches of a query task, computing the cancer type match once per match
+        criterion, and the alteration of exclusion matches once per query node
+        """
+        cancer_type_matches = dict()
+        exclusion_matches = dict()
+        trial_match_documents = list()
+        for trial_match in trial_matches:
+            # match criteria are referenced by the trial matches for the whole batch, so their ids are unique
+            cancer_type_match = cancer_type_matches.get(id(trial_match.match_criterion), None)
+            if cancer_type_match is None:
+                cancer_type_match = cancer_type_matches[id(trial_match.match_criterion)] = get_cancer_type_match(
+                    trial_match)
+            new_trial_match = pre_process_trial_matches(trial_match)
+            trial_match_documents.append(
+                create_trial_match(self, trial_match, new_trial_match, cancer_type_match, exclusion_matches))
+        return trial_match_documents
+
+
+def create_trial_match(matchengine: MatchEngine,
+                       trial_match: TrialMatch,
+                       new_trial_match: Dict,
+                       cancer_type_match: str,
+                       exclusion_matches: Dict[int, Dict]) -> Dict:
+    """
+    DFCITrialMatchDocumentCreator.create_trial_matches, given the cancer type match of the trial match, and the
+    formatted exclusion matches of query nodes (by id) already computed
+    """
+    query = trial_match.match_reason.extract_raw_query()
+    clinical_doc = matchengine.cache.docs[trial_match.match_reason.clinical_id]
+    new_trial_match.update({'cancer_type_match': cancer_type_match})
+
+    if trial_match.match_reason.reason_name == 'genomic':
+        genomic_doc = matchengine.cache.docs.setdefault(trial_match.match_reason.reference_id, None)
+        if genomic_doc is None:
+            query_node = trial_match.match_reason.query_node
+            exclusion_match = exclusion_matches.get(id(query_node), None)
+            if exclusion_match is None:
+                exclusion_match = exclusion_matches[id(query_node)] = format_trial_match_k_v(
+                    format_exclusion_match(trial_match))
+            new_trial_match.update(exclusion_match)
+        else:
+            new_trial_match.update(
+                format_trial_match_k_v(get_genomic_details(genomic_doc, trial_match)))
+    elif trial_match.match_reason.reason_name == 'prior_treatments':
+        prior_treatments_doc = matchengine.cache.docs[trial_match.match_reason.genomic_id]
+        new_trial_match.update({"prior_treatment_id": trial_match.match_reason.genomic_id})
+        new_trial_match.update(
+            {k: v for k, v in prior_treatments_doc.items() if
+             not k.startswith('_')})
+    elif trial_match.match_reason.reason_name == 'clinical':
+        clinical_details = get_clinical_details(clinical_doc, query)
+        new_trial_match.update(format_trial_match_k_v(clinical_details))
+        if clinical_details['match_type'] == 'tmb':
+            # set on the trial_match document, the cached clinical document is shared by every match of the patient
+            new_trial_match['variant_category'] = 'TMB'
+
+    new_trial_match.pop("_updated", None)
+    new_trial_match.pop("last_updated", None)
+    return new_trial_match
 
 
 __export__ = ["DFCITrialMatchDocumentCreator"]
@@ -0,0 +1,71 @@
+"""
+trial_match documents for benchmarks, built the way MatchEngine.pre_process_trial_matches and
+DFCITrialMatchDocumentCreator.create_trial_matches build them, from the integration test clinical and genomic data
+and an integration test trial.
+"""
+import gzip
+import json
+import os
+from itertools import islice
+
+import bson
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def load_documents(collection: str, limit: int = None):
+    with gzip.open(os.path.join(DATA_DIR, 'integration_data', f'{collection}.bson.gz')) as file_handle:
+        return list(islice(bson.decode_file_iter(file_handle), limit))
+
+
+def lower_keys(doc):
+    return {key.lower(): val for key, val in doc.items() if key != "_id"}
+
+
+def load_trial_match_documents(limit: int = 1000, trial: str = 'structured_sv'):
+    return [trial_match_document for trial_match_document, _, _ in load_trial_match_sections(limit, trial)]
+
+
+def load_trial_match_sections(limit: int = 1000, trial: str = 'structured_sv'):
+    """
+    trial_match documents, with the trial and (lowercased) clinical document their fields were copied from
+    """
+    with open(os.path.join(DATA_DIR, 'integration_trials', f'{trial}.json')) as file_handle:
+        trial = json.load(file_handle)
+    clinical_docs = {clinical_doc['_id']: clinical_doc for clinical_doc in load_documents('clinical')}
+    clinical_sections = dict()
+    trial_match_sections = list()
+    for genomic_doc in load_documents('genomic', limit):
+        clinical_doc = clinical_docs[genomic_doc['CLINICAL_ID']]
+        clinical_section = clinical_sections.setdefault(clinical_doc['_id'], lower_keys(clinical_doc))
+        trial_match_document = dict(clinical_section)
+        trial_match_document.update({
+            'clinical_id': clinical_doc['_id'],
+            'match_level': 'step',
+            'internal_id': 1234,
+            'reason_type': 'genomic',
+            'q_depth': 2,
+            'q_width': 1,
+            'code': '1',
+            'trial_curation_level_status': 'open',
+            'trial_summary_status': 'open to accrual',
+            'coordinating_center': 'Dana-Farber Cancer Institute',
+            'show_in_ui': True,
+            'query_hash': 'bc4a4fed5b9c1ed3a3e9ff5f5e2d60d6eb6a7b0c'
+        })
+        trial_match_document.update({k: v
+                                     for k, v in trial.items()
+                                     if k not in {'treatment_list', '_summary', 'status', '_elasticsearch', 'match'}})
+        trial_match_document.update({
+            'match_path': 'treatment_list.step.0.match.0',
+            'combo_coord': '4e1a3bb2bd4c10d9c93b6d2f5f7f5a9a0a1c1e9e',
+            'is_disabled': False,
+            'cancer_type_match': 'specific',
+            'match_type': 'gene',
+            'genomic_alteration': genomic_doc.get('TRUE_HUGO_SYMBOL', None),
+            'genomic_id': genomic_doc['_id']
+        })
+        trial_match_document.update(lower_keys(genomic_doc))
+        trial_match_document['sort_order'] = [0, 2, 1, 99, 99, -1]
+        trial_match_sections.append((trial_match_document, trial, clinical_section))
+    return trial_match_sections
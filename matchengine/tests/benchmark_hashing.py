@@ -0,0 +1,48 @@
+"""
+Per-call cost of hashing trial_match documents: nested_object_hash with the canonical encoding and with legacy
+hashing, and composite hashes reusing the digests of the trial and clinical fields of each document.
+
+Run with: python -m matchengine.tests.benchmark_hashing
+"""
+import timeit
+
+from matchengine.internals.utilities.match_hash import PartialDigest, composite_match_hash
+from matchengine.internals.utilities.object_comparison import (
+    canonical_digest,
+    legacy_nested_object_hash
+)
+from matchengine.tests.benchmark_data import load_trial_match_sections
+
+
+def benchmark(trial_match_sections, repeat: int = 5):
+    documents = [document for document, _, _ in trial_match_sections]
+    partial_digests = dict()
+
+    def composite_hashes():
+        for document, trial, clinical_section in trial_match_sections:
+            sections = (partial_digests.setdefault(id(trial), PartialDigest(trial)),
+                        partial_digests.setdefault(id(clinical_section), PartialDigest(clinical_section)))
+            composite_match_hash(document, sections, set())
+
+    hash_functions = (('legacy', lambda: [legacy_nested_object_hash(document) for document in documents]),
+                      ('canonical', lambda: [canonical_digest(document).hex() for document in documents]),
+                      ('composite', composite_hashes))
+    results = dict()
+    for name, hash_documents in hash_functions:
+        partial_digests.clear()
+        # the first repetition includes the cost of computing the digests of each trial and clinical section
+        results[name] = min(timeit.repeat(hash_documents, number=1, repeat=repeat)) / len(documents)
+    return results
+
+
+def main():
+    trial_match_sections = load_trial_match_sections()
+    results = benchmark(trial_match_sections)
+    print(f"{len(trial_match_sections)} trial_match documents")
+    for name, seconds in results.items():
+        print(f"{name:>10}: {seconds * 1e6:8.2f} us per document "
+              f"({results['legacy'] / seconds:.2f}x legacy)")
+
+
+if __name__ == '__main__':
+    main()
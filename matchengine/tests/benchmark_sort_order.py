@@ -0,0 +1,70 @@
+"""
+Per-document cost of computing the sort_order of trial_match documents: walking the trial_match_sorting config for
+each document (as utilities.get_sort_order did), and with the config compiled once by SortOrderEvaluator, one document
+at a time and in a batch.
+
+Run with: python -m matchengine.tests.benchmark_sort_order
+"""
+import json
+import os
+import timeit
+
+from bson import ObjectId
+
+from matchengine.internals.utilities.sort_order import SortOrderEvaluator
+from matchengine.tests.benchmark_data import DATA_DIR, load_trial_match_documents
+
+
+def walk_sort_config(sort_map, trial_identifier, match_document):
+    sort_array = list()
+    for sort_dimension in sort_map:
+        sort_index = 99
+        for sort_key in sort_dimension:
+            if sort_key in match_document:
+                sorting_vals = sort_dimension[sort_key]
+                is_any = sorting_vals.get("ANY_VALUE", None)
+                trial_match_val = str(match_document[sort_key]) if is_any is None else "ANY_VALUE"
+
+                if (trial_match_val is not None and trial_match_val in sorting_vals) or is_any is not None:
+                    matched_sort_int = sort_dimension[sort_key][trial_match_val]
+                    if matched_sort_int < sort_index:
+                        sort_index = matched_sort_int
+
+        sort_array.append(sort_index)
+
+    identifier = match_document.get(trial_identifier, None)
+    if isinstance(identifier, ObjectId) or identifier is None:
+        pass
+    else:
+        sort_array.append(int(identifier.replace("-", "")))
+
+    return sort_array
+
+
+def benchmark(sort_map, trial_identifier, documents, repeat: int = 5):
+    evaluator = SortOrderEvaluator(sort_map, trial_identifier)
+    expected = [walk_sort_config(sort_map, trial_identifier, document) for document in documents]
+    assert evaluator.sort_orders(documents) == expected
+    assert [evaluator.sort_order(document) for document in documents] == expected
+
+    sort_functions = (('config walk', lambda: [walk_sort_config(sort_map, trial_identifier, document)
+                                               for document in documents]),
+                      ('compiled', lambda: [evaluator.sort_order(document) for document in documents]),
+                      ('batch', lambda: evaluator.sort_orders(documents)))
+    return {name: min(timeit.repeat(sort_documents, number=1, repeat=repeat)) / len(documents)
+            for name, sort_documents in sort_functions}
+
+
+def main():
+    with open(os.path.join(os.path.dirname(DATA_DIR), 'config.json')) as file_handle:
+        config = json.load(file_handle)
+    documents = load_trial_match_documents()
+    results = benchmark(config['trial_match_sorting'], config.get('trial_identifier', 'protocol_no'), documents)
+    print(f"{len(documents)} trial_match documents")
+    for name, seconds in results.items():
+        print(f"{name:>12}: {seconds * 1e6:8.2f} us per document "
+              f"({results['config walk'] / seconds:.2f}x config walk)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,42 @@
+import asyncio
+import datetime
 import glob
 import json
 import os
+import pickle
+import re
+import tempfile
 from unittest import TestCase
 
+from bson import ObjectId
+
 from matchengine.internals.engine import MatchEngine
 from matchengine.internals.match_criteria_transform import MatchCriteriaTransform
+from matchengine.internals.query_transform import QueryTransformerContainer, cacheable, \
+    attach_transformers_to_match_criteria_transform
 from matchengine.internals.match_translator import create_match_tree, get_match_paths, extract_match_clauses_from_trial, \
-    translate_match_path
-from matchengine.internals.typing.matchengine_types import MatchClause, MatchCriteria, MatchCriterion
-from matchengine.internals.typing.matchengine_types import MatchClauseData, ParentPath, MatchClauseLevel
-from matchengine.internals.utilities.object_comparison import nested_object_hash
+    translate_match_path, get_matching_match_paths, get_node_paths, translate_match_tree, translate_match_tree_paths
+from matchengine.internals.typing.matchengine_types import MatchClause, MatchCriteria, MatchCriterion, Cache
+from matchengine.internals.typing.matchengine_types import MatchClauseData, ParentPath, MatchClauseLevel, MatchTree
+from matchengine.internals.typing.matchengine_types import ClinicalMatchReason, TrialMatch
+from matchengine.internals.typing.matchengine_types import (MultiCollectionQuery, QueryNode, QueryNodeContainer,
+                                                            QueryPart, QueryTransformerResult)
+from matchengine.internals.utilities.age_eligibility import BirthDateIndex
+from matchengine.internals.utilities.clinical_id_set import ClinicalIDIndex
+from matchengine.internals.utilities import parallel_compilation
+from matchengine.internals.utilities.in_memory_query import InMemoryClinicalEvaluator, ExtendedAttributeIndex
+from matchengine.internals.utilities.match_hash import PartialDigest, composite_match_hash
+from matchengine.internals.utilities.object_comparison import nested_object_hash, legacy_nested_object_hash, \
+    set_legacy_hashing
+from matchengine.internals.utilities.persistent_cache import PersistentQueryCache
+from matchengine.internals.utilities.plan_cache import PlanCache, PersistentPlanCache, plan_fingerprint
+from matchengine.internals.utilities.query import gather_bounded, match_path_node_query, \
+    match_path_prefix_clinical_ids
+from matchengine.internals.utilities.query_planner import QueryPlanner
+from matchengine.internals.utilities.run_log import ClinicalUpdateIndex
+from matchengine.internals.utilities.sort_order import SortOrderEvaluator
 from matchengine.internals.utilities.utilities import find_plugins
+from matchengine.plugins.DFCITrialMatchDocumentCreator import DFCITrialMatchDocumentCreator
 
 
 class TestMatchEngine(TestCase):
@@ -30,6 +56,29 @@ class TestMatchEngine(TestCase):
         self.me.match_criteria_transform = MatchCriteriaTransform(self.config,
                                                                   [os.path.join(os.path.dirname(__file__), 'data')])
 
+    def tearDown(self) -> None:
+        parallel_compilation._compiler = None
+
+    def compiler_settings(self):
+        """compiler settings of a MatchEngine with the DFCI config and plugins"""
+        me = MatchEngine.__new__(MatchEngine)
+        with open('matchengine/config/dfci_config.json') as config_file_handle:
+            me.config = json.load(config_file_handle)
+        me.resource_dirs = [os.path.join(os.path.dirname(os.path.dirname(__file__)), 'ref')]
+        me.plugin_dir = 'matchengine/plugins'
+        me.match_document_creator_class = 'DFCITrialMatchDocumentCreator'
+        me.query_node_transformer_class = 'DFCIQueryNodeTransformer'
+        me.query_node_container_transformer_class = 'DFCIQueryContainerTransformer'
+        me.query_node_subsetter_class = 'DFCIQueryNodeClinicalIDSubsetter'
+        me.match_on_closed = False
+        me.factorize_match_trees = False
+        me.memoize_query_transformers = False
+        me.canonical_hashes = False
+        me.debug = False
+        me.fig_dir = None
+        me.plan_cache = None
+        return me.get_compiler_settings()
+
     def test_find_plugins(self):
         """Verify functions inside external config files are reachable within the Matchengine class"""
         old_create_trial_matches = self.me.create_trial_matches
@@ -169,6 +218,52 @@ class TestMatchEngine(TestCase):
                         assert nested_object_hash(inner_test_case_criteria) == nested_object_hash(
                             inner_match_path_criteria)
 
+    def test_get_matching_match_paths(self):
+        clinical_id_index = ClinicalIDIndex(range(4))
+        for file in glob.glob('./matchengine/tests/data/ctml_boolean_cases/*.json'):
+            with open(file) as f:
+                me_trial = [json.load(f)]
+            match_tree = create_match_tree(self.me, MatchClauseData(match_clause=me_trial,
+                                                                    internal_id='123',
+                                                                    code='456',
+                                                                    coordinating_center='The Death Star',
+                                                                    status='Open to Accrual',
+                                                                    parent_path=ParentPath(()),
+                                                                    match_clause_level=MatchClauseLevel('arm'),
+                                                                    match_clause_additional_attributes={},
+                                                                    is_suspended=True,
+                                                                    protocol_no='12-345'))
+            order = match_tree.topological_order()
+            assert sorted(order) == sorted(match_tree.nodes)
+            assert all(order.index(parent) < order.index(child) for parent, child in match_tree.edges)
+
+            # every path reaches each node at one of the depths of the node
+            depths = match_tree.depths()
+            for path in get_node_paths(match_tree):
+                assert all(depth in depths[node] for depth, node in enumerate(path))
+
+            # if every node is matched by every clinical id, every match path is
+            everyone = {(node, depth): clinical_id_index.to_set(range(4))
+                        for node, node_depths in depths.items()
+                        for depth in node_depths}
+            matching_paths = list(get_matching_match_paths(match_tree, everyone))
+            assert sorted(path for path, _ in matching_paths) == sorted(
+                tuple(path) for path in get_node_paths(match_tree))
+            assert all(clinical_ids == {0, 1, 2, 3} for _, clinical_ids in matching_paths)
+
+            # clinical ids of each leaf only match the paths through that leaf
+            leaves = [node for node, degree in match_tree.out_degree if not degree]
+            matched = dict(everyone)
+            for depth in depths[leaves[0]]:
+                matched[(leaves[0], depth)] = clinical_id_index.to_set([1])
+            for leaf in leaves[1:]:
+                for depth in depths[leaf]:
+                    matched[(leaf, depth)] = clinical_id_index.empty_set()
+            for path, clinical_ids in get_matching_match_paths(match_tree, matched):
+                assert path[-1] == leaves[0] and clinical_ids == {1}
+            matched[(0, 0)] = clinical_id_index.empty_set()
+            assert not list(get_matching_match_paths(match_tree, matched))
+
     def test_translate_match_path(self):
         self.me.trials = dict()
         find_plugins(self.me)
@@ -187,6 +282,298 @@ class TestMatchEngine(TestCase):
         assert len(match_paths.clinical) == 0
         assert len(match_paths.extended_attributes) == 0
 
+    def test_translate_match_tree(self):
+        self.me.trials = dict()
+        find_plugins(self.me)
+        match_clause_data = MatchClauseData(match_clause=MatchClause([{}]),
+                                            internal_id='123',
+                                            code='456',
+                                            coordinating_center='The Death Star',
+                                            status='Open to Accrual',
+                                            parent_path=ParentPath(()),
+                                            match_clause_level=MatchClauseLevel('arm'),
+                                            match_clause_additional_attributes={},
+                                            protocol_no='12-345',
+                                            is_suspended=True)
+        # node 3 is reached at depth 2 through node 1, and at depth 3 through nodes 1 and 2
+        match_tree = MatchTree()
+        criteria = {0: [{'clinical': {'age_numerical': '>=18'}}],
+                    1: [{'genomic': {'hugo_symbol': 'BRAF'}}],
+                    2: [{'genomic': {'hugo_symbol': 'KRAS'}}],
+                    3: [{'genomic': {'protein_change': 'p.V600E'}}]}
+        for parent_id, child_id in [(0, 1), (1, 2), (1, 3), (2, 3)]:
+            match_tree.add_edge(parent_id, child_id)
+        for node_id, criteria_list in criteria.items():
+            match_tree.nodes[node_id]['criteria_list'] = criteria_list
+        assert match_tree.depths() == {0: [0], 1: [1], 2: [2], 3: [2, 3]}
+
+        node_queries = translate_match_tree(self.me, match_clause_data, match_tree)
+        assert sorted(node_queries) == [(0, 0), (1, 1), (2, 2), (3, 2), (3, 3)]
+        node_query_hashes = {query_node.hash()
+                             for node_query in node_queries.values()
+                             for query_node_container in node_query.clinical + node_query.extended_attributes
+                             for query_node in query_node_container.query_nodes}
+
+        # the query nodes of each match path are those of its nodes, at their depths along the path
+        path_queries = translate_match_tree_paths(self.me, match_clause_data, match_tree)
+        assert sorted(path_queries) == [(0, 1, 2, 3), (0, 1, 3)]
+        for match_path, query in path_queries.values():
+            for query_node_container in query.clinical + query.extended_attributes:
+                for query_node in query_node_container.query_nodes:
+                    assert query_node.hash() in node_query_hashes
+
+    def test_match_path_prefix_clinical_ids(self):
+        clinical_id_index = ClinicalIDIndex(range(4))
+        clinical_nodes = [QueryNode('clinical', node_id, None, 0, [QueryPart({'field': node_id}, False, True, False)])
+                          for node_id in (0, 2)]
+        genomic_node = QueryNode('genomic', 1, None, 1, [QueryPart({'variant': 1}, False, True, False)])
+        mcq = MultiCollectionQuery([QueryNodeContainer([genomic_node]), QueryNodeContainer(list())],
+                                   [QueryNodeContainer([query_node]) for query_node in clinical_nodes])
+        node_query = match_path_node_query(mcq, 1)
+        assert node_query.extended_attributes[0].query_nodes == [genomic_node] and not node_query.clinical
+        assert [qnc.query_nodes[0].node_id for qnc in match_path_node_query(mcq, 2).clinical] == [2]
+
+        loop = asyncio.new_event_loop()
+        match_clause_data = MatchClauseData(match_clause=MatchClause([{}]),
+                                            internal_id='123',
+                                            code='456',
+                                            coordinating_center='The Death Star',
+                                            status='Open to Accrual',
+                                            parent_path=ParentPath(()),
+                                            match_clause_level=MatchClauseLevel('arm'),
+                                            match_clause_additional_attributes={},
+                                            protocol_no='12-345',
+                                            is_suspended=True)
+        match_path = MatchCriterion([MatchCriteria({}, depth, node_id) for depth, node_id in enumerate((0, 1, 2))])
+
+        # prefixes computed by other match paths of the clause are reused rather than queried again
+        path_prefixes = dict()
+        for prefix, clinical_ids in (((0,), {0, 1, 2}), ((0, 1), {1, 2})):
+            future = path_prefixes[(id(match_clause_data), prefix)] = loop.create_future()
+            future.set_result(clinical_id_index.to_set(clinical_ids))
+        assert loop.run_until_complete(match_path_prefix_clinical_ids(self.me,
+                                                                      path_prefixes,
+                                                                      match_clause_data,
+                                                                      match_path,
+                                                                      mcq,
+                                                                      clinical_id_index.to_set(range(4)))) == {1, 2}
+        loop.close()
+
+    def test_plan_cache(self):
+        def match_clause_data(match_clause, parent_path=('treatment_list', 'step', 0, 'arm', 0, 'match')):
+            return MatchClauseData(match_clause=match_clause,
+                                   internal_id='123',
+                                   code='456',
+                                   coordinating_center='The Death Star',
+                                   status='Open to Accrual',
+                                   parent_path=ParentPath(parent_path),
+                                   match_clause_level=MatchClauseLevel('arm'),
+                                   match_clause_additional_attributes={},
+                                   protocol_no='12-345',
+                                   is_suspended=True)
+
+        plugin_dir = os.path.join(os.path.dirname(__file__), 'plugins')
+        fingerprint = plan_fingerprint(self.config, {'factorize_match_trees': False}, [plugin_dir])
+        assert fingerprint == plan_fingerprint(self.config, {'factorize_match_trees': False}, [plugin_dir])
+        assert fingerprint != plan_fingerprint(self.config, {'factorize_match_trees': True}, [plugin_dir])
+        plan_cache = PlanCache(fingerprint)
+        braf_and_age = [{'and': [{'genomic': {'hugo_symbol': 'BRAF'}}, {'clinical': {'age_numerical': '>=18'}}]}]
+        age_and_braf = [{'and': [{'clinical': {'age_numerical': '>=18'}}, {'genomic': {'hugo_symbol': 'BRAF'}}]}]
+        key = plan_cache.key(match_clause_data(braf_and_age))
+        assert plan_cache.get(key) is None
+        plan_cache.put(key, ([], {'>=18'}))
+        assert plan_cache.get(plan_cache.key(match_clause_data(json.loads(json.dumps(braf_and_age))))) == (
+            [], {'>=18'})
+        # the order of criteria and the parent path are part of the key
+        assert plan_cache.get(plan_cache.key(match_clause_data(age_and_braf))) is None
+        assert plan_cache.get(plan_cache.key(match_clause_data(braf_and_age, ('match',)))) is None
+        assert PlanCache(fingerprint + '0').key(match_clause_data(braf_and_age)) != key
+        assert (plan_cache.hits, plan_cache.misses) == (1, 3) and plan_cache.hit_rate() == 0.25
+
+    def test_persistent_plan_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(cache_dir.name, 'plan_cache.sqlite')
+        first_update = datetime.datetime(2020, 1, 1)
+        self.me.match_on_closed = False
+        with open('./matchengine/tests/data/trials/11-111.json') as f:
+            self.me.trials = {'11-111': json.load(f)}
+        match_clause_data = next(extract_match_clauses_from_trial(self.me, '11-111'))
+        query_node = QueryNode('clinical', 1, None, 0, [QueryPart({'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Melanoma'},
+                                                                  False, True, False)])
+        query_node.finalize()
+        query = MultiCollectionQuery(list(), [QueryNodeContainer([query_node])])
+        tasks = [(match_clause_data, match_path, query)
+                 for match_path in get_match_paths(create_match_tree(self.me, match_clause_data))]
+        assert tasks
+
+        persistent = PersistentPlanCache(path, 'fingerprint')
+        persistent.record('11-111', first_update, (tasks, {'>=18'}))
+        persistent.record('67-890', None, (tasks, set()))
+        persistent.close()
+
+        persistent = PersistentPlanCache(path, 'fingerprint')
+        loaded_tasks, age_criteria = persistent.load('11-111', first_update)
+        assert age_criteria == {'>=18'}
+        for (_, match_path, query), (loaded_data, loaded_path, loaded_query) in zip(tasks, loaded_tasks):
+            assert loaded_data.match_clause == match_clause_data.match_clause
+            assert loaded_path.hash() == match_path.hash()
+            assert ([query_node.hash() for qnc in loaded_query.clinical for query_node in qnc.query_nodes]
+                    == [query_node.hash() for qnc in query.clinical for query_node in qnc.query_nodes])
+        # trials updated since, without an _updated field, or compiled with a different fingerprint are compiled again
+        assert persistent.load('11-111', datetime.datetime(2020, 2, 1)) is None
+        assert persistent.load('67-890', None) is None
+        assert (persistent.hits, persistent.misses) == (1, 2)
+        persistent.close()
+        assert PersistentPlanCache(path, 'other fingerprint').load('11-111', first_update) is None
+        cache_dir.cleanup()
+
+    def test_birth_date_index(self):
+        find_plugins(self.me)
+        age_range_to_date_query = getattr(self.me.match_criteria_transform.query_transformers,
+                                          'age_range_to_date_int_query')
+        then = datetime.date(2019, 6, 15)
+        now = datetime.date(2020, 6, 15)
+        birth_dates = {clinical_id: int((now - datetime.timedelta(days=clinical_id * 30)).strftime('%Y%m%d'))
+                       for clinical_id in range(0, 365 * 25 // 30)}
+        birth_dates['no birth date'] = None
+        birth_date_index = BirthDateIndex(birth_dates, age_range_to_date_query)
+        age_criterion = {'>=18', '<=.5', '==1'}
+        expected = set()
+        for clinical_id, birth_date in birth_dates.items():
+            for age_criteria in age_criterion:
+                at_run = age_range_to_date_query(sample_key=None, trial_value=age_criteria, compare_date=then)
+                today = age_range_to_date_query(sample_key=None, trial_value=age_criteria, compare_date=now)
+                ((operator, at_run_value),) = at_run.results[0].query[None].items()
+                ((_, today_value),) = today.results[0].query[None].items()
+                if birth_date is not None and ({'$gte': birth_date >= at_run_value,
+                                                '$lte': birth_date <= at_run_value,
+                                                '$eq': birth_date == at_run_value}[operator]
+                                               != {'$gte': birth_date >= today_value,
+                                                   '$lte': birth_date <= today_value,
+                                                   '$eq': birth_date == today_value}[operator]):
+                    expected.add(clinical_id)
+        assert expected
+        assert birth_date_index.changed_eligibility(age_criterion, then, now) == expected
+        assert birth_date_index.changed_eligibility(['>=18'], then, then) == set()
+
+    def test_clinical_update_index(self):
+        updated = datetime.datetime(2020, 1, 2)
+        clinical_update_mapping = {1: None, 2: updated - datetime.timedelta(days=1), 3: updated,
+                                   4: updated + datetime.timedelta(days=1), 5: updated}
+        clinical_update_index = ClinicalUpdateIndex(clinical_update_mapping)
+        assert clinical_update_index.never_updated == {1}
+        assert clinical_update_index.updated_since(updated) == {4}
+        assert clinical_update_index.updated_since(updated - datetime.timedelta(days=2)) == {2, 3, 4, 5}
+
+        self.me.ignore_run_log = False
+        self.me.match_on_closed = False
+        self.me.match_on_deceased = False
+        self.me.clinical_ids = {1, 2, 3, 4}
+        self.me.clinical_deceased = {5}
+        self.me.clinical_update_mapping = clinical_update_mapping
+        self.me.clinical_update_index = clinical_update_index
+        self.me.get_newly_qualifying_patients = lambda run_log, age_criterion, clinical_ids: set()
+        self.me._clinical_ids_for_protocol_cache = dict()
+        self.me._run_log_history = {
+            '12-345': [{'_created': updated,
+                        'clinical_ids': {'list': [2, 3, 4]},
+                        'run_params': {'match_on_deceased': False, 'match_on_closed': False}}]
+        }
+        self.me._clinical_ids_for_run_log_signature = dict()
+        self.me._run_log_history['67-890'] = [dict(self.me._run_log_history['12-345'][0])]
+        self.me._run_log_history['67-890'][0]['clinical_ids'] = {'list': [4, 3, 2]}
+        # 1 was never updated, 4 was updated since the last run
+        assert self.me.get_clinical_ids_for_protocol('12-345', set()) == {1, 4}
+        # protocols with the same run history share the result
+        assert self.me.get_clinical_ids_for_protocol('67-890', set()) is self.me.get_clinical_ids_for_protocol(
+            '12-345', set())
+        assert len(self.me._clinical_ids_for_run_log_signature) == 1
+
+    def test_parallel_compilation(self):
+        with open('./matchengine/tests/data/trials/11-111.json') as f:
+            trial = json.load(f)
+        settings = self.compiler_settings()
+        # compiled trials are sent back from worker processes, so must survive pickling
+        parallel_compilation.init_compiler(settings)
+        tasks, age_criteria = pickle.loads(pickle.dumps(parallel_compilation.compile_trial('11-111', trial)))
+        assert tasks and not age_criteria
+        for match_clause_data, match_path, query in tasks:
+            assert match_clause_data.protocol_no == '11-111'
+            assert match_path.criteria_list
+            assert all(query_node.is_finalized
+                       for query_node_container in query.clinical + query.extended_attributes
+                       for query_node in query_node_container.query_nodes)
+
+    def test_compile_pool(self):
+        with open('./matchengine/tests/data/trials/11-111.json') as f:
+            trial = json.load(f)
+        settings = self.compiler_settings()
+
+        def compiled(result):
+            tasks, age_criteria = result
+            return [(match_clause_data.protocol_no,
+                     match_clause_data.parent_path,
+                     match_path.hash(),
+                     [query_node.hash()
+                      for query_node_container in query.clinical + query.extended_attributes
+                      for query_node in query_node_container.query_nodes])
+                    for match_clause_data, match_path, query in tasks], age_criteria
+
+        # a spawned worker process loads the plugins from the settings, and sends back the same compiled trial
+        compile_pool = parallel_compilation.create_compile_pool(1, settings)
+        try:
+            pooled = compile_pool.submit(parallel_compilation.compile_trial, '11-111', trial).result(timeout=120)
+        finally:
+            compile_pool.shutdown()
+        parallel_compilation.init_compiler(settings)
+        in_process = parallel_compilation.compile_trial('11-111', trial)
+        assert compiled(pooled) == compiled(in_process)
+        assert compiled(pooled)[0]
+
+    def test_query_transformer_memo(self):
+        with open('./matchengine/tests/data/trials/11-111.json') as f:
+            trial = json.load(f)
+        settings = self.compiler_settings()
+
+        def query_hashes(tasks):
+            return [[query_node.hash()
+                     for query_node_container in query.clinical + query.extended_attributes
+                     for query_node in query_node_container.query_nodes]
+                    for _, _, query in tasks]
+
+        parallel_compilation.init_compiler(settings)
+        expected = query_hashes(parallel_compilation.compile_trial('11-111', trial)[0])
+        settings['memoize_query_transformers'] = True
+        parallel_compilation.init_compiler(settings)
+        memo = parallel_compilation._compiler.match_criteria_transform.query_transformer_memo
+        assert query_hashes(parallel_compilation.compile_trial('11-111', trial)[0]) == expected
+        misses = memo.misses
+        # the second compilation is entirely memoized, and unaffected by query node transforms of the first
+        assert query_hashes(parallel_compilation.compile_trial('11-111', trial)[0]) == expected
+        assert memo.misses == misses and memo.hits >= misses > 0
+
+        class TestTransformers(QueryTransformerContainer):
+            def default(self, **kwargs):
+                return QueryTransformerResult({kwargs['sample_key']: kwargs['trial_value']}, False)
+
+            @cacheable
+            def declared(self, **kwargs):
+                return QueryTransformerResult({kwargs['sample_key']: kwargs['trial_value']}, False)
+
+        # transformers are only memoized once declared cacheable
+        match_criteria_transform = parallel_compilation._compiler.match_criteria_transform
+        attach_transformers_to_match_criteria_transform(match_criteria_transform, TestTransformers)
+        assert match_criteria_transform.cacheable_transformers['nomap']
+        assert match_criteria_transform.cacheable_transformers['tmb_range_to_query']
+        assert not match_criteria_transform.cacheable_transformers['default']
+        assert match_criteria_transform.cacheable_transformers['declared']
+
+        # equal trial values of different classes are memoized separately
+        transform_args = {'sample_key': 'KEY', 'trial_path': 'clinical', 'trial_key': 'key'}
+        results = [memo.transform(match_criteria_transform, 'declared', dict(transform_args, trial_value=trial_value))
+                   for trial_value in (1, True, 1.0)]
+        assert [result.results[0].query['KEY'].__class__ for result in results] == [int, bool, float]
+
     def test_comparable_dict(self):
         assert nested_object_hash({}) == nested_object_hash({})
         assert nested_object_hash({"1": "1",
@@ -219,3 +606,374 @@ class TestMatchEngine(TestCase):
             },
             "4": [9, 8]
         })
+
+    def test_canonical_hashing(self):
+        # legacy hashing (the default) reproduces the digests of previous versions
+        legacy_digest = '6d28ce3ff2af0951d3900c2c0dfb68ef16554d2b'
+        document = {'protocol_no': '11-111', 'match_path': 'treatment_list.step.0', 'q': [1, 2.5, None, True]}
+        assert legacy_nested_object_hash(document) == legacy_digest
+        assert nested_object_hash(document) == legacy_digest
+
+        previous = set_legacy_hashing(False)
+        try:
+            assert previous
+            assert nested_object_hash(document) != legacy_digest
+            # multi-byte characters are hashed by their characters
+            assert nested_object_hash({'gene': 'Ä'}) != nested_object_hash({'gene': 'ä'})
+            assert nested_object_hash({'gene': 'ŁĄ'}) != nested_object_hash({'gene': 'ŁĆ'})
+            # values are tagged with their type, and strings delimited
+            assert len({nested_object_hash({'v': value}) for value in (1, 1.0, True, '1', None, 'None')}) == 6
+            assert nested_object_hash({'a': 'b', 'c': 'd'}) != nested_object_hash({'a': 'b:c', '': 'd'})
+            assert nested_object_hash({'v': (1, 2)}) != nested_object_hash({'v': (2, 1)})
+        finally:
+            set_legacy_hashing(previous)
+        assert nested_object_hash(document) == legacy_digest
+
+    def test_composite_match_hash(self):
+        trial = {'protocol_no': '11-111', 'staff': [{'name': 'a'}, {'name': 'b'}]}
+        clinical = {'sample_id': 'S1', 'age': 42}
+        document = {**clinical, **trial, 'match_path': 'treatment_list.step.0', 'is_disabled': False, 'hash': 'x'}
+        composite_hash = composite_match_hash(document, (PartialDigest(trial), PartialDigest(clinical)), {'hash'})
+        # the hash depends neither on which section values are reused from, nor on the order of keys
+        assert composite_hash == composite_match_hash(document, (), {'hash'})
+        assert composite_hash == composite_match_hash(dict(reversed(list(document.items()))),
+                                                      (PartialDigest(clinical),),
+                                                      {'hash'})
+        # nor on the excluded keys, and digests reused from a section are the same as computed ones
+        assert composite_hash == composite_match_hash({**document, 'hash': 'y'}, (PartialDigest(trial),), {'hash'})
+        assert composite_hash != composite_match_hash({**document, 'age': 43}, (), {'hash'})
+        assert composite_hash != composite_match_hash({**document, 'is_disabled': 0}, (), {'hash'})
+        assert composite_hash != composite_match_hash(document, (), set())
+
+    def test_trial_match_template(self):
+        self.me.cache = Cache()
+        self.me._trial_match_templates = dict()
+        self.me._clinical_match_fields = dict()
+        clinical_id = 'clinical_1'
+        self.me.cache.docs[clinical_id] = {'_id': clinical_id, 'SAMPLE_ID': 'S1', 'AGE': 42, '_updated': 1,
+                                           'CODE': 'clinical'}
+        trial = {'protocol_no': '12-345', '_id': 'trial_1', 'treatment_list': {}, 'status': 'Open', 'code': 'trial'}
+        match_clause_data = MatchClauseData(match_clause=MatchClause([{}]),
+                                            internal_id='123',
+                                            code='456',
+                                            coordinating_center='The Death Star',
+                                            status='Open to Accrual',
+                                            parent_path=ParentPath(('treatment_list', 'step', 0)),
+                                            match_clause_level=MatchClauseLevel('step'),
+                                            match_clause_additional_attributes={},
+                                            protocol_no='12-345',
+                                            is_suspended=True)
+        match_criterion = MatchCriterion([MatchCriteria({}, 0, 0)])
+        trial_matches = [TrialMatch(trial, match_clause_data, match_criterion, None,
+                                    ClinicalMatchReason(None, clinical_id, depth, True), None)
+                         for depth in (1, 2)]
+        first, second = [self.me.pre_process_trial_matches(trial_match) for trial_match in trial_matches]
+        assert first == {'sample_id': 'S1', 'age': 42, 'code': 'trial', 'clinical_id': clinical_id,
+                         'match_level': 'step', 'internal_id': '123', 'reason_type': 'clinical', 'q_depth': 1,
+                         'q_width': 1, 'trial_curation_level_status': 'closed',
+                         'trial_summary_status': 'Open to Accrual', 'coordinating_center': 'The Death Star',
+                         'show_in_ui': True, 'query_hash': match_criterion.hash(), 'protocol_no': '12-345',
+                         'match_path': 'treatment_list.step.0',
+                         'combo_coord': nested_object_hash({'query_hash': match_criterion.hash(),
+                                                            'match_path': 'treatment_list.step.0',
+                                                            'protocol_no': '12-345'}),
+                         'is_disabled': False}
+        assert second == dict(first, q_depth=2)
+        # documents are new dicts, sharing the fields computed once
+        assert first is not second and first['combo_coord'] is second['combo_coord']
+        first['sample_id'] = 'S2'
+        assert self.me.pre_process_trial_matches(trial_matches[0])['sample_id'] == 'S1'
+        # fields added to a document by a plugin don't carry over to the following documents
+        first['variant_category'] = 'TMB'
+        second['variant_category'] = 'TMB'
+        assert 'variant_category' not in self.me.pre_process_trial_matches(trial_matches[0])
+        assert 'variant_category' not in self.me.pre_process_trial_matches(trial_matches[1])
+        # a reloaded clinical document is copied again
+        self.me.cache.docs[clinical_id] = dict(self.me.cache.docs[clinical_id], AGE=43)
+        assert self.me.pre_process_trial_matches(trial_matches[0])['age'] == 43
+
+    def test_create_trial_matches_batch(self):
+        # without a batch hook in the plugin, documents are created one at a time
+        find_plugins(self.me)
+        assert self.me.create_trial_matches_batch.__func__ is MatchEngine.create_trial_matches_batch
+
+        self.me.cache = Cache()
+        self.me._clinical_match_fields = dict()
+        clinical_ids = ['clinical_1', 'clinical_2', 'clinical_2']
+        for tmb, clinical_id in enumerate(clinical_ids):
+            self.me.cache.docs[clinical_id] = {'_id': clinical_id, 'SAMPLE_ID': clinical_id,
+                                               'TUMOR_MUTATIONAL_BURDEN_PER_MEGABASE': tmb}
+        match_criterion = MatchCriterion([MatchCriteria([{'clinical': {'oncotree_primary_diagnosis': '_SOLID_'}}],
+                                                        0, 0)])
+        query_part = QueryPart({'TUMOR_MUTATIONAL_BURDEN_PER_MEGABASE': {'$gte': 0}}, False, True, False)
+        trial_matches = [TrialMatch({}, None, match_criterion, None,
+                                    ClinicalMatchReason(query_part, clinical_id, 1, True), None)
+                         for clinical_id in clinical_ids]
+
+        pre_processed = list()
+
+        def pre_process_trial_matches(trial_match):
+            # a stand-in for MatchEngine.pre_process_trial_matches, copying the cached clinical fields
+            new_trial_match = dict(self.me.get_clinical_match_fields(trial_match.match_reason.clinical_id))
+            pre_processed.append(dict(new_trial_match))
+            return new_trial_match
+
+        documents = DFCITrialMatchDocumentCreator.create_trial_matches_batch(self.me,
+                                                                             trial_matches,
+                                                                             pre_process_trial_matches)
+        assert documents == [DFCITrialMatchDocumentCreator.create_trial_matches(self.me,
+                                                                                trial_match,
+                                                                                pre_process_trial_matches(trial_match))
+                             for trial_match in trial_matches]
+        assert [document['cancer_type_match'] for document in documents] == ['all_solid'] * 3
+        assert [document['match_type'] for document in documents] == ['generic_clinical', 'tmb', 'tmb']
+        assert [document.get('variant_category', None) for document in documents] == [None, 'TMB', 'TMB']
+        # the cached clinical documents are not modified, so no field carries over to later trial matches
+        assert not any('variant_category' in self.me.cache.docs[clinical_id] for clinical_id in clinical_ids)
+        assert not any('variant_category' in new_trial_match for new_trial_match in pre_processed)
+
+    def test_sort_order_evaluator(self):
+        evaluator = SortOrderEvaluator(self.config['trial_match_sorting'], 'protocol_no')
+        documents = [
+            {'show_in_ui': True, 'trial_curation_level_status': 'closed', 'match_type': 'mmr', 'tier': 2,
+             'cnv_call': 'Gain', 'coordinating_center': 'Dana-Farber Cancer Institute', 'protocol_no': '12-345'},
+            {'show_in_ui': False, 'match_type': 'variant', 'variant_category': 'SV', 'wildtype': False},
+            {'protocol_no': ObjectId()}
+        ]
+        expected = [[-1, 20, 99, 99, 99, 0, 12345], [-1, 99, 0, 0, 99, 99], [99] * 6]
+        assert [evaluator.sort_order(document) for document in documents] == expected
+        assert evaluator.sort_orders(documents) == expected
+        # a field with an ANY_VALUE sorting value matches whatever its value
+        evaluator = SortOrderEvaluator([{'tier': {'1': 5, 'ANY_VALUE': 7}}], 'protocol_no')
+        assert evaluator.sort_orders([{'tier': 1}, {'tier': None}, {}]) == [[7], [7], [99]]
+
+    def test_cache_in_process_waiting(self):
+        cache = Cache()
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            need_new, future, waiting_on = cache.claim('query', {1, 2, 3})
+            assert need_new == {1, 2, 3} and not waiting_on
+
+            # a second worker needing overlapping ids should only query the ids not already in process
+            other_need_new, other_future, other_waiting_on = cache.claim('query', {2, 3, 4})
+            assert other_need_new == {4} and other_waiting_on == {future}
+
+            async def fetch():
+                await asyncio.sleep(0)
+                cache.ids['query'].update({1: 1, 3: 3})
+                cache.release('query', need_new, future)
+
+            fetch_task = loop.create_task(fetch())
+            await cache.wait_for(other_waiting_on)
+            assert fetch_task.done()
+            # only matching clinical ids are kept in the id cache
+            assert cache.ids['query'] == {1: 1, 3: 3}
+            assert cache.queried['query'] == {1, 2, 3} and cache.matched['query'] == {1, 3}
+            cache.release('query', other_need_new, other_future)
+            assert not cache.in_process['query']
+            assert cache.queried['query'] == {1, 2, 3, 4} and cache.matched['query'] == {1, 3}
+            usage = cache.memory_usage()
+            assert usage['queried'] == usage['matched'] == 8 and usage['ids'] > 0
+
+            # failed queries raise in waiting workers and leave the ids unqueried
+            failed_need_new, failed_future, _ = cache.claim('failed', {1})
+            _, _, failed_waiting_on = cache.claim('failed', {1})
+            cache.release('failed', failed_need_new, failed_future, ValueError('query failed'))
+            try:
+                await cache.wait_for(failed_waiting_on)
+                assert False
+            except ValueError:
+                pass
+            assert cache.claim('failed', {1})[0] == {1}
+
+        loop.run_until_complete(run())
+        loop.close()
+
+    def test_persistent_query_cache(self):
+        first_run = datetime.datetime(2020, 1, 1)
+        second_run = datetime.datetime(2020, 2, 1)
+        loop = asyncio.new_event_loop()
+        cache_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(cache_dir.name, 'query_cache.sqlite')
+
+        async def run():
+            persistent = PersistentQueryCache(path, {1: first_run, 2: first_run, 3: first_run}, first_run)
+            cache = Cache(persistent=persistent)
+            need_new, future, _ = cache.claim('query', {1, 2, 3})
+            cache.ids['query'].update({1: {'genomic_1'}, 3: {'genomic_3'}})
+            cache.release('query', need_new, future)
+            assert cache.ids['query'] == {1: ('genomic_1',), 3: ('genomic_3',)}
+            persistent.close()
+
+            # clinical ID 3 has been updated since the first run, and clinical ID 4 is new
+            persistent = PersistentQueryCache(path,
+                                              {1: first_run, 2: first_run, 3: second_run, 4: second_run},
+                                              second_run)
+            assert persistent.load('query') == {1: ('genomic_1',), 2: None}
+            cache = Cache(persistent=persistent)
+            need_new, future, _ = cache.claim('query', {1, 2, 3, 4})
+            assert need_new == {3, 4}
+            assert cache.matched['query'] == {1}
+            cache.release('query', need_new, future)
+            persistent.close()
+            persistent = PersistentQueryCache(path, {3: second_run}, second_run)
+            assert persistent.load('query') == {3: None}
+            # only matches are stored one row each, and loading dropped the match superseded by the second run
+            assert persistent.connection.execute("SELECT COUNT(*) FROM query_matches").fetchone() == (1,)
+            persistent.close()
+
+            # pending results are written as soon as flush_size of them are queued
+            persistent = PersistentQueryCache(path, {5: second_run, 6: second_run}, second_run, flush_size=3)
+            persistent.record('other', [5], {})
+            assert persistent.pending_size == 1
+            persistent.record('other', [6], {6: ('genomic_6',)})
+            assert persistent.pending_size == 0
+            assert persistent.load('other') == {5: None, 6: ('genomic_6',)}
+            persistent.close()
+
+        loop.run_until_complete(run())
+        loop.close()
+        cache_dir.cleanup()
+
+    def test_clinical_id_set(self):
+        clinical_id_index = ClinicalIDIndex(range(100))
+        evens = clinical_id_index.to_set(range(0, 100, 2))
+        small = clinical_id_index.to_set(range(10))
+        assert len(evens) == 50 and 64 in evens and 65 not in evens and 1000 not in evens
+        assert evens & small == {0, 2, 4, 6, 8}
+        assert small - evens == {1, 3, 5, 7, 9}
+        assert len(evens | small) == 55
+        assert list(small) == list(range(10))
+        assert not clinical_id_index.empty_set() and small
+
+        # sets created before the index grew are padded when combined with newer sets
+        grown = clinical_id_index.to_set([200, 2])
+        assert small | grown == set(range(10)) | {200}
+        assert grown - small == {200}
+        small &= grown
+        assert small == {2}
+        assert clinical_id_index.to_set({1, 2}) == clinical_id_index.to_set([2, 1, 2])
+
+    def test_in_memory_clinical_evaluator(self):
+        clinical_data = {
+            1: {'_id': 1, 'GENDER': 'Male', 'BIRTH_DATE_INT': 19700101, 'TMB': 10.5, 'DIAGNOSIS': 'Melanoma'},
+            2: {'_id': 2, 'GENDER': 'Female', 'BIRTH_DATE_INT': 20100101, 'TMB': 2, 'DIAGNOSIS': 'Glioma'},
+            3: {'_id': 3, 'GENDER': 'Female', 'BIRTH_DATE_INT': 19500101, 'TMB': True},
+            4: {'_id': 4, 'GENDER': 'Male', 'BIRTH_DATE_INT': 19900101, 'DIAGNOSIS': ['Melanoma']}
+        }
+        clinical_id_index = ClinicalIDIndex([5])
+        evaluator = InMemoryClinicalEvaluator(clinical_id_index,
+                                              clinical_data,
+                                              ['GENDER', 'BIRTH_DATE_INT', 'TMB', 'DIAGNOSIS'])
+        all_ids = set(clinical_data.keys())
+        assert evaluator.clinical_ids == all_ids
+
+        def evaluate(query, clinical_ids=all_ids):
+            query_hash = nested_object_hash(query)
+            if not evaluator.supports(query_hash, query):
+                return None
+            return evaluator.evaluate(query_hash, query, clinical_id_index.to_set(clinical_ids))
+
+        assert evaluate({'GENDER': 'Female'}) == {2, 3}
+        assert evaluate({'GENDER': 'Female'}, {1, 2}) == {2}
+        assert evaluate({'GENDER': {'$in': ['Male', 'Other']}}) == {1, 4}
+        assert evaluate({'GENDER': {'$nin': ['Male']}}) == {2, 3}
+        assert evaluate({'BIRTH_DATE_INT': {'$lte': 19700101}}) == {1, 3}
+        assert evaluate({'BIRTH_DATE_INT': {'$gt': 19600101, '$lt': 20000101}}) == {1, 4}
+        assert evaluate({'$or': [{'GENDER': 'Male'}, {'BIRTH_DATE_INT': {'$lt': 19600101}}]}) == {1, 3, 4}
+
+        # numbers match across int and float, but not bools, and missing fields match None
+        assert evaluate({'TMB': {'$gte': 2.0}}) == {1, 2}
+        assert evaluate({'TMB': 2.0}) == {2}
+        assert evaluate({'TMB': True}) == {3}
+        assert evaluate({'TMB': None}) == {4}
+
+        # unsupported operators, unloaded or array fields are left to the database
+        assert evaluate({'GENDER': {'$regex': '^M'}}) is None
+        assert evaluate({'BIRTH_DATE_INT': {'$lte': datetime.datetime(1970, 1, 1)}}) is None
+        assert evaluate({'VITAL_STATUS': 'alive'}) is None
+        assert evaluate({'DIAGNOSIS': 'Melanoma'}) is None
+
+    def test_extended_attribute_index(self):
+        genomic_docs = [
+            {'_id': 'g1', 'CLINICAL_ID': 1, 'TRUE_HUGO_SYMBOL': 'BRAF', 'TRUE_PROTEIN_CHANGE': 'p.V600E',
+             'VARIANT_CATEGORY': 'MUTATION', 'WILDTYPE': False},
+            {'_id': 'g2', 'CLINICAL_ID': 1, 'TRUE_HUGO_SYMBOL': 'EGFR', 'VARIANT_CATEGORY': 'CNV',
+             'CNV_CALL': 'Gain', 'WILDTYPE': False},
+            {'_id': 'g3', 'CLINICAL_ID': 2, 'TRUE_HUGO_SYMBOL': 'BRAF', 'TRUE_PROTEIN_CHANGE': 'p.V600K',
+             'VARIANT_CATEGORY': 'MUTATION', 'WILDTYPE': True, 'TRUE_TRANSCRIPT_EXON': 15},
+            {'_id': 'g4', 'CLINICAL_ID': 3, 'TRUE_HUGO_SYMBOL': 'ALK', 'VARIANT_CATEGORY': 'SV',
+             'STRUCTURAL_VARIANT_COMMENT': 'EML4-ALK fusion', 'TRUE_TRANSCRIPT_EXON': [1, 2]},
+        ]
+        fields = ['TRUE_HUGO_SYMBOL', 'TRUE_PROTEIN_CHANGE', 'VARIANT_CATEGORY', 'CNV_CALL', 'WILDTYPE',
+                  'STRUCTURAL_VARIANT_COMMENT', 'TRUE_TRANSCRIPT_EXON']
+        clinical_id_index = ClinicalIDIndex()
+        index = ExtendedAttributeIndex(clinical_id_index, 'genomic', 'CLINICAL_ID', '_id', fields, genomic_docs)
+
+        def find(query, clinical_ids=frozenset({1, 2, 3})):
+            docs = index.find(nested_object_hash(query), query, clinical_id_index.to_set(clinical_ids))
+            return None if docs is None else {(doc['CLINICAL_ID'], doc['_id']) for doc in docs}
+
+        assert find({'TRUE_HUGO_SYMBOL': 'BRAF', 'WILDTYPE': False}) == {(1, 'g1')}
+        assert find({'TRUE_HUGO_SYMBOL': 'BRAF'}, {2, 4}) == {(2, 'g3')}
+        assert find({'VARIANT_CATEGORY': {'$in': ['MUTATION', 'CNV']}, 'TRUE_HUGO_SYMBOL': {'$ne': 'BRAF'}}) == {
+            (1, 'g2')}
+        assert find({'CNV_CALL': None, 'WILDTYPE': {'$ne': True}}) == {(1, 'g1'), (3, 'g4')}
+        assert find({'$or': [{'TRUE_HUGO_SYMBOL': 'ALK'}, {'CNV_CALL': 'Gain'}]}) == {(1, 'g2'), (3, 'g4')}
+        assert find({'TRUE_PROTEIN_CHANGE': {'$regex': re.compile('^p.V600[ACDEFGHIKLMNPQRSTVWY]$', re.I)}}) == {
+            (1, 'g1'), (2, 'g3')}
+        assert find({'STRUCTURAL_VARIANT_COMMENT': re.compile(r'(.*\Walk\W.*)|(^alk\W.*)|(.*\Walk$)', re.I)}) == {
+            (3, 'g4')}
+        assert find({'TRUE_HUGO_SYMBOL': 'KRAS'}) == set()
+
+        # array valued, unindexed fields and unsupported operators are left to the database
+        assert find({'TRUE_TRANSCRIPT_EXON': 15}) is None
+        assert find({'TIER': 1}) is None
+        assert find({'TRUE_HUGO_SYMBOL': {'$exists': True}}) is None
+
+    def test_gather_bounded(self):
+        loop = asyncio.new_event_loop()
+        running = list()
+        max_running = list()
+
+        async def query(idx):
+            running.append(idx)
+            max_running.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(idx)
+            return idx
+
+        results = loop.run_until_complete(gather_bounded(2, [query(idx) for idx in range(5)]))
+        loop.close()
+        assert results == list(range(5))
+        assert max(max_running) == 2
+
+    def test_query_planner(self):
+        cache = Cache()
+        common, rare, unknown = [QueryPart({'field': value}, False, True, False) for value in ('common', 'rare', 'new')]
+        excluded = QueryPart({'field': 'excluded'}, True, True, False)
+        clinical_nodes = [QueryNode('clinical', idx, None, 0, [query_part])
+                          for idx, query_part in enumerate([unknown, common, excluded, rare])]
+        fusion, mutation = [QueryNode('genomic', idx, None, 0, [QueryPart({'variant': value}, False, True, False)])
+                            for idx, value in enumerate(('fusion', 'mutation'))]
+        fusion.finalize()
+        mutation.finalize()
+        cache.statistics[common.hash()] = [100, 80]
+        cache.statistics[excluded.hash()] = [100, 10]
+        cache.statistics[mutation.raw_query_hash()] = [100, 30]
+        planner = QueryPlanner(cache, {rare.hash(): (90, 1), fusion.raw_query_hash(): (100, 1)})
+        mcq = MultiCollectionQuery([QueryNodeContainer([mutation]), QueryNodeContainer([fusion])],
+                                   [QueryNodeContainer(clinical_nodes)])
+
+        assert planner.query_part_selectivity(excluded) == 0.9
+        assert planner.query_part_selectivity(unknown) == 1.0
+        assert [query_node.node_id for query_node in planner.plan_clinical_query_nodes(mcq)] == [3, 1, 2, 0]
+        assert [idx for idx, _ in planner.plan_extended_query_node_containers(mcq)] == [1, 0]
+        assert planner.extended_first(mcq)
+        mcq.extended_attributes = [QueryNodeContainer([fusion, mutation])]
+        assert round(planner.query_node_container_selectivity(mcq.extended_attributes[0]), 2) == 0.31
+        assert not planner.extended_first(mcq)
+        assert planner.statistics_updates() == {common.hash(): (100, 80),
+                                                excluded.hash(): (100, 10),
+                                                mutation.raw_query_hash(): (100, 30)}
@@ -29,6 +29,7 @@ setup(
         "python-dateutil>=2.8.0",
         "PyYAML>=5.1",
         "Pandas>=0.25.0",
+        "numpy>=1.17.0",
         "pymongo>=3.8.0",
         "networkx>=2.3",
         "motor==2.0.0"